@@ -0,0 +1,412 @@
+#
+# AlarmRuleEvaluator
+#
+# Evaluation of the rules of configured alarms against UVE contents
+#
+
+import json
+import os
+
+from .sandesh.viz.constants import VM_TABLE
+from .sandesh.alarmgen_ctrl.sandesh_alarm_base.ttypes import \
+    AlarmOperand2, AlarmCondition, AlarmMatch, AlarmConditionMatch, \
+    AlarmAndList
+
+
+class _AttrVal(object):
+    """ The value of an operand for one element of the UVE.
+        The path to the value is kept as a chain of (parent, node)
+        tuples, and only turned into a list if the variables of
+        the condition need it.
+    """
+    __slots__ = ('value', 'path', 'status')
+
+    def __init__(self, value, path, status):
+        self.value = value
+        self.path = path
+        self.status = status
+
+    def uve_path(self):
+        nodes = []
+        path = self.path
+        while path is not None:
+            path, node = path
+            nodes.append(node)
+        nodes.reverse()
+        return nodes
+# end class _AttrVal
+
+
+def _compile_attribute(attr_list):
+    """ Returns a function that gets the attribute 'attr_list' from
+        a UVE (or a part of it), as either an _AttrVal or a (possibly
+        nested) list of them
+    """
+    if not attr_list:
+        def get_attr(tuve, path):
+            return _AttrVal(tuve, path, True)
+        return get_attr
+
+    attr = attr_list[0]
+    get_rest = _compile_attribute(attr_list[1:])
+
+    def get_attr(tuve, path):
+        if tuve is None:
+            return _AttrVal(None, path, False)
+        if isinstance(tuve, dict):
+            if attr == '*' or attr == '__value':
+                return [get_rest(val, (path, {key: val})) \
+                        for key, val in tuve.items()]
+            elif attr == '__key':
+                return [get_rest(key, (path, {key: val})) \
+                        for key, val in tuve.items()]
+            else:
+                tuve = tuve.get(attr)
+                return get_rest(tuve, (path, {attr: tuve}))
+        elif isinstance(tuve, list):
+            return [get_attr(elem, (path, {'__list_element__': elem})) \
+                    for elem in tuve]
+        elif isinstance(tuve, str):
+            try:
+                json_elem = json.loads(tuve)
+            except ValueError:
+                return _AttrVal(None, path, False)
+            else:
+                return get_attr(json_elem, path)
+    return get_attr
+# end _compile_attribute
+
+
+def _get_attribute_from_uve_path(attr_list, uve_path):
+    ai = ui = 0
+    pnode = uve_path[ui]
+    while (ai < len(attr_list) and ui < len(uve_path)):
+        if attr_list[ai] == '__key':
+            return next(iter(uve_path[ui].keys()))
+        elif attr_list[ai] == '__value':
+            return next(iter(uve_path[ui].values()))
+        if attr_list[ai] != '*' and attr_list[ai] not in uve_path[ui]:
+            break
+        pnode = uve_path[ui]
+        ui += 1
+        ai += 1
+        if len(uve_path) > ui and '__list_element__' in uve_path[ui]:
+            pnode = uve_path[ui]
+            ui += 1
+    if not ui:
+        return None
+    val = next(iter(pnode.values()))
+    for a in attr_list[ai:]:
+        if val is None or not isinstance(val, dict):
+            return None
+        val = val.get(a)
+    return val
+# end _get_attribute_from_uve_path
+
+
+def _get_json_value(val):
+    try:
+        json.loads(val)
+    except (ValueError, TypeError):
+        return json.dumps(val)
+    else:
+        return val
+# end _get_json_value
+
+
+def _null_lt(val1, val2):
+    if val1 is None and val2 is None:
+        return False
+    if val1 is None:
+        return True
+    if val2 is None:
+        return False
+    return val1 < val2
+
+def _null_le(val1, val2):
+    if val1 is None:
+        return True
+    if val2 is None:
+        return False
+    return val1 <= val2
+
+def _null_gt(val1, val2):
+    if val1 is None and val2 is None:
+        return False
+    if val2 is None:
+        return True
+    if val1 is None:
+        return False
+    return val1 > val2
+
+def _null_ge(val1, val2):
+    if val2 is None:
+        return True
+    if val1 is None:
+        return False
+    return val1 >= val2
+
+def _in(val1, val2):
+    if not isinstance(val2, list):
+        return False
+    return val1 in val2
+
+def _not_in(val1, val2):
+    if not isinstance(val2, list):
+        return True
+    return val1 not in val2
+
+def _size_eq(val1, val2):
+    if not isinstance(val1, list):
+        return False
+    return len(val1) == val2
+
+def _size_ne(val1, val2):
+    if not isinstance(val1, list):
+        return True
+    return len(val1) != val2
+
+
+_OPERATIONS = {
+    '==': lambda val1, val2: val1 == val2,
+    '!=': lambda val1, val2: val1 != val2,
+    '<': _null_lt,
+    '<=': _null_le,
+    '>': _null_gt,
+    '>=': _null_ge,
+    'in': _in,
+    'not in': _not_in,
+    'range': lambda val1, val2: val2[0] <= val1 <= val2[1],
+    'size==': _size_eq,
+    'size!=': _size_ne,
+}
+
+
+class AlarmRuleEvaluator(object):
+    """ The rules of an alarm config, compiled into functions.
+        Operand paths are split, constant operands are parsed and
+        operations are looked up once, when the alarm config is
+        loaded, instead of every time a UVE is evaluated.
+
+        Calling the evaluator with a UVE key and the UVE contents
+        returns the list of AlarmAndList that match, or None.
+
+        uve_types is the set of UVE struct types that the rules read,
+        or None if they can read any struct type of the UVE.
+    """
+
+    def __init__(self, alarm_cfg, logger):
+        self._logger = logger
+        self._is_project_alarm = alarm_cfg.parent_type == 'project'
+        self._parent_fqname = None
+        if self._is_project_alarm:
+            self._parent_fqname = alarm_cfg.get_parent_fq_name_str()
+        self._or_list = []
+        self.uve_types = set()
+        if self._is_project_alarm:
+            # The project of a VM is taken from its interface list
+            self.uve_types.add('UveVirtualMachineAgent')
+        rules = alarm_cfg.alarm_rules
+        if rules is None or rules.or_list is None or \
+                any(cfg_and_list.and_list is None \
+                    for cfg_and_list in rules.or_list):
+            # The alarm is evaluated against any struct, and raised with
+            # no rules and an AlarmExceptionTrace, as the interpreter did
+            self._or_list = None
+            self.uve_types = None
+            return
+        for cfg_and_list in rules.or_list:
+            self._or_list.append([self._compile_condition(exp) \
+                for exp in cfg_and_list.and_list])
+    # end __init__
+
+    def _add_uve_type(self, attr):
+        # The first element of an operand is the UVE struct type
+        if self.uve_types is None:
+            return
+        typ = attr.split('.', 1)[0]
+        if typ in ('*', '__key', '__value'):
+            self.uve_types = None
+        else:
+            self.uve_types.add(typ)
+    # end _add_uve_type
+
+    def _parse_value(self, val, name):
+        if isinstance(val, (str, bytes, bytearray)):
+            try:
+                return json.loads(val)
+            except ValueError as e:
+                self._logger.warning(
+                    "Failed to parse %s as JSON: %s" % (name, str(e)))
+        return val
+    # end _parse_value
+
+    def _compile_condition(self, exp):
+        """ Returns a function that evaluates the expression 'exp'
+            against a UVE, and returns the AlarmConditionMatch or None
+        """
+        compare = _OPERATIONS.get(exp.operation, lambda val1, val2: None)
+        self._add_uve_type(exp.operand1)
+        if exp.operand2.json_value is None:
+            self._add_uve_type(exp.operand2.uve_attribute)
+        for var in exp.variables or []:
+            self._add_uve_type(var)
+        get_operand1 = _compile_attribute(exp.operand1.split('.'))
+        is_json = exp.operand2.json_value is not None
+        get_operand2 = None
+        json_error = None
+        const_val = None
+        const_cmp = None
+        if is_json:
+            try:
+                const_val = json.loads(exp.operand2.json_value)
+            except ValueError as e:
+                json_error = e
+            else:
+                const_cmp = self._parse_value(const_val, 'val2')
+        else:
+            get_operand2 = _compile_attribute(
+                exp.operand2.uve_attribute.split('.'))
+
+        # For each variable, find the operand whose path it follows
+        op1_list = exp.operand1.split('.')
+        variables = []
+        for var in exp.variables or []:
+            var_list = var.split('.')
+            p1 = os.path.commonprefix([op1_list, var_list])
+            from_op1 = True
+            if not is_json:
+                p2 = os.path.commonprefix(
+                    [exp.operand2.uve_attribute.split('.'), var_list])
+                from_op1 = p1 > p2
+            variables.append((var, var_list, from_op1))
+
+        parse_value = self._parse_value
+
+        def cmp_vals(val1, val2):
+            return compare(parse_value(val1, 'val1'),
+                           parse_value(val2, 'val2'))
+
+        def cmp_const(val1):
+            return compare(parse_value(val1, 'val1'), const_cmp)
+
+        def match(op1, op2):
+            json_vars = {}
+            if variables:
+                path1 = op1.uve_path()
+                path2 = None
+                for var, var_list, from_op1 in variables:
+                    if from_op1:
+                        var_val = _get_attribute_from_uve_path(var_list,
+                            path1)
+                    else:
+                        if path2 is None:
+                            path2 = op2.uve_path()
+                        var_val = _get_attribute_from_uve_path(var_list,
+                            path2)
+                    json_vars[var] = _get_json_value(var_val)
+            json_operand2_val = None
+            if not is_json:
+                json_operand2_val = _get_json_value(op2.value)
+            return AlarmMatch(json_operand1_value=_get_json_value(op1.value),
+                json_operand2_value=json_operand2_val,
+                json_variables=json_vars)
+
+        def condition_match(match_list):
+            return AlarmConditionMatch(
+                condition=AlarmCondition(operation=exp.operation,
+                    operand1=exp.operand1, operand2=AlarmOperand2(
+                        uve_attribute=exp.operand2.uve_attribute,
+                        json_value=exp.operand2.json_value),
+                    variables=exp.variables),
+                match=match_list)
+
+        def evaluate(uve):
+            op1 = get_operand1(uve, None)
+            if isinstance(op1, _AttrVal) and op1.status is False:
+                return None
+            if is_json:
+                if json_error is not None:
+                    raise json_error
+                op2 = const_val
+            else:
+                op2 = get_operand2(uve, None)
+                if isinstance(op2, _AttrVal) and op2.status is False:
+                    return None
+            op1_is_list = isinstance(op1, list)
+            op2_is_list = not is_json and isinstance(op2, list)
+            if not op1_is_list and not op2_is_list:
+                if is_json:
+                    matched = cmp_const(op1.value)
+                else:
+                    matched = cmp_vals(op1.value, op2.value)
+                if matched:
+                    return condition_match([match(op1, op2)])
+                return None
+            match_list = []
+            # both operand1 and operand2 are lists
+            if op1_is_list and op2_is_list:
+                if len(op1) != len(op2):
+                    return None
+                for val1, val2 in zip(op1, op2):
+                    if cmp_vals(val1.value, val2.value):
+                        match_list.append(match(val1, val2))
+            # operand1 is a list and operand2 is not
+            elif op1_is_list:
+                for val1 in op1:
+                    if is_json:
+                        matched = cmp_const(val1.value)
+                    else:
+                        matched = cmp_vals(val1.value, op2.value)
+                    if matched:
+                        match_list.append(match(val1, op2))
+            # operand1 is not a list and operand2 is
+            else:
+                for val2 in op2:
+                    if cmp_vals(op1.value, val2.value):
+                        match_list.append(match(op1, val2))
+            if match_list:
+                return condition_match(match_list)
+            return None
+        return evaluate
+    # end _compile_condition
+
+    def _get_uve_parent_fqname(self, table, uve_name, uve):
+        try:
+            # virtual-machine UVE key doesn't have project name in the prefix.
+            # Hence extract the project name from the interface_list.
+            if table == VM_TABLE:
+                return uve['UveVirtualMachineAgent']['interface_list'][0].\
+                    rsplit(':', 1)[0]
+            else:
+                return uve_name.rsplit(':', 1)[0]
+        except (KeyError, IndexError):
+            return None
+    # end _get_uve_parent_fqname
+
+    def __call__(self, uve_key, uve):
+        # For alarms configured under project, the parent fq_name of the uve
+        # should match with that of the alarm config
+        if self._is_project_alarm:
+            table, uve_name = uve_key.split(':', 1)
+            if self._get_uve_parent_fqname(table, uve_name, uve) != \
+                    self._parent_fqname:
+                return None
+        if self._or_list is None:
+            raise ValueError("Alarm has no rules")
+        or_list = []
+        for and_conds in self._or_list:
+            and_list = []
+            for cond in and_conds:
+                cond_match = cond(uve)
+                if cond_match is None:
+                    break
+                and_list.append(cond_match)
+            else:
+                or_list.append(AlarmAndList(and_list))
+        if or_list:
+            return or_list
+        return None
+    # end __call__
+
+# end class AlarmRuleEvaluator
@@ -10,6 +10,7 @@
 
 from gevent import monkey
 monkey.patch_all()
+import gevent.event
 import sys
 import json
 import socket
@@ -19,6 +20,9 @@ import traceback
 import signal
 import random
 import hashlib
+import heapq
+import os
+import zlib
 import logging
 import configparser
 from collections import OrderedDict
@@ -26,10 +30,9 @@ from pysandesh.sandesh_base import *
 from pysandesh.connection_info import ConnectionState
 from pysandesh.sandesh_logger import SandeshLogger
 from pysandesh.gen_py.sandesh_alarm.ttypes import SandeshAlarmAckResponseCode
-from .sandesh.viz.constants import VM_TABLE
 from .sandesh.alarmgen_ctrl.sandesh_alarm_base.ttypes import AlarmTrace, \
-    UVEAlarms, UVEAlarmInfo, UVEAlarmConfig, AlarmOperand2, AlarmCondition, \
-    AlarmMatch, AlarmConditionMatch, AlarmAndList, AlarmRules
+    UVEAlarms, UVEAlarmInfo, UVEAlarmConfig, AlarmRules, AlarmAndList, \
+    AlarmConditionMatch, AlarmCondition, AlarmOperand2, AlarmMatch
 from .sandesh.analytics.ttypes import *
 from .sandesh.nodeinfo.ttypes import NodeStatusUVE, NodeStatus
 from .sandesh.nodeinfo.cpuinfo.ttypes import *
@@ -43,6 +46,7 @@ from .alarmgen_cfg import CfgParser
 from .uveserver import UVEServer
 from .partition_handler import UveStreamProc
 from .alarmgen_config_handler import AlarmGenConfigHandler, _INVERSE_UVE_MAP
+from .alarm_rules import AlarmRuleEvaluator
 from .sandesh.alarmgen_ctrl.ttypes import PartitionOwnershipReq, \
     PartitionOwnershipResp, PartitionStatusReq, UVECollInfo, UVEGenInfo, \
     PartitionStatusResp, UVETableAlarmReq, UVETableAlarmResp, \
@@ -51,12 +55,15 @@ from .sandesh.alarmgen_ctrl.ttypes import PartitionOwnershipReq, \
     AlarmgenPartition, AlarmgenPartionInfo, AlarmgenUpdate, \
     UVETableInfoReq, UVETableInfoResp, UVEObjectInfo, UVEStructInfo, \
     UVETablePerfReq, UVETablePerfResp, UVETableInfo, \
+    PartitionStatsReq, PartitionStatsResp, AlarmgenPartitionStats, \
+    StageLatencyReq, StageLatencyResp, AlarmgenStageLatency, \
     UVEAlarmStateMachineInfo, UVEAlarmState, UVEAlarmOperState,\
     AlarmStateChangeTrace, UVEQTrace, AlarmConfig, AlarmConfigRequest, \
     AlarmConfigResponse, AlarmgenUVEStats, AlarmgenAlarmStats, \
     AlarmgenPartitionTrace, AlarmExceptionTrace
 
-from .opserver_util import AnalyticsDiscovery
+from .opserver_util import AnalyticsDiscovery, convert_to_string, \
+    LatencyHistogram
 from stevedore import hook, extension
 from pysandesh.util import UTCTimestampUsec
 from libpartition.libpartition import PartitionClient
@@ -69,7 +76,8 @@ OutputRow = namedtuple("OutputRow",["key","typ","val"])
 class AGTabStats(object):
     """ This class is used to store per-UVE-table information
         about the time taken and number of instances when
-        a UVE was retrieved, published or evaluated for alarms
+        a UVE was retrieved, published or evaluated for alarms,
+        and the number of alarm evaluations skipped
     """
     def __init__(self):
         self.reset()
@@ -86,6 +94,9 @@ class AGTabStats(object):
         self.call_time += get_time
         self.call_n += 1
 
+    def record_skip(self, skip_n):
+        self.skip_n += skip_n
+
     def get_result(self):
         if self.get_n:
             return self.get_time // self.get_n
@@ -111,10 +122,55 @@ class AGTabStats(object):
         self.get_n = 0
         self.pub_time = 0
         self.pub_n = 0
+        self.skip_n = 0
+
+
+class AGPartStats(object):
+    """ This class is used to store per-partition information
+        about the UVE batches processed: their number, the
+        distributions of the number of UVEs and time taken per batch,
+        and the longest time from the enqueueing of a UVE to its output
+    """
+    def __init__(self):
+        self.reset()
+
+    def record_batch(self, nuves, batch_time, age):
+        self.batch_n += 1
+        self.uves_n += nuves
+        self.uves_max = max(self.uves_max, nuves)
+        self.uves_hist.record(nuves)
+        self.batch_time += batch_time
+        self.batch_time_max = max(self.batch_time_max, batch_time)
+        self.batch_time_hist.record(batch_time)
+        self.age_max = max(self.age_max, age)
+
+    def uves_result(self):
+        if self.batch_n:
+            return self.uves_n // self.batch_n
+        else:
+            return 0
+
+    def batch_time_result(self):
+        if self.batch_n:
+            return self.batch_time // self.batch_n
+        else:
+            return 0
+
+    def reset(self):
+        self.batch_n = 0
+        self.uves_n = 0
+        self.uves_max = 0
+        self.uves_hist = LatencyHistogram()
+        self.batch_time = 0
+        self.batch_time_max = 0
+        self.batch_time_hist = LatencyHistogram()
+        self.age_max = 0
 
 
 class AGKeyInfo(object):
     """ This class is used to maintain UVE contents
+        If the fingerprints of the structs are given (see
+        UVEServer.get_uves), they are compared instead of the contents.
     """
 
     def __init__(self, part):
@@ -122,9 +178,19 @@ class AGKeyInfo(object):
         # key of struct name, value of content dict
 
         self.current_dict = {}
+        # key of struct name, value of content fingerprint
+        self.current_fprints = {}
+        # fingerprints restored from a checkpoint, until the UVE is read
+        self.restored_fprints = None
         self.update({})
 
-    def update_single(self, typ, val):
+    def _is_changed(self, typ, val, fprint):
+        old_fprint = self.current_fprints.get(typ)
+        if fprint is not None and old_fprint is not None:
+            return fprint != old_fprint
+        return val != self.current_dict[typ]
+
+    def update_single(self, typ, val, fprint=None):
         # A single UVE struct has changed
         # If the UVE has gone away, the val is passed in as None
 
@@ -139,20 +205,30 @@ class AGKeyInfo(object):
                 self.set_unchanged.remove(typ)
                 self.set_removed.add(typ)
                 del self.current_dict[typ]
+                self.current_fprints.pop(typ, None)
             else:
                 # both "added" and "removed" will be empty
-                if val != self.current_dict[typ]:
+                if self._is_changed(typ, val, fprint):
                     self.set_unchanged.remove(typ)
                     self.set_changed.add(typ)
                     self.current_dict[typ] = val
+                self._set_fprint(typ, fprint)
         else:
             if val != None:
                 self.set_added.add(typ)
                 self.current_dict[typ] = val
+                self._set_fprint(typ, fprint)
+
+    def _set_fprint(self, typ, fprint):
+        if fprint is None:
+            self.current_fprints.pop(typ, None)
+        else:
+            self.current_fprints[typ] = fprint
 
-    def update(self, new_dict):
+    def update(self, new_dict, fprints=None):
         # A UVE has changed, and we have the entire new
         # content of the UVE available in new_dict
+        fprints = fprints or {}
         set_current = set(new_dict.keys())
         set_past = set(self.current_dict.keys())
         set_intersect = set_current.intersection(set_past)
@@ -162,11 +238,38 @@ class AGKeyInfo(object):
         self.set_changed = set()
         self.set_unchanged = set()
         for o in set_intersect:
-            if new_dict[o] != self.current_dict[o]:
+            if self._is_changed(o, new_dict[o], fprints.get(o)):
                 self.set_changed.add(o)
             else:
                 self.set_unchanged.add(o)
         self.current_dict = new_dict
+        self.current_fprints = dict((typ, fprints[typ]) \
+            for typ in new_dict if typ in fprints)
+
+    def fingerprints(self):
+        # The fingerprint of each struct, or None if it is not known
+        if self.restored_fprints is not None:
+            return self.restored_fprints
+        return dict((typ, self.current_fprints.get(typ)) \
+            for typ in self.current_dict)
+
+    def restore(self, fprints):
+        # The UVE had these structs when it was checkpointed
+        self.restored_fprints = dict(fprints)
+
+    def reconcile(self):
+        # After the first update of a restored UVE, returns the structs
+        # that changed since the checkpoint, or None if not restored
+        if self.restored_fprints is None:
+            return None
+        restored = self.restored_fprints
+        self.restored_fprints = None
+        changed = set()
+        for typ in set(self.current_dict) | set(restored):
+            fprint = self.current_fprints.get(typ)
+            if fprint is None or fprint != restored.get(typ):
+                changed.add(typ)
+        return changed
 
     def values(self):
         return self.current_dict
@@ -184,44 +287,59 @@ class AGKeyInfo(object):
         return self.set_unchanged
 
 class AlarmProcessor(object):
+    """ Evaluates the alarms of a UVE. The results of an evaluation are
+        in uve_alarms and skipped; reset() clears them, so that the same
+        AlarmProcessor can be used for the next UVE.
+    """
 
     def __init__(self, sandesh):
         self._sandesh = sandesh
         self._logger = sandesh._logger
+        self.reset()
+
+    def reset(self):
         self.uve_alarms = {}
-        self.ActiveTimer = {}
-        self.IdleTimer = {}
-        self.FreqExceededCheck = {}
-        self.FreqCheck_Times = {}
-        self.FreqCheck_Seconds = {}
+        self.skipped = set()
+
+    @staticmethod
+    def reads_types(alarm, types):
+        """
+        Returns False if the alarm is known not to read any of the
+        given UVE struct types
+        """
+        if hasattr(alarm, '__call__'):
+            return True
+        evaluator = alarm.evaluator()
+        if evaluator is None or evaluator.uve_types is None:
+            return True
+        return not evaluator.uve_types.isdisjoint(types)
 
-    def process_alarms(self, alarm_fqname, alarm, uv, local_uve):
+    def process_alarms(self, alarm_fqname, alarm, uv, local_uve,
+                       changed_types=None):
+        """
+        Evaluate the alarm for the UVE. If the set of UVE struct types
+        that changed is given, and the alarm does not read any of them,
+        the alarm is not evaluated; it is added to 'skipped' instead.
+        """
         if not alarm.is_enabled():
             return
+        if changed_types is not None and \
+                not self.reads_types(alarm, changed_types):
+            self.skipped.add(alarm_fqname)
+            return
         sev = alarm.severity()
-        if not uv in self.ActiveTimer:
-            self.ActiveTimer[uv] = {}
-        self.ActiveTimer[uv][alarm_fqname] = alarm.ActiveTimer()
-        if not uv in self.IdleTimer:
-            self.IdleTimer[uv] = {}
-        self.IdleTimer[uv][alarm_fqname] = alarm.IdleTimer()
-        if not uv in self.FreqExceededCheck:
-            self.FreqExceededCheck[uv] = {}
-        self.FreqExceededCheck[uv][alarm_fqname] = alarm.FreqExceededCheck()
-        if not uv in self.FreqCheck_Times:
-            self.FreqCheck_Times[uv] = {}
-        self.FreqCheck_Times[uv][alarm_fqname] = alarm.FreqCheck_Times()
-        if not uv in self.FreqCheck_Seconds:
-            self.FreqCheck_Seconds[uv] = {}
-        self.FreqCheck_Seconds[uv][alarm_fqname] = alarm.FreqCheck_Seconds()
-
         try:
             # __call__ method overrides the generic alarm processing code.
             if hasattr(alarm, '__call__'):
                 or_list = alarm.__call__(uv, local_uve)
             else:
-                or_list = self._evaluate_uve_for_alarms(
-                    alarm.config(), uv, local_uve)
+                # The rules are compiled when the alarm config is loaded
+                evaluator = alarm.evaluator()
+                if evaluator is None:
+                    evaluator = AlarmRuleEvaluator(alarm.config(),
+                                                   self._logger)
+                    alarm.set_evaluator(evaluator)
+                or_list = evaluator(uv, local_uve)
             self._logger.debug("Alarm[%s] %s: %s" %
                 (uv, alarm_fqname, str(or_list)))
             if or_list:
@@ -242,311 +360,165 @@ class AlarmProcessor(object):
                     description=alarm.description(), ack=False)
     # end process_alarms
 
-    def _get_uve_attribute(self, tuve, attr_list, uve_path=None):
-        if uve_path is None:
-            uve_path = []
-        if tuve is None or not attr_list:
-            return {'value': tuve, 'uve_path': uve_path,
-                    'status': False if len(attr_list) else True}
-        if isinstance(tuve, dict):
-            if attr_list[0] in ('*', '__value'):
-                return [self._get_uve_attribute(val, attr_list[1:],
-                        uve_path+[{key: val}]) \
-                        for key, val in tuve.items()]
-            elif attr_list[0] == '__key':
-                return [self._get_uve_attribute(key, attr_list[1:],
-                        uve_path+[{key: val}]) \
-                        for key, val in tuve.items()]
-            else:
-                tuve = tuve.get(attr_list[0])
-                uve_path.append({attr_list[0]: tuve})
-                return self._get_uve_attribute(tuve, attr_list[1:], uve_path)
-        elif isinstance(tuve, list):
-            return [self._get_uve_attribute(elem, attr_list,
-                    uve_path+[{'__list_element__': elem}]) \
-                    for elem in tuve]
-        elif isinstance(tuve, str):
-            try:
-                json_elem = json.loads(tuve)
-            except ValueError:
-                return {'value': None, 'uve_path': uve_path, 'status': False}
-            else:
-                return self._get_uve_attribute(json_elem, attr_list, uve_path)
-    # end _get_uve_attribute
-
-    def _get_operand_value(self, uve, operand):
-        attr_list = operand.split('.')
-        return self._get_uve_attribute(uve, attr_list)
-    # end _get_operand_value
-
-    def _get_json_value(self, val):
-        try:
-            tval = json.loads(val)
-        except (ValueError, TypeError):
-            return json.dumps(val)
-        else:
-            return val
-    # end _get_json_value
-
-    def _get_attribute_from_uve_path(self, attr, uve_path):
-        attr_list = attr.split('.')
-        ai = ui = 0
-        pnode = uve_path[ui]
-        while (ai < len(attr_list) and ui < len(uve_path)):
-            if attr_list[ai] == '__key':
-                return next(iter(uve_path[ui].keys()))
-            elif attr_list[ai] == '__value':
-                return next(iter(uve_path[ui].values()))
-            if attr_list[ai] != '*' and attr_list[ai] not in uve_path[ui]:
-                break
-            pnode = uve_path[ui]
-            ui += 1
-            ai += 1
-            if len(uve_path) > ui and '__list_element__' in uve_path[ui]:
-                pnode = uve_path[ui]
-                ui += 1
-        if not ui:
-            return None
-        val = next(iter(pnode.values()))
-        for a in attr_list[ai:]:
-            if val is None or not isinstance(val, dict):
-                return None
-            val = val.get(a)
-        return val
-    # end _get_attribute_from_uve_path
-
-    def _get_json_variables(self, uve, exp, operand1_val,
-                            operand2_val, is_operand2_json_val):
-        json_vars = {}
-        for var in exp.variables:
-            p1 = os.path.commonprefix([exp.operand1.split('.'),
-                var.split('.')])
-            if not is_operand2_json_val:
-                p2 = os.path.commonprefix(
-                    [exp.operand2.uve_attribute.split('.'), var.split('.')])
-                if p1 > p2:
-                    var_val = self._get_attribute_from_uve_path(var,
-                        operand1_val['uve_path'])
-                else:
-                    var_val = self._get_attribute_from_uve_path(var,
-                        operand2_val['uve_path'])
-            else:
-                var_val = self._get_attribute_from_uve_path(var,
-                    operand1_val['uve_path'])
-            json_vars[var] = self._get_json_value(var_val)
-        return json_vars
-    # end _get_json_variables
+    def _evaluate_uve_for_alarms(self, alarm_cfg, uve_key, uve):
+        return AlarmRuleEvaluator(alarm_cfg, self._logger)(uve_key, uve)
+    # end _evaluate_uve_for_alarms
 
-    def _compare_operand_vals(self, val1, val2, operation):
-        try:
-            if val1 is not None:
-                val1 = json.loads(val1)
-        except (TypeError, ValueError) as e:
-            self._logger.warn(
-                f"Failed to parse val1 as JSON: {str(e)}"
-            )
-        try:
-            if val2 is not None:
-                val2 = json.loads(val2)
-        except (TypeError, ValueError) as e:
-            self._logger.warn(
-                f"Failed to parse val2 as JSON: {str(e)}"
-            )
-        if operation == '==':
-            return val1 == val2
-        elif operation == '!=':
-            return val1 != val2
-        elif operation == '<':
-            if val1 is None and val2 is None:
-                return False
-            if val1 is None:
-                return True
-            if val2 is None:
-                return False
-            return val1 < val2
-        elif operation == '<=':
-            if val1 is None:
-                return True
-            if val2 is None:
-                return False
-            return val1 <= val2
-        elif operation == '>':
-            if val1 is None and val2 is None:
-                return False
-            if val2 is None:
-                return True
-            if val1 is None:
-                return False
-            return val1 > val2
-        elif operation == '>=':
-            if val2 is None:
-                return True
-            if val1 is None:
-                return False
-            return val1 >= val2
-        elif operation == 'in':
-            if not isinstance(val2, list):
-                return False
-            return val1 in val2
-        elif operation == 'not in':
-            if not isinstance(val2, list):
-                return True
-            return val1 not in val2
-        elif operation == 'range':
-            return val2[0] <= val1 <= val2[1]
-        elif operation == 'size==':
-            if not isinstance(val1, list):
-                return False
-            return len(val1) == val2
-        elif operation == 'size!=':
-            if not isinstance(val1, list):
-                return True
-            return len(val1) != val2
-    # end _compare_operand_vals
-
-    def _get_alarm_match(self, uve, exp, operand1_val, operand2_val,
-                         is_operand2_json_val):
-        json_vars = self._get_json_variables(uve, exp, operand1_val,
-            operand2_val, is_operand2_json_val)
-        json_operand1_val = self._get_json_value(operand1_val['value'])
-        if not is_operand2_json_val:
-            json_operand2_val = self._get_json_value(operand2_val['value'])
-        else:
-            json_operand2_val = None
-        return AlarmMatch(json_operand1_value=json_operand1_val,
-            json_operand2_value=json_operand2_val, json_variables=json_vars)
-    # end _get_alarm_match
-
-    def _get_alarm_condition_match(self, uve, exp, operand1_val, operand2_val,
-                                   is_operand2_json_val, match_list=None):
-        if not match_list:
-            match_list = [self._get_alarm_match(uve, exp, operand1_val,
-                operand2_val, is_operand2_json_val)]
-        return AlarmConditionMatch(
-            condition=AlarmCondition(operation=exp.operation,
-                operand1=exp.operand1, operand2=AlarmOperand2(
-                    uve_attribute=exp.operand2.uve_attribute,
-                    json_value=exp.operand2.json_value),
-                variables=exp.variables),
-            match=match_list)
-    # end _get_alarm_condition_match
-
-    def _get_uve_parent_fqname(self, table, uve_name, uve):
-        try:
-            # virtual-machine UVE key doesn't have project name in the prefix.
-            # Hence extract the project name from the interface_list.
-            if table == VM_TABLE:
-                return uve['UveVirtualMachineAgent']['interface_list'][0].\
-                    rsplit(':', 1)[0]
-            else:
-                return uve_name.rsplit(':', 1)[0]
-        except (KeyError, IndexError):
-            return None
-    # end _get_uve_parent_fqname
 
-    def _evaluate_uve_for_alarms(self, alarm_cfg, uve_key, uve):
-        table, uve_name = uve_key.split(':', 1)
-        # For alarms configured under project, the parent fq_name of the uve
-        # should match with that of the alarm config
-        if alarm_cfg.parent_type == 'project':
-            uve_parent_fqname = self._get_uve_parent_fqname(table,
-                uve_name, uve)
-            if uve_parent_fqname != alarm_cfg.get_parent_fq_name_str():
-                return None
-        or_list = []
-        for cfg_and_list in alarm_cfg.alarm_rules.or_list:
-            and_list = []
-            and_list_fail = False
-            for exp in cfg_and_list.and_list:
-                operand1_val = self._get_operand_value(uve, exp.operand1)
-                if isinstance(operand1_val, dict) and \
-                    operand1_val['status'] is False:
-                    and_list_fail = True
-                    break
-                if exp.operand2.json_value is not None:
-                    operand2_val = json.loads(exp.operand2.json_value)
-                    is_operand2_json_val = True
-                else:
-                    operand2_val = self._get_operand_value(uve,
-                        exp.operand2.uve_attribute)
-                    if isinstance(operand2_val, dict) and \
-                        operand2_val['status'] is False:
-                        and_list_fail = True
-                        break
-                    is_operand2_json_val = False
-                if isinstance(operand1_val, list) or \
-                    (is_operand2_json_val is False and \
-                        isinstance(operand2_val, list)):
-                    match_list = []
-                    # both operand1_val and operand2_val are list
-                    if isinstance(operand1_val, list) and \
-                        (is_operand2_json_val is False and \
-                            isinstance(operand2_val, list)):
-                            if len(operand1_val) != len(operand2_val):
-                                and_list_fail = True
-                                break
-                            for i in range(0, len(operand1_val)):
-                                if self._compare_operand_vals(
-                                    operand1_val[i]['value'],
-                                    operand2_val[i]['value'],
-                                    exp.operation):
-                                    match_list.append(
-                                        self._get_alarm_match(
-                                        uve, exp, operand1_val[i],
-                                        operand2_val[i],
-                                        is_operand2_json_val))
-                    # operand1_val is list and operand2_val is not list
-                    elif isinstance(operand1_val, list):
-                        val2 = operand2_val
-                        if not is_operand2_json_val:
-                            val2 = operand2_val['value']
-                        for val1 in operand1_val:
-                            if self._compare_operand_vals(val1['value'],
-                                val2, exp.operation):
-                                match_list.append(self._get_alarm_match(
-                                    uve, exp, val1, operand2_val,
-                                    is_operand2_json_val))
-                    # operand1_val is not list and operand2_val is list
-                    elif is_operand2_json_val is False and \
-                        isinstance(operand2_val, list):
-                        for val2 in operand2_val:
-                            if self._compare_operand_vals(
-                                operand1_val['value'], val2['value'],
-                                exp.operation):
-                                match_list.append(self._get_alarm_match(
-                                    uve, exp, operand1_val, val2,
-                                    is_operand2_json_val))
-                    if match_list:
-                        and_list.append(self._get_alarm_condition_match(
-                            uve, exp, operand1_val, operand2_val,
-                            is_operand2_json_val, match_list))
-                    else:
-                        and_list_fail = True
-                        break
-                # Neither operand1_val nor operand2_val is a list
-                else:
-                    val1 = operand1_val['value']
-                    val2 = operand2_val
-                    if not is_operand2_json_val:
-                        val2 = operand2_val['value']
-                    if self._compare_operand_vals(val1, val2, exp.operation):
-                        and_list.append(self._get_alarm_condition_match(
-                            uve, exp, operand1_val, operand2_val,
-                            is_operand2_json_val))
-                    else:
-                        and_list_fail = True
-                        break
-            if not and_list_fail:
-                or_list.append(AlarmAndList(and_list))
-        if or_list:
-            return or_list
+# Bounds on the number of UVEs taken from a partition queue per batch
+_UVE_BATCH_MIN = 200
+_UVE_BATCH_MAX = 20000
+
+# Stages of UVE processing whose latency is recorded:
+#   kafka_to_uveq : from reading a kafka message to queueing the UVE
+#   uveq_wait     : from queueing a UVE to taking it for processing
+#   get_uve       : reading a batch of UVEs from the collectors' redis
+#   alarm_eval    : evaluating the alarms of a UVE
+#   send_agg_uve  : writing a batch of aggregated UVE rows
+_LATENCY_STAGES = ('kafka_to_uveq', 'uveq_wait', 'get_uve', 'alarm_eval',
+                   'send_agg_uve')
+_LATENCY_PERCENTILES = (50, 99, 99.9)
+
+# Number of aggregated UVEs in each chunk of a snapshot
+_AGG_SNAP_BATCH = 100
+
+# Writes a batch of aggregated UVE rows of a partition, and publishes them.
+# KEYS: AGPARTS of the instance, then AGPARTKEYS, AGPARTSEQ and AGPARTDIRTY
+#       of the partition, then the AGPARTVALUES key of each row
+# ARGV: part, acq_time, whether to maintain AGPARTDIRTY (1/0), AGPARTPUB
+#       channel, then for each row: op (U: update struct, R: remove struct, D: remove UVE),
+#       key, type, JSON value, JSON of the published element without its
+#       closing brace, whether to publish the value (1/0)
+# Returns: sequence number of the write, 1 if the partition is new or 2 if
+#       it has stale contents, the keys that were left with no struct, and
+#       the stale acquisition time. Nothing is written if the partition has
+#       stale contents; the caller clears them and writes again.
+_AGG_UVE_SCRIPT = """
+local parts_key, keys_key, seq_key, dirty_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local part, acq_time = ARGV[1], ARGV[2]
+local dirty = ARGV[3] == '1'
+local pub_channel = ARGV[4]
+local reset = 0
+local old_acq = redis.call('HGET', parts_key, part)
+if not old_acq then
+    redis.call('HSET', parts_key, part, acq_time)
+    reset = 1
+    old_acq = ''
+elseif tonumber(old_acq) ~= tonumber(acq_time) then
+    return {0, 2, {}, old_acq}
+end
+local check = {}
+local pub = {}
+local row = 4
+for i = 5, #ARGV, 6 do
+    local op, key, typ, val = ARGV[i], ARGV[i+1], ARGV[i+2], ARGV[i+3]
+    row = row + 1
+    local vals_key = KEYS[row]
+    if dirty then
+        redis.call('SADD', dirty_key, key)
+    end
+    if op == 'D' then
+        redis.call('SREM', keys_key, key)
+        redis.call('DEL', vals_key)
+    elseif op == 'R' then
+        redis.call('HDEL', vals_key, typ)
+        check[key] = vals_key
+    else
+        redis.call('SADD', keys_key, key)
+        redis.call('HSET', vals_key, typ, val)
+    end
+    if ARGV[i+5] == '1' then
+        pub[#pub+1] = ARGV[i+4] .. ', "value": ' .. val
+    else
+        pub[#pub+1] = ARGV[i+4]
+    end
+end
+local empty = {}
+for key, vals_key in pairs(check) do
+    if redis.call('EXISTS', vals_key) == 0 then
+        redis.call('SREM', keys_key, key)
+        empty[#empty+1] = key
+    end
+end
+local seq = redis.call('INCR', seq_key)
+local seq_str = string.format(', "seq": %d}', seq)
+for i = 1, #pub do
+    pub[i] = pub[i] .. seq_str
+end
+redis.call('PUBLISH', pub_channel, '[' .. table.concat(pub, ', ') .. ']')
+return {seq, reset, empty, old_acq}
+"""
+
+
+def alarm_rules_to_dict(alarm_rules):
+    """
+    Return the AlarmRules of an alarm as plain dicts and lists
+    """
+    if alarm_rules is None or alarm_rules.or_list is None:
         return None
-    # end _evaluate_uve_for_alarms
+    or_list = []
+    for and_list in alarm_rules.or_list:
+        conds = []
+        for cond_match in and_list.and_list:
+            cond = cond_match.condition
+            conds.append({
+                'condition': {'operation': cond.operation,
+                    'operand1': cond.operand1,
+                    'operand2': {
+                        'uve_attribute': cond.operand2.uve_attribute,
+                        'json_value': cond.operand2.json_value},
+                    'variables': cond.variables},
+                'match': [{'json_operand1_value': match.json_operand1_value,
+                    'json_operand2_value': match.json_operand2_value,
+                    'json_variables': match.json_variables} \
+                    for match in cond_match.match]})
+        or_list.append(conds)
+    return or_list
+# end alarm_rules_to_dict
+
+
+def alarm_rules_from_dict(or_list):
+    """
+    Return the AlarmRules of the plain dicts and lists returned by
+    alarm_rules_to_dict
+    """
+    if or_list is None:
+        return AlarmRules(None)
+    return AlarmRules(or_list=[AlarmAndList(and_list=[AlarmConditionMatch(
+        condition=AlarmCondition(operation=cond['condition']['operation'],
+            operand1=cond['condition']['operand1'],
+            operand2=AlarmOperand2(**cond['condition']['operand2']),
+            variables=cond['condition']['variables']),
+        match=[AlarmMatch(**match) for match in cond['match']]) \
+        for cond in and_list]) for and_list in or_list])
+# end alarm_rules_from_dict
+
+
+def alarm_config_digest(alarm_obj):
+    """
+    Return a digest of what an alarm evaluates and how its state machine
+    is run, so that alarm states checkpointed under a different config
+    are not restored
+    """
+    if alarm_obj.config():
+        rules = alarm_obj.config().alarm_rules
+    else:
+        rules = alarm_obj.rules()
+    cfg = json.dumps([rules, alarm_obj.severity(), alarm_obj.ActiveTimer(),
+        alarm_obj.IdleTimer(), alarm_obj.FreqCheck_Times(),
+        alarm_obj.FreqCheck_Seconds(), alarm_obj.FreqExceededCheck(),
+        alarm_obj.is_enabled()], sort_keys=True,
+        default=lambda obj: getattr(obj, '__dict__', str(obj)))
+    return hashlib.md5(cfg.encode()).hexdigest()
+# end alarm_config_digest
 
 
 class AlarmStateMachine(object):
+    # Pending timers, as a set of (tab, uv, nm) for each timeout second,
+    # and a heap of the timeout seconds, so that only the due timers
+    # are looked at when the timers are run
     tab_alarms_timer = {}
-    last_timers_run = None
+    timer_heap = []
     def __init__(self, tab, uv, nm, sandesh, activeTimer, idleTimer,
             freqCheck_Times, freqCheck_Seconds, freqExceededCheck):
         self._sandesh = sandesh
@@ -579,6 +551,57 @@ class AlarmStateMachine(object):
     def get_uac(self):
         return self.uac
 
+    def get_state(self):
+        """
+        Return the state and the timeouts of the state machine as plain
+        dicts and lists, so that it can be checkpointed as JSON
+        """
+        uai = None
+        if self.uai:
+            uai = {'type': self.uai.type, 'severity': self.uai.severity,
+                   'timestamp': self.uai.timestamp, 'token': self.uai.token,
+                   'description': self.uai.description,
+                   'ack': self.uai.ack,
+                   'alarm_rules': alarm_rules_to_dict(self.uai.alarm_rules)}
+        return {'uac': {'ActiveTimer': self.uac.ActiveTimer,
+                        'IdleTimer': self.uac.IdleTimer,
+                        'FreqCheck_Times': self.uac.FreqCheck_Times,
+                        'FreqCheck_Seconds': self.uac.FreqCheck_Seconds,
+                        'FreqExceededCheck': self.uac.FreqExceededCheck},
+                'uas': {'state': self.uas.state,
+                        'delete_timestamp': self.uas.delete_timestamp,
+                        'head_timestamp': self.uas.head_timestamp,
+                        'alarm_timestamp': list(self.uas.alarm_timestamp)},
+                'uai': uai,
+                'activeTimeout': self.activeTimeout,
+                'deleteTimeout': self.deleteTimeout,
+                'idleTimeout': self.idleTimeout}
+
+    def set_state(self, state):
+        """
+        Restore the state returned by get_state, and the pending
+        timer of that state
+        """
+        self.uac = UVEAlarmConfig(**state['uac'])
+        self.uas = UVEAlarmOperState(**state['uas'])
+        self.uai = None
+        if state['uai']:
+            uai = dict(state['uai'])
+            uai['alarm_rules'] = alarm_rules_from_dict(uai['alarm_rules'])
+            self.uai = UVEAlarmInfo(**uai)
+        self.activeTimeout = state['activeTimeout']
+        self.deleteTimeout = state['deleteTimeout']
+        self.idleTimeout = state['idleTimeout']
+        timeout = None
+        if self.uas.state == UVEAlarmState.Soak_Active:
+            timeout = self.activeTimeout
+        elif self.uas.state == UVEAlarmState.Soak_Idle:
+            timeout = self.idleTimeout
+        elif self.uas.state == UVEAlarmState.Idle:
+            timeout = self.deleteTimeout
+        if timeout and timeout > 0:
+            self._add_timer_to_list(timeout)
+
     def get_uas(self):
         return self.uas
 
@@ -619,10 +642,26 @@ class AlarmStateMachine(object):
             return True
         return False
 
+    @staticmethod
+    def add_timer(timeout, tab, uv, nm):
+        timers = AlarmStateMachine.tab_alarms_timer.get(timeout)
+        if timers is None:
+            timers = set()
+            AlarmStateMachine.tab_alarms_timer[timeout] = timers
+            heapq.heappush(AlarmStateMachine.timer_heap, timeout)
+        timers.add((tab, uv, nm))
+    # end add_timer
+
+    def _add_timer_to_list(self, index):
+        AlarmStateMachine.add_timer(index, self.tab, self.uv, self.nm)
+
     def _remove_timer_from_list(self, index):
-        AlarmStateMachine.tab_alarms_timer[index].discard((self.tab,\
-                                self.uv, self.nm))
-        if len(AlarmStateMachine.tab_alarms_timer[index]) == 0:
+        # The heap entry of an emptied bucket is dropped when it is due
+        timers = AlarmStateMachine.tab_alarms_timer.get(index)
+        if timers is None:
+            return
+        timers.discard((self.tab, self.uv, self.nm))
+        if len(timers) == 0:
             del AlarmStateMachine.tab_alarms_timer[index]
 
     def set_alarms(self):
@@ -636,8 +675,7 @@ class AlarmStateMachine(object):
             self.uas.state = UVEAlarmState.Active
             self._remove_timer_from_list(self.idleTimeout)
         elif self.uas.state == UVEAlarmState.Idle:
-            if self.deleteTimeout and (self.deleteTimeout in \
-                    AlarmStateMachine.tab_alarms_timer):
+            if self.deleteTimeout:
                 self._remove_timer_from_list(self.deleteTimeout)
             if self.uac.FreqExceededCheck:
                 # log the timestamp
@@ -654,11 +692,7 @@ class AlarmStateMachine(object):
                 # put it on the timer
                 self.uas.state = UVEAlarmState.Soak_Active
                 self.activeTimeout = curr_time + self.uac.ActiveTimer
-                timeout_value = self.activeTimeout
-                if not timeout_value in AlarmStateMachine.tab_alarms_timer:
-                    AlarmStateMachine.tab_alarms_timer[timeout_value] = set()
-                AlarmStateMachine.tab_alarms_timer[timeout_value].add\
-                        ((self.tab, self.uv, self.nm))
+                self._add_timer_to_list(self.activeTimeout)
         self.send_state_change_trace(old_state, self.uas.state)
     #end set_alarms
 
@@ -690,11 +724,7 @@ class AlarmStateMachine(object):
             self._remove_timer_from_list(self.activeTimeout)
             if self.uac.FreqCheck_Seconds:
                 self.deleteTimeout = cur_time + self.uac.FreqCheck_Seconds
-                to_value = self.deleteTimeout
-                if not to_value in AlarmStateMachine.tab_alarms_timer:
-                    AlarmStateMachine.tab_alarms_timer[to_value] = set()
-                AlarmStateMachine.tab_alarms_timer[to_value].add\
-                    ((self.tab, self.uv, self.nm))
+                self._add_timer_to_list(self.deleteTimeout)
             else:
                 delete_alarm = True
         elif self.uas.state == UVEAlarmState.Active:
@@ -703,21 +733,13 @@ class AlarmStateMachine(object):
                 self.uas.state = UVEAlarmState.Idle
                 if self.uac.FreqCheck_Seconds:
                     self.deleteTimeout = cur_time + self.uac.FreqCheck_Seconds
-                    to_value = self.deleteTimeout
-                    if not to_value in AlarmStateMachine.tab_alarms_timer:
-                        AlarmStateMachine.tab_alarms_timer[to_value] = set()
-                    AlarmStateMachine.tab_alarms_timer[to_value].add\
-                        ((self.tab, self.uv, self.nm))
+                    self._add_timer_to_list(self.deleteTimeout)
                 else:
                     delete_alarm = True
             else:
                 self.uas.state = UVEAlarmState.Soak_Idle
                 self.idleTimeout = cur_time + self.uac.IdleTimer
-                to_value = self.idleTimeout
-                if not to_value in AlarmStateMachine.tab_alarms_timer:
-                    AlarmStateMachine.tab_alarms_timer[to_value] = set()
-                AlarmStateMachine.tab_alarms_timer[to_value].add\
-                        ((self.tab, self.uv, self.nm))
+                self._add_timer_to_list(self.idleTimeout)
         self.send_state_change_trace(old_state, self.uas.state)
         return delete_alarm
 
@@ -816,58 +838,44 @@ class AlarmStateMachine(object):
 
     @staticmethod
     def run_timers(curr_time, tab_alarms):
-        inputs = namedtuple('inputs', ['tab', 'uv', 'nm',
-                            'delete_alarm', 'timeout_val', 'old_to'])
+        """
+        This function runs the timers that are due at curr_time.
+        Timer buckets are popped off the heap in timeout order, so the
+        cost is proportional to the number of due timers, and not to
+        the number of pending timers or of seconds since the last run
+        """
         delete_alarms = []
         update_alarms = []
-        if AlarmStateMachine.last_timers_run is None:
-            AlarmStateMachine.last_timers_run = curr_time
-        for next_timer in range(AlarmStateMachine.last_timers_run, curr_time + 1):
-          if next_timer in AlarmStateMachine.tab_alarms_timer:
-            update_timers = []
-            for (tab, uv, nm) in AlarmStateMachine.tab_alarms_timer[next_timer]:
-                asm = tab_alarms[tab][uv][nm]
+        timer_heap = AlarmStateMachine.timer_heap
+        while timer_heap and timer_heap[0] <= curr_time:
+            next_timer = heapq.heappop(timer_heap)
+            timers = AlarmStateMachine.tab_alarms_timer.pop(next_timer, None)
+            if timers is None:
+                # all the timers of this bucket were cancelled
+                continue
+            for (tab, uv, nm) in timers:
+                try:
+                    asm = tab_alarms[tab][uv][nm]
+                except KeyError:
+                    # the alarm was deleted along with its partition
+                    continue
                 delete_alarm, update_alarm, timeout_val = \
                                 asm.run_uve_soaking_timer(next_timer)
                 if delete_alarm:
                     delete_alarms.append((asm.tab, asm.uv, asm.nm))
                 if update_alarm:
                     update_alarms.append((asm.tab, asm.uv, asm.nm))
-                update_timers.append(inputs(tab=asm.tab, uv=asm.uv, nm=asm.nm,
-                                    delete_alarm=delete_alarm,
-                                    timeout_val=timeout_val, old_to=next_timer))
-            for timer in update_timers:
-                if timer.timeout_val is not None or timer.delete_alarm:
-                    AlarmStateMachine.update_tab_alarms_timer(timer.tab,
-                                    timer.uv, timer.nm, timer.old_to,
-                                    timer.timeout_val, tab_alarms)
-        AlarmStateMachine.last_timers_run = curr_time + 1
+                if not delete_alarm and timeout_val is not None and \
+                        timeout_val >= 0:
+                    AlarmStateMachine.add_timer(timeout_val, tab, uv, nm)
         return delete_alarms, update_alarms
+    # end run_timers
 
     @staticmethod
-    def update_tab_alarms_timer(tab, uv, nm, curr_index, timeout_val,
-            tab_alarms):
-        del_timers = []
-        if curr_index is not None and curr_index > 0:
-            timers = AlarmStateMachine.tab_alarms_timer[curr_index]
-            if (tab, uv, nm) in timers:
-                asm = tab_alarms[tab][uv][nm]
-                timers.discard((tab, uv, nm))
-            if len(timers) == 0:
-                del_timers.append(curr_index)
-        for timeout in del_timers:
-            del AlarmStateMachine.tab_alarms_timer[timeout]
-        if timeout_val is not None and timeout_val >= 0:
-            if not timeout_val in AlarmStateMachine.tab_alarms_timer:
-                AlarmStateMachine.tab_alarms_timer[timeout_val] = set()
-            if (tab, uv, nm) in AlarmStateMachine.tab_alarms_timer\
-                    [timeout_val]:
-                self._logger.error("Timer error for (%s,%s,%s)" % \
-                    (tab, uv, nm))
-                raise SystemExit(1)
-            AlarmStateMachine.tab_alarms_timer[timeout_val].add\
-                        ((asm.tab, asm.uv, asm.nm))
-
+    def clear_timers():
+        AlarmStateMachine.tab_alarms_timer.clear()
+        del AlarmStateMachine.timer_heap[:]
+    # end clear_timers
 
 
 class Controller(object):
@@ -975,6 +983,23 @@ class Controller(object):
         self.ptab_info = {}
         self.tab_perf = {}
         self.tab_perf_prev = {}
+        self.part_perf = {}
+        self.part_perf_prev = {}
+        # Latency histograms of the current and previous stats interval,
+        # and since the start, per stage
+        self.stage_hist = self.new_stage_hists()
+        self.stage_hist_prev = self.new_stage_hists()
+        self.stage_hist_total = self.new_stage_hists()
+        # Greenlet writing the periodic aggregated UVE snapshots
+        self._agg_snap_task = None
+        self._agg_snap_time = 0
+        # _AGG_UVE_SCRIPT, registered with the aggregated UVE redis
+        self._agg_script = None
+        # Greenlet writing the periodic partition checkpoints
+        self._ckpt_task = None
+        self._ckpt_time = time.time()
+        self._ckpt_seq = 0
+        self._ckpt_uves = {}
         for table in tables:
             self.mgrs[table] = hook.HookManager(
                 namespace='contrail.analytics.alarms',
@@ -1034,8 +1059,19 @@ class Controller(object):
         self._uvestats = {}
         self._alarmstats = {}
         self._uveq = {}
+        # Time at which each key of the UVE queue was enqueued
+        self._uveq_ts = {}
         self._uveqf = {}
+        # Set when there is work for run_uve_processing
+        self._uveq_event = gevent.event.Event()
+        # Set when the UVE queue of a partition is created or deleted
+        self._uveq_parts_event = gevent.event.Event()
+        # Moving average of the processing time (in seconds) per UVE
+        self._uve_key_time = None
         self._alarm_config_change_map = {}
+        # AlarmProcessor of each partition, and the alarms of each table
+        self._alarm_procs = {}
+        self._alarm_index = {}
 
         # form a string of ips
         zk_servers = ','.join(self._conf.zk_list())
@@ -1052,6 +1088,8 @@ class Controller(object):
         UVETableAlarmReq.handle_request = self.handle_UVETableAlarmReq
         UVETableInfoReq.handle_request = self.handle_UVETableInfoReq
         UVETablePerfReq.handle_request = self.handle_UVETablePerfReq
+        PartitionStatsReq.handle_request = self.handle_PartitionStatsReq
+        StageLatencyReq.handle_request = self.handle_StageLatencyReq
         AlarmConfigRequest.handle_request = self.handle_AlarmConfigRequest
 
     def partition_log(self, msg):
@@ -1150,6 +1188,15 @@ class Controller(object):
         uveq_trace.part = part
         if part not in self._uveq:
             self._uveq[part] = OrderedDict()
+            self._uveq_ts[part] = {}
+            # The UVEs restored from a checkpoint of the partition are
+            # read in full
+            ckpt_uves = self._ckpt_uves.pop(part, None)
+            if ckpt_uves:
+                ckpt_uves.update((uv, types) for uv, types in uves.items() \
+                    if uv not in ckpt_uves)
+                uves = ckpt_uves
+            self._uveq_parts_event.set()
             self._logger.info('Created uveQ for part %s' % str(part))
             uveq_trace.oper = "create"
         else:
@@ -1157,7 +1204,13 @@ class Controller(object):
         uveq_trace.trace_msg(name="UVEQTrace",\
                 sandesh=self._sandesh)
 
+        # A key that is already queued keeps its place in the queue,
+        # and the time at which it was first enqueued
+        curr_time = time.time()
+        uveq_ts = self._uveq_ts[part]
         for uv,types in uves.items():
+            if uv not in uveq_ts:
+                uveq_ts[uv] = curr_time
             if types is None:
                 self._uveq[part][uv] = None
             else:
@@ -1169,12 +1222,135 @@ class Controller(object):
                     self._uveq[part][uv] = {}
                     for kk in types.keys():
                         self._uveq[part][uv][kk] = {}
+        self._uveq_event.set()
+
+    def requeue_uve_notifq(self, part, uves, uves_ts):
+        """
+        Put back UVEs that could not be processed at the head of the
+        UVE queue, with the time at which they were first enqueued,
+        so that they are processed before the UVEs enqueued after them
+        """
+        self.handle_uve_notifq(part, uves)
+        uveq = self._uveq[part]
+        uveq_ts = self._uveq_ts[part]
+        for uv in reversed(list(uves.keys())):
+            uveq.move_to_end(uv, last=False)
+            if uv in uves_ts:
+                uveq_ts[uv] = min(uveq_ts[uv], uves_ts[uv])
+
+    def uveq_oldest_age(self, part):
+        """
+        Returns the time in seconds since the oldest UVE of the
+        UVE queue of the partition was enqueued, or 0 if it is empty
+        """
+        uveq = self._uveq.get(part)
+        if not uveq:
+            return 0
+        return time.time() - self._uveq_ts[part][next(iter(uveq))]
+
+    def uveq_size(self, part):
+        return len(self._uveq.get(part, {}))
+
+    def record_part_batch(self, part, nuves, batch_time, age):
+        """
+        Record a batch of nuves UVEs of the partition, processed in
+        batch_time usec, the oldest of which was output age msec
+        after it was enqueued
+        """
+        if part not in self.part_perf:
+            self.part_perf[part] = AGPartStats()
+        self.part_perf[part].record_batch(nuves, batch_time, age)
+
+    def partition_stats(self, part):
+        """
+        Returns the AlarmgenPartitionStats of the partition, with the
+        current kafka lag and UVE queue, and the batches processed
+        in the previous stats interval
+        """
+        ps = AlarmgenPartitionStats(partition = part)
+        worker = self._workers.get(part)
+        if worker is not None:
+            ps.kafka_lag = worker.lag()
+            ps.paused = worker.paused()
+        ps.uveq_size = self.uveq_size(part)
+        ps.uveq_oldest_age = int(self.uveq_oldest_age(part) * 1000)
+        perf = self.part_perf_prev.get(part)
+        if perf is None:
+            perf = AGPartStats()
+        ps.batches = perf.batch_n
+        ps.batch_uves_avg = perf.uves_result()
+        ps.batch_uves_max = perf.uves_max
+        ps.batch_time_avg = perf.batch_time_result()
+        ps.batch_time_max = perf.batch_time_max
+        ps.batch_uves_p50, ps.batch_uves_p99 = \
+            perf.uves_hist.percentiles((50, 99))
+        ps.batch_time_p50, ps.batch_time_p99, ps.batch_time_p999 = \
+            perf.batch_time_hist.percentiles(_LATENCY_PERCENTILES)
+        ps.processing_age_max = perf.age_max
+        return ps
+
+    def run_timed(self, part_timing, part, func, *args):
+        """
+        Call func, adding the time it takes to part_timing[part][0], and
+        setting part_timing[part][1] to the time at which it returns
+        """
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            end = time.time()
+            timing = part_timing.setdefault(part, [0, 0])
+            timing[0] += end - start
+            timing[1] = end
+
+    @staticmethod
+    def new_stage_hists():
+        return dict((stage, LatencyHistogram()) for stage in _LATENCY_STAGES)
+
+    def stage_latency(self, stage_hists):
+        """
+        Returns the AlarmgenStageLatency of each stage, for the
+        given latency histograms
+        """
+        latencies = []
+        for stage in _LATENCY_STAGES:
+            hist = stage_hists[stage]
+            p50, p99, p999 = hist.percentiles(_LATENCY_PERCENTILES)
+            latencies.append(AlarmgenStageLatency(stage = stage,
+                count = hist.count(), p50 = p50, p99 = p99, p999 = p999,
+                max = hist.max()))
+        return latencies
+
+    def uve_batch_size(self, nparts):
+        """
+        Returns the number of UVEs to take from each of the nparts
+        partition queues, so that processing them takes about the
+        configured target time
+        """
+        if not self._uve_key_time or not nparts:
+            return _UVE_BATCH_MIN
+        target = self._conf.uve_processing_target_msec() / 1000.0
+        size = int(target / (self._uve_key_time * nparts))
+        return max(_UVE_BATCH_MIN, min(size, _UVE_BATCH_MAX))
+
+    def update_uve_key_time(self, elapsed, nkeys):
+        if not nkeys:
+            return
+        key_time = elapsed / nkeys
+        if self._uve_key_time is None:
+            self._uve_key_time = key_time
+        else:
+            self._uve_key_time = 0.8 * self._uve_key_time + 0.2 * key_time
 
-    def handle_resource_check(self, part, current_inst):
+    def handle_resource_check(self, part, current_inst, batch_cb=None):
         """
         This function compares the set of synced redis instances
         against the set now being reported by UVEServer
 
+        The contents of the added instances are read in parallel.
+        If batch_cb is given, it is called with each batch of
+        contents as it is read.
+
         It returns :
         - The updated set of redis instances
         - A set of collectors to be removed
@@ -1193,8 +1369,11 @@ class Controller(object):
             coll_delete.add(ipaddr + ":" + str(port))
 
         chg_res = {}
-        for r_inst in r_added:
-            coll, res = self._us.get_part(part, r_inst)
+        gets = [gevent.spawn(self._us.get_part, part, r_inst, batch_cb) \
+                for r_inst in r_added]
+        gevent.joinall(gets)
+        for get in gets:
+            coll, res = get.get()
             chg_res[coll] = res
             uveq_trace = UVEQTrace()
             uveq_trace.uves = [str((k,str(v))) for k,v in res.items()]
@@ -1229,6 +1408,8 @@ class Controller(object):
             uveq_trace.trace_msg(name="UVEQTrace",\
                     sandesh=self._sandesh)
             del self._uveq[part]
+            del self._uveq_ts[part]
+            self._uveq_parts_event.set()
 
     def clear_agg_uve(self, redish, inst, part, acq_time=None):
         if acq_time:
@@ -1239,18 +1420,34 @@ class Controller(object):
         ppe2 = redish.pipeline()
         ppe2.hdel("AGPARTS:%s" % inst, part)
         ppe2.smembers("AGPARTKEYS:%s:%d" % (inst, part))
+        ppe2.get("AGPARTSNAP:%s:%d" % (inst, part))
         pperes2 = ppe2.execute()
         ppe3 = redish.pipeline()
         # Remove all contents for this AG-Partition
-        for elem in pperes2[-1]:
-            ppe3.delete("AGPARTVALUES:%s:%d:%s" % (inst, part, elem))
+        for elem in pperes2[1]:
+            ppe3.delete("AGPARTVALUES:%s:%d:%s" % \
+                (inst, part, convert_to_string(elem)))
         ppe3.delete("AGPARTKEYS:%s:%d" % (inst, part))
+        ppe3.delete("AGPARTSEQ:%s:%d" % (inst, part))
+        ppe3.delete("AGPARTSNAP:%s:%d" % (inst, part))
+        if pperes2[2] is not None:
+            head = json.loads(pperes2[2])
+            for elem in self.agg_snapshot_chunks(inst, part,
+                    [[head["gen"], head["chunks"]]] + head["prev"]):
+                ppe3.delete(elem)
+        ppe3.delete("AGPARTDIRTY:%s:%d" % (inst, part))
         if acq_time:
             ppe3.hset("AGPARTS:%s" % inst, part, acq_time)
         pperes3 = ppe3.execute()
         self.partition_log('Agg %s clear/reset partition %d done' % \
             (inst, part))
 
+    def agg_uve_script(self, redish):
+        if self._agg_script is None or \
+                self._agg_script.registered_client is not redish:
+            self._agg_script = redish.register_script(_AGG_UVE_SCRIPT)
+        return self._agg_script
+
     def send_agg_uve(self, redish, inst, part, acq_time, rows):
         """
         This function writes aggregated UVEs to redis
@@ -1259,72 +1456,328 @@ class Controller(object):
         If type is "None", it means that the UVE is being removed
         If value is none, it mean that struct of the UVE is being removed
 
-        The key and typename information is also published on a redis channel
+        The key and typename information is also published on a redis channel.
+        Struct values that are not larger than redis_agg_inline_size are
+        published too, so that subscribers need not read them back.
+
+        Every write is given the next sequence number of the partition,
+        kept in AGPARTSEQ, and the published elements carry it, so that
+        subscribers can tell when they have missed a message.
+
+        If snapshots are enabled, the keys written are also added to
+        AGPARTDIRTY, the set of keys that changed since the last snapshot.
+
+        The whole write, including the check of the partition acquisition
+        time, is done atomically by one call of _AGG_UVE_SCRIPT. If the
+        partition has stale contents, they are cleared by clear_agg_uve
+        and the write is done again.
         """
         if not redish:
             self._logger.error("No redis handle")
             raise SystemExit(1)
-        old_acq_time = redish.hget("AGPARTS:%s" % inst, part)
-        if old_acq_time is None:
-            self._logger.info("Agg %s part %d new" % (inst, part))
-            redish.hset("AGPARTS:%s" % inst, part, acq_time)
-        else:
-            # Is there stale information for this partition?
-            if int(old_acq_time) != acq_time:
-                self._logger.info("Agg %s stale info part %d, acqs %d,%d" % \
-                        (inst, part, int(old_acq_time), acq_time))
-                self.clear_agg_uve(redish, inst, part, acq_time)
-
-        pub_list = []
-        ppe = redish.pipeline()
-        check_keys = set()
+        prevt = UTCTimestampUsec()
+        inline_size = self._conf.redis_agg_inline_size()
+        snap_enabled = bool(self._conf.redis_agg_snapshot_interval())
+        keys = ["AGPARTS:%s" % inst, "AGPARTKEYS:%s:%d" % (inst, part),
+                "AGPARTSEQ:%s:%d" % (inst, part),
+                "AGPARTDIRTY:%s:%d" % (inst, part)]
+        args = [part, acq_time, int(snap_enabled),
+                "AGPARTPUB:%s:%d" % (inst, part)]
         for row in rows:
             vjson = json.dumps(row.val)
             typ = row.typ
             key = row.key
-            pub_list.append({"key":key,"type":typ})
             if typ is None:
                 self._logger.debug("Agg remove part %d, key %s" % (part,key))
                 # The entire contents of the UVE should be removed
-                ppe.srem("AGPARTKEYS:%s:%d" % (inst, part), key)
-                ppe.delete("AGPARTVALUES:%s:%d:%s" % (inst, part, key))
+                op = 'D'
+                typ = ''
+            elif row.val is None:
+                self._logger.debug("Agg remove part %d, key %s, type %s" % (part,key,typ))
+                # Remove the given struct from the UVE
+                op = 'R'
             else:
-                if row.val is None:
-                    self._logger.debug("Agg remove part %d, key %s, type %s" % (part,key,typ))
-                    # Remove the given struct from the UVE
-                    ppe.hdel("AGPARTVALUES:%s:%d:%s" % (inst, part, key), typ)
-                    check_keys.add(key)
+                self._logger.debug("Agg update part %d, key %s, type %s" % (part,key,typ))
+                op = 'U'
+            # Values are added to the message as already encoded
+            pub_head = json.dumps({"key":key,"type":row.typ})[:-1]
+            inline = row.typ is not None and len(vjson) <= inline_size
+            keys.append("AGPARTVALUES:%s:%d:%s" % (inst, part, key))
+            args.extend([op, key, typ, vjson, pub_head, int(inline)])
+        script = self.agg_uve_script(redish)
+        seq, reset, empty_keys, old_acq_time = script(keys=keys, args=args)
+        if reset == 2:
+            # There was stale information for this partition. It is
+            # cleared with pipelines rather than in the script, so that
+            # redis is not blocked while all its keys are deleted
+            self._logger.info("Agg %s stale info part %d, acqs %d,%d" % \
+                    (inst, part, int(old_acq_time), acq_time))
+            self.clear_agg_uve(redish, inst, part, acq_time)
+            seq, reset, empty_keys, old_acq_time = \
+                script(keys=keys, args=args)
+        self.stage_hist['send_agg_uve'].record(UTCTimestampUsec() - prevt)
+
+        if reset == 1:
+            self._logger.info("Agg %s part %d new" % (inst, part))
+
+        # The index had keys for which there are now no contents
+        for key in empty_keys:
+            self._logger.error("Agg unexpected key %s from inst:part %s:%d" % \
+                    (convert_to_string(key), inst, part))
+        if empty_keys:
+            self._logger.error("Agg unexpected rows %s" % str(rows))
+        return seq
+
+    def partition_checkpoint_file(self, part):
+        return os.path.join(self._conf.checkpoint_dir(),
+            "alarmgen-%s-part-%d.ckpt" % (self._instance_id, part))
+
+    def alarm_config_digests(self):
+        """
+        Returns the digest of every configured alarm, as
+        <uve-type or uve-key> : { <alarm> : <digest> }
+        """
+        return dict((key, dict((nm, alarm_config_digest(alarm_obj)) \
+            for nm, alarm_obj in key_alarms.items())) \
+            for key, key_alarms in \
+                self._config_handler.alarm_config_db().items())
+
+    def write_partition_checkpoint(self, part):
+        """
+        This function writes the UVE keys, struct fingerprints and alarm
+        states of a partition to a local file, with a sequence number and
+        the digests of the alarm config that the alarm states were
+        evaluated with.
+        The file is written and synced under a temporary name and then
+        renamed, so that a restarting instance never reads a partial
+        checkpoint.
+        """
+        uves = {}
+        alarms = {}
+        for tab, tuves in self.ptab_info.get(part, {}).items():
+            tab_alarms = self.tab_alarms.get(tab, {})
+            uves[tab] = {}
+            for uve_name, kinfo in tuves.items():
+                uves[tab][uve_name] = kinfo.fingerprints()
+                uv = tab + ":" + uve_name
+                if tab_alarms.get(uv):
+                    alarms.setdefault(tab, {})[uv] = dict((nm, asm.get_state()) \
+                        for nm, asm in tab_alarms[uv].items())
+        self._ckpt_seq += 1
+        fname = self.partition_checkpoint_file(part)
+        try:
+            data = zlib.compress(json.dumps({
+                "version": 2, "part": part, "seq": self._ckpt_seq,
+                "time": time.time(),
+                "alarm_config": self.alarm_config_digests(),
+                "uves": uves, "alarms": alarms}).encode())
+            with open(fname + ".tmp", "wb") as ckpt:
+                ckpt.write(data)
+                ckpt.flush()
+                os.fsync(ckpt.fileno())
+            os.rename(fname + ".tmp", fname)
+        except (IOError, OSError, TypeError, ValueError) as ex:
+            self._logger.error("Checkpoint of part %d failed: %s" % \
+                    (part, str(ex)))
+            return
+        self._logger.info("Checkpoint %d of part %d, %d bytes" % \
+                (self._ckpt_seq, part, len(data)))
+
+    def write_partition_checkpoints(self, parts):
+        """
+        This function writes the checkpoints of the given partitions,
+        one partition at a time
+        """
+        for part in parts:
+            if part in self._workers:
+                self.write_partition_checkpoint(part)
+            gevent.sleep(0)
+
+    def restore_partition_checkpoint(self, part):
+        """
+        This function restores the UVE keys, struct fingerprints and
+        alarm states of a partition from its checkpoint, if there is one
+        and it is not older than checkpoint_max_age.
+        The restored UVEs are queued to be read again when the partition's
+        UVE queue is created. Alarms are evaluated only for the structs
+        that changed since the checkpoint, and the others keep their
+        restored state and timers. The UVEs for which the alarm config
+        changed since the checkpoint are evaluated for all the alarms,
+        and the alarm states of the changed alarms are not restored.
+        """
+        if not self._conf.checkpoint_dir():
+            return False
+        fname = self.partition_checkpoint_file(part)
+        if not os.path.exists(fname):
+            return False
+        try:
+            with open(fname, "rb") as ckpt:
+                state = json.loads(zlib.decompress(ckpt.read()).decode())
+        except Exception as ex:
+            self._logger.error("Cannot read checkpoint of part %d: %s" % \
+                    (part, str(ex)))
+            return False
+        if state.get("version") != 2 or state.get("part") != part:
+            self._logger.error("Invalid checkpoint for part %d" % part)
+            return False
+        age = time.time() - state["time"]
+        max_age = self._conf.checkpoint_max_age()
+        if max_age and age > max_age:
+            self.partition_log("Checkpoint %d of part %d is %d sec old, "
+                "not restored" % (state["seq"], part, age))
+            return False
+        self._ckpt_seq = max(self._ckpt_seq, state["seq"])
+        ckpt_digests = state["alarm_config"]
+        curr_digests = self.alarm_config_digests()
+        def alarm_digest(digests, tab, uv, nm):
+            # An alarm of the uve-key overrides that of the uve-type
+            return digests.get(uv, {}).get(nm) or \
+                digests.get(tab, {}).get(nm)
+        stale = set()
+        for tab, tab_alarms in state["alarms"].items():
+            self.tab_alarms.setdefault(tab, {})
+            for uv, uv_alarms in tab_alarms.items():
+                self.tab_alarms[tab][uv] = {}
+                for nm, asm_state in uv_alarms.items():
+                    digest = alarm_digest(curr_digests, tab, uv, nm)
+                    if digest is None or \
+                            digest != alarm_digest(ckpt_digests, tab, uv, nm):
+                        stale.add(uv)
+                        continue
+                    asm = AlarmStateMachine(tab=tab, uv=uv, nm=nm,
+                        sandesh=self._sandesh, activeTimer=0, idleTimer=0,
+                        freqCheck_Times=0, freqCheck_Seconds=0,
+                        freqExceededCheck=False)
+                    asm.set_state(asm_state)
+                    self.tab_alarms[tab][uv][nm] = asm
+                if self.tab_alarms[tab][uv]:
+                    self.send_alarm_update(tab, uv)
                 else:
-                    self._logger.debug("Agg update part %d, key %s, type %s" % (part,key,typ))
-                    ppe.sadd("AGPARTKEYS:%s:%d" % (inst, part), key)
-                    ppe.hset("AGPARTVALUES:%s:%d:%s" % (inst, part, key),
-                        typ, vjson)
-        ppe.execute()
+                    del self.tab_alarms[tab][uv]
+        self.ptab_info[part] = {}
+        uves = {}
+        for tab, tuves in state["uves"].items():
+            self.ptab_info[part][tab] = {}
+            tab_same = ckpt_digests.get(tab) == curr_digests.get(tab)
+            for uve_name, fprints in tuves.items():
+                uv = tab + ":" + uve_name
+                kinfo = AGKeyInfo(part)
+                # Alarms were added, removed or changed for this UVE,
+                # so all of them are evaluated when it is read
+                if tab_same and uv not in stale and \
+                        ckpt_digests.get(uv) == curr_digests.get(uv):
+                    kinfo.restore(fprints)
+                self.ptab_info[part][tab][uve_name] = kinfo
+                uves[uv] = None
+        # The UVE queue of the partition is created by the worker; the
+        # restored UVEs are queued then, so that the partition is not
+        # taken as started before its worker is
+        self._ckpt_uves[part] = uves
+        self.partition_log("Restored part %d from checkpoint %d, "
+            "%d UVEs, %d with changed alarm config" % (part, state["seq"],
+            len(uves), len(stale)))
+        return True
+
+    def agg_snapshot_chunks(self, inst, part, gens):
+        """
+        This function returns the keys of the chunks of the aggregated
+        UVE partition snapshots given as [gen, number of chunks] pairs
+        """
+        chunks = []
+        for gen, count in gens:
+            chunks += ["AGPARTSNAP:%s:%d:%d:%d" % (inst, part, gen, idx) \
+                for idx in range(count)]
+        return chunks
 
-        # Find the keys that have no content (all structs have been deleted)
-        ppe4 = redish.pipeline()
-        check_keys_list = list(check_keys)
-        for kk in check_keys_list:
-           ppe4.exists("AGPARTVALUES:%s:%d:%s" % (inst, part, kk))
-        pperes4 = ppe4.execute()
+    def send_agg_snapshot(self, redish, inst, part, acq_time):
+        """
+        This function writes the contents of an aggregated UVE partition
+        to redis as compressed chunks of _AGG_SNAP_BATCH UVEs, so that
+        subscribers can load the partition one chunk at a time instead
+        of with one read per UVE.
+
+        The chunks are AGPARTSNAP:<inst>:<part>:<gen>:<n>, and the header
+        AGPARTSNAP:<inst>:<part> names them. The header also has the
+        AGPARTSEQ of the partition when the build started; subscribers
+        replay the updates published after it from the partition's feed.
+        The contents are read back from redis in batches, yielding in
+        between, so that UVE processing goes on while the snapshot is
+        built. The chunks of a snapshot are kept until the snapshot after
+        it is written, so that subscribers have a snapshot interval to
+        read them.
+        """
+        snap_key = "AGPARTSNAP:%s:%d" % (inst, part)
+        ppe = redish.pipeline()
+        ppe.get("AGPARTSEQ:%s:%d" % (inst, part))
+        ppe.delete("AGPARTDIRTY:%s:%d" % (inst, part))
+        ppe.get(snap_key)
+        seq, _, prev = ppe.execute()
+        seq = int(seq) if seq is not None else 0
+        prev = json.loads(prev) if prev is not None else None
+        gen = int(time.time() * 1000)
+        if prev is not None and gen <= prev["gen"]:
+            gen = prev["gen"] + 1
+        chunks = 0
+        nkeys = 0
+        nbytes = 0
+        for keys in redish.sscan_batches("AGPARTKEYS:%s:%d" % (inst, part),
+                                         _AGG_SNAP_BATCH):
+            keys = [convert_to_string(key) for key in keys]
+            for idx in range(0, len(keys), _AGG_SNAP_BATCH):
+                ckeys = keys[idx:idx + _AGG_SNAP_BATCH]
+                ppe = redish.pipeline(transaction=False)
+                for key in ckeys:
+                    ppe.hgetall("AGPARTVALUES:%s:%d:%s" % (inst, part, key))
+                uves = {}
+                for key, vals in zip(ckeys, ppe.execute()):
+                    if vals:
+                        uves[key] = dict((convert_to_string(typ),
+                            convert_to_string(val)) \
+                            for typ, val in vals.items())
+                if not uves:
+                    continue
+                blob = zlib.compress(json.dumps(uves).encode())
+                redish.set("%s:%d:%d" % (snap_key, gen, chunks), blob)
+                chunks += 1
+                nkeys += len(uves)
+                nbytes += len(blob)
+                gevent.sleep(0)
+        head = {"acq_time": acq_time, "seq": seq, "gen": gen,
+                "chunks": chunks, "prev": []}
+        # The partition was released or reset while the snapshot was built
+        if part not in self._workers or \
+                self._workers[part].acq_time() != acq_time:
+            self._logger.info("Agg %s snapshot part %d, acq %d dropped" % \
+                    (inst, part, acq_time))
+            if chunks:
+                redish.delete(*self.agg_snapshot_chunks(inst, part,
+                                                        [[gen, chunks]]))
+            return
+        ppe = redish.pipeline()
+        if prev is not None:
+            head["prev"] = [[prev["gen"], prev["chunks"]]]
+            for elem in self.agg_snapshot_chunks(inst, part, prev["prev"]):
+                ppe.delete(elem)
+        ppe.set(snap_key, json.dumps(head))
+        ppe.execute()
+        self._logger.info("Agg %s snapshot part %d, seq %d, %d keys, "
+                "%d chunks, %d bytes" % (inst, part, seq, nkeys, chunks,
+                nbytes))
 
-        retry = False
-        # From the index, removes keys for which there are now no contents
-        ppe5 = redish.pipeline()
-        idx = 0
-        for res in pperes4:
-            if not res:
-                self._logger.error("Agg unexpected key %s from inst:part %s:%d" % \
-                        (check_keys_list[idx], inst, part))
-                ppe5.srem("AGPARTKEYS:%s:%d" % (inst, part), check_keys_list[idx])
-                retry = True
-            idx += 1
-        ppe5.execute()
-
-        redish.publish('AGPARTPUB:%s:%d' % (inst, part), json.dumps(pub_list))
-
-        if retry:
-            self._logger.error("Agg unexpected rows %s" % str(rows))
+    def send_agg_snapshots(self, redish, parts):
+        """
+        This function writes the snapshots of the given (part, acq_time)
+        aggregated UVE partitions, one partition at a time
+        """
+        for part, acq_time in parts:
+            try:
+                self.send_agg_snapshot(redish, self._instance_id, part,
+                                       acq_time)
+            except Exception as ex:
+                template = "Exception {0} in agg snapshot. Arguments:\n{1!r}"
+                messag = template.format(type(ex).__name__, ex.args)
+                self._logger.error("%s : part %d" % (messag, part))
+            gevent.sleep(0)
 
     def send_alarm_update(self, tab, uk):
         ustruct = None
@@ -1335,7 +1788,9 @@ class Controller(object):
             for nm, asm in self.tab_alarms[tab][uk].items():
                 uai = asm.get_uai()
                 if uai:
-                    alm_copy.append(copy.deepcopy(uai))
+                    # Only the fields of the UVEAlarmInfo are changed
+                    # later (e.g. ack), not the objects they refer to
+                    alm_copy.append(copy.copy(uai))
         if len(alm_copy) == 0:
             ustruct = UVEAlarms(name = str(uk).split(':',1)[1], deleted = True)
             self._logger.info('deleting alarm: %s' % (uk))
@@ -1465,6 +1920,8 @@ class Controller(object):
                     self._logger.info("Stopping part %d uveQ : %s" % \
                             (part,str(self._uveq[part].keys())))
                     del self._uveq[part]
+                    del self._uveq_ts[part]
+                    self._uveq_parts_event.set()
             prev = time.time()
             try:
                 # Get the collector list from zookeeper, it is assumed that redis is
@@ -1501,7 +1958,14 @@ class Controller(object):
                         self.reconnect_agg_uve(lredis)
                 gevs = {}
                 pendingset = {}
+                pending_ts = {}
+                # Processing time of the batch of each partition, and
+                # the time at which it was written out
+                part_timing = {}
                 kafka_topic_down = False
+                batch_size = self.uve_batch_size(
+                    sum(1 for uveq in self._uveq.values() if uveq))
+                batch_start = time.time()
                 for part in self._uveq.keys():
                     if not len(self._uveq[part]):
                         continue
@@ -1512,18 +1976,28 @@ class Controller(object):
 
                     # Allow the partition handlers to queue new UVEs without
                     # interfering with the work of processing the current UVEs
-                    # Process no more than 200 keys at a time
-                    pendingset[part] = {}
+                    # Process no more than batch_size keys at a time,
+                    # oldest first
+                    pendingset[part] = OrderedDict()
+                    pending_ts[part] = {}
+                    uveq_ts = self._uveq_ts[part]
+                    uveq_wait = self.stage_hist['uveq_wait']
+                    deq_time = time.time()
                     icount = 0
-                    while (len(self._uveq[part]) > 0) and icount < 200:
-                        kp,vp = self._uveq[part].popitem()
+                    while (len(self._uveq[part]) > 0) and \
+                            icount < batch_size:
+                        kp,vp = self._uveq[part].popitem(last=False)
                         pendingset[part][kp] = vp
+                        enq_time = uveq_ts.pop(kp)
+                        pending_ts[part][kp] = enq_time
+                        uveq_wait.record(int((deq_time - enq_time) * 1000000))
                         icount += 1
-                    self._logger.info("UVE Process for %d : %d, %d remain" % \
-                            (part, len(pendingset[part]), len(self._uveq[part])))
+                    self._logger.info("UVE Process for %d : %d, %d remain, "
+                            "oldest %.3f sec" % (part, len(pendingset[part]),
+                            len(self._uveq[part]), self.uveq_oldest_age(part)))
 
-                    gevs[part] = gevent.spawn(self.handle_uve_notif, part,\
-                        pendingset[part])
+                    gevs[part] = gevent.spawn(self.run_timed, part_timing,
+                        part, self.handle_uve_notif, part, pendingset[part])
                 server_list = []
                 if kafka_topic_down:
                     server_list.append(self._workers[kafka_part_failed]._brokers)
@@ -1559,7 +2033,8 @@ class Controller(object):
                             outp[part] = None
                         if outp[part] is None:
                             self._logger.error("UVE Process failed for %d" % part)
-                            self.handle_uve_notifq(part, pendingset[part])
+                            self.requeue_uve_notifq(part, pendingset[part],
+                                                    pending_ts[part])
                         elif not part in self._workers:
                             outp[part] = None
                             self._logger.error(
@@ -1567,7 +2042,8 @@ class Controller(object):
                         else:
                             self._logger.info("UVE Agg on %d items in part %d" % \
                                     (len(outp), part))
-                            gevs_out[part] = gevent.spawn(self.run_uve_agg, lredis,\
+                            gevs_out[part] = gevent.spawn(self.run_timed,
+                                    part_timing, part, self.run_uve_agg, lredis,
                                     outp[part], part, self._workers[part].acq_time())
 
                     if len(gevs_out):
@@ -1577,6 +2053,39 @@ class Controller(object):
                         for part in gevs_out.keys():
                             gevs_out[part].get()
 
+                    self.update_uve_key_time(time.time() - batch_start,
+                        sum(len(pendingset[part]) for part in gevs_out))
+                    for part in gevs_out.keys():
+                        part_time, part_end = part_timing[part]
+                        self.record_part_batch(part, len(pendingset[part]),
+                            int(part_time * 1000000),
+                            int((part_end - min(pending_ts[part].values()))
+                                * 1000))
+
+                # The checkpoints and snapshots are written by greenlets
+                # of their own, so that UVE processing does not wait for them
+                ckpt_interval = self._conf.checkpoint_interval()
+                if self._conf.checkpoint_dir() and ckpt_interval and \
+                        time.time() - self._ckpt_time >= ckpt_interval \
+                        and (self._ckpt_task is None or \
+                             self._ckpt_task.ready()):
+                    self._ckpt_time = time.time()
+                    self._ckpt_task = gevent.spawn(
+                        self.write_partition_checkpoints,
+                        sorted(self._workers.keys()))
+
+                snap_interval = self._conf.redis_agg_snapshot_interval()
+                if lredis is not None and snap_interval and \
+                        time.time() - self._agg_snap_time >= snap_interval \
+                        and (self._agg_snap_task is None or \
+                             self._agg_snap_task.ready()):
+                    self._agg_snap_time = time.time()
+                    parts = [(part, self._workers[part].acq_time()) \
+                        for part in sorted(self._workers.keys()) \
+                        if self._workers[part]._up]
+                    self._agg_snap_task = gevent.spawn(
+                        self.send_agg_snapshots, lredis, parts)
+
                 # If there are alarm config changes, then start a gevent per
                 # partition to process the alarm config changes
                 if self._alarm_config_change_map:
@@ -1644,14 +2153,24 @@ class Controller(object):
                 self._logger.error("%s : traceback %s" % \
                                   (messag, traceback.format_exc()))
                 raise SystemExit(1)
-            if (curr - prev) < 1:
-                gevent.sleep(1 - (curr - prev))
+            self._uveq_event.clear()
+            if any(self._uveq.values()):
+                self._logger.info("UVE Process saturated")
+                gevent.sleep(0)
+            elif (curr - prev) < 1:
+                # Run again as soon as UVEs are queued, or in time for
+                # the alarm timers
+                self._uveq_event.wait(1 - (curr - prev))
                 self._logger.info("UVE Done")
             else:
-                self._logger.info("UVE Process saturated")
                 gevent.sleep(0)
 
-    def examine_uve_for_alarms(self, part, uve_key, uve):
+    def examine_uve_for_alarms(self, part, uve_key, uve, changed_types=None):
+        """
+        Evaluate the alarms of the UVE. If changed_types is given, only
+        the alarms that read one of these UVE struct types are evaluated,
+        and the others keep their state.
+        """
         table = uve_key.split(':', 1)[0]
         if table in _INVERSE_UVE_MAP:
             table_str = _INVERSE_UVE_MAP[table]
@@ -1659,23 +2178,37 @@ class Controller(object):
             table_str = table
         alarm_cfg = self._config_handler.alarm_config_db()
         prevt = UTCTimestampUsec()
-        aproc = AlarmProcessor(self._sandesh)
+        try:
+            aproc = self._alarm_procs[part]
+        except KeyError:
+            aproc = AlarmProcessor(self._sandesh)
+            self._alarm_procs[part] = aproc
+        aproc.reset()
         # Process all alarms configured for this uve-type
-        for alarm_fqname, alarm_obj in \
-            alarm_cfg.get(table, {}).items():
-            aproc.process_alarms(alarm_fqname, alarm_obj, uve_key, uve)
+        for alarm_fqname, alarm_obj in self.get_table_alarms(table):
+            aproc.process_alarms(alarm_fqname, alarm_obj, uve_key, uve,
+                                 changed_types)
         # Process all alarms configured for this uve-key
-        for alarm_fqname, alarm_obj in \
-            alarm_cfg.get(uve_key, {}).items():
-            aproc.process_alarms(alarm_fqname, alarm_obj, uve_key, uve)
+        key_alarms = alarm_cfg.get(uve_key)
+        if key_alarms:
+            for alarm_fqname, alarm_obj in key_alarms.items():
+                aproc.process_alarms(alarm_fqname, alarm_obj, uve_key, uve,
+                                     changed_types)
         new_uve_alarms = aproc.uve_alarms
-        self.tab_perf[table].record_call(UTCTimestampUsec() - prevt)
+        skipped = aproc.skipped
+        call_time = UTCTimestampUsec() - prevt
+        self.tab_perf[table].record_call(call_time)
+        self.stage_hist['alarm_eval'].record(call_time)
+        self.tab_perf[table].record_skip(len(skipped))
 
         del_types = []
         if table not in self.tab_alarms:
             self.tab_alarms[table] = {}
         if uve_key in self.tab_alarms[table]:
             for nm, asm in self.tab_alarms[table][uve_key].items():
+                # This type was not evaluated, as its inputs did not change
+                if nm in skipped:
+                    continue
                 # This type was present earlier, but is now gone
                 if nm not in new_uve_alarms:
                     del_types.append(nm)
@@ -1690,22 +2223,24 @@ class Controller(object):
             self._logger.debug("Alarm[%s] Updated %s" % \
                     (table, str(new_uve_alarms)))
             # These alarm types are new or updated
-            for nm, uai2 in new_uve_alarms.items():
-                uai = copy.deepcopy(uai2)
+            for nm, uai in new_uve_alarms.items():
+                # The AlarmProcessor makes a new UVEAlarmInfo for every
+                # evaluation, so it need not be copied
                 uai.timestamp = UTCTimestampUsec()
                 uai.token = Controller.token(self._sandesh, uai.timestamp)
                 if uve_key not in self.tab_alarms[table]:
                     self.tab_alarms[table][uve_key] = {}
                 if not nm in self.tab_alarms[table][uve_key]:
+                    # An alarm of the uve-key overrides that of the uve-type
+                    alarm_obj = alarm_cfg.get(uve_key, {}).get(nm) or \
+                        alarm_cfg[table][nm]
                     self.tab_alarms[table][uve_key][nm] = AlarmStateMachine(
                         tab=table, uv=uve_key, nm=nm, sandesh=self._sandesh,
-                        activeTimer=aproc.ActiveTimer[uve_key][nm],
-                        idleTimer=aproc.IdleTimer[uve_key][nm],
-                        freqCheck_Times=aproc.FreqCheck_Times[uve_key][nm],
-                        freqCheck_Seconds= \
-                            aproc.FreqCheck_Seconds[uve_key][nm],
-                        freqExceededCheck= \
-                            aproc.FreqExceededCheck[uve_key][nm])
+                        activeTimer=alarm_obj.ActiveTimer(),
+                        idleTimer=alarm_obj.IdleTimer(),
+                        freqCheck_Times=alarm_obj.FreqCheck_Times(),
+                        freqCheck_Seconds=alarm_obj.FreqCheck_Seconds(),
+                        freqExceededCheck=alarm_obj.FreqExceededCheck())
                 asm = self.tab_alarms[table][uve_key][nm]
                 asm.set_uai(uai)
                 # go through alarm set state machine code
@@ -1740,6 +2275,20 @@ class Controller(object):
             self.send_alarm_update(table, uve_key)
     # end examine_uve_for_alarms
 
+    def get_table_alarms(self, table):
+        """
+        Returns the (name, alarm) list of the alarms configured for the
+        uve-type. The list is kept until the alarm config changes.
+        """
+        try:
+            return self._alarm_index[table]
+        except KeyError:
+            talarms = list(self._config_handler.alarm_config_db().get(
+                table, {}).items())
+            self._alarm_index[table] = talarms
+            return talarms
+    # end get_table_alarms
+
     def alarm_config_change_worker(self, partition, alarm_config_change_map):
         self._logger.debug('Alarm config change worker for partition %d'
             % (partition))
@@ -1771,6 +2320,7 @@ class Controller(object):
     # end alarm_config_change_worker
 
     def alarm_config_change_callback(self, alarm_config_change_map):
+        self._alarm_index = {}
         for table, alarm_map in alarm_config_change_map.items():
             try:
                 tamap = self._alarm_config_change_map[table]
@@ -1781,6 +2331,7 @@ class Controller(object):
     # end alarm_config_change_callback
 
     def stop_uve_partition(self, part):
+        self._alarm_procs.pop(part, None)
         if not part in self.ptab_info:
             return
         for tk in list(self.ptab_info[part].keys()):
@@ -1862,6 +2413,23 @@ class Controller(object):
         uveq_trace.trace_msg(name="UVEQTrace",\
                 sandesh=self._sandesh)
 
+        # Read all the UVEs together, with one round trip per collector
+        # redis, rather than one UVE at a time
+        keys = {}
+        for uv,types in uves.items():
+            filters = {}
+            if types:
+                filters["cfilt"] = {}
+                for typ in types.keys():
+                    filters["cfilt"][typ] = set()
+            keys[uv] = filters
+        prevt = UTCTimestampUsec()
+        uve_fprints = {}
+        uve_reads = self._us.get_uves(keys, True, fprints=uve_fprints)
+        read_time = UTCTimestampUsec() - prevt
+        self.stage_hist['get_uve'].record(read_time)
+        get_time = read_time // max(len(keys), 1)
+
         erruves = []
         for uv,types in uves.items():
             tab = uv.split(':',1)[0]
@@ -1870,18 +2438,11 @@ class Controller(object):
 
 
             uve_name = uv.split(':',1)[1]
-            prevt = UTCTimestampUsec()
-            filters = {}
-            if types:
-                filters["cfilt"] = {}
-                for typ in types.keys():
-                    filters["cfilt"][typ] = set()
-
-            failures, uve_data = self._us.get_uve(uv, True, filters)
+            failures, uve_data = uve_reads[uv]
             if failures:
                 erruves.append(uv)
                 success = False
-            self.tab_perf[tab].record_get(UTCTimestampUsec() - prevt)
+            self.tab_perf[tab].record_get(get_time)
             # Handling Agg UVEs
             if not part in self.ptab_info:
                 self._logger.info("Creating UVE table for part %s" % str(part))
@@ -1895,8 +2456,14 @@ class Controller(object):
             prevt = UTCTimestampUsec()
             output[uv] = {}
             touched = False
+            fprints = uve_fprints.get(uv, {})
+            alarm_types = None
             if not types:
-                self.ptab_info[part][tab][uve_name].update(uve_data)
+                self.ptab_info[part][tab][uve_name].update(uve_data, fprints)
+                # All the structs of a UVE restored from a checkpoint are
+                # output, but only those that changed since the checkpoint
+                # are evaluated for alarms
+                alarm_types = self.ptab_info[part][tab][uve_name].reconcile()
                 if len(self.ptab_info[part][tab][uve_name].removed()):
                     touched = True
                     rset = self.ptab_info[part][tab][uve_name].removed()
@@ -1931,7 +2498,8 @@ class Controller(object):
                     val = None
                     if typ in uve_data:
                         val = uve_data[typ]
-                    self.ptab_info[part][tab][uve_name].update_single(typ, val)
+                    self.ptab_info[part][tab][uve_name].update_single(typ, val,
+                        fprints.get(typ) if val is not None else None)
                     if len(self.ptab_info[part][tab][uve_name].removed()):
                         touched = True
                         rset = self.ptab_info[part][tab][uve_name].removed()
@@ -2002,8 +2570,11 @@ class Controller(object):
                             del self.tab_alarms[tab][uv][nm]
                         self.send_alarm_update(tab, uv)
                 continue
-            # Examine UVE to check if alarm need to be raised/deleted
-            self.examine_uve_for_alarms(part, uv, local_uve)
+            # Examine UVE to check if alarm need to be raised/deleted.
+            # Only the alarms that read the changed structs are evaluated
+            if alarm_types is None:
+                alarm_types = set(output.get(uv, {}).keys())
+            self.examine_uve_for_alarms(part, uv, local_uve, alarm_types)
         if success:
             uveq_trace = UVEQTrace()
             uveq_trace.uves = []
@@ -2106,6 +2677,7 @@ class Controller(object):
             resp.get_time = self.tab_perf_prev[pt].get_result()
             resp.pub_time = self.tab_perf_prev[pt].pub_result()
             resp.updates = self.tab_perf_prev[pt].get_n
+            resp.skipped_alarms = self.tab_perf_prev[pt].skip_n
 
             if np == len(parts):
                 mr = False
@@ -2114,6 +2686,22 @@ class Controller(object):
             resp.response(req.context(), mr)
             np = np + 1
 
+    def handle_PartitionStatsReq(self, req):
+        if req.partition == -1:
+            parts = sorted(self._workers.keys())
+        else:
+            parts = [req.partition]
+        self._logger.info("Got PartitionStatsReq: %s" % str(parts))
+        resp = PartitionStatsResp()
+        resp.partitions = [self.partition_stats(pt) for pt in parts]
+        resp.response(req.context())
+
+    def handle_StageLatencyReq(self, req):
+        resp = StageLatencyResp()
+        resp.interval = self.stage_latency(self.stage_hist_prev)
+        resp.total = self.stage_latency(self.stage_hist_total)
+        resp.response(req.context())
+
     def handle_AlarmConfigRequest(self, req):
         config_db = self._config_handler.config_db()
         alarm_config_db = config_db.get('alarm', {})
@@ -2129,6 +2717,25 @@ class Controller(object):
         res.response(req.context())
     # end handle_AlarmConfigRequest
 
+    def wait_uveq_parts(self, parts, present, timeout):
+        """
+        Wait for the UVE queues of the given partitions to be created
+        (present is True) or deleted (present is False)
+        Returns the partitions that are still not in the wanted state
+        """
+        def pending():
+            if present:
+                return parts - set(self._uveq.keys())
+            return parts.intersection(set(self._uveq.keys()))
+        end_time = time.time() + timeout
+        while pending():
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            self._uveq_parts_event.clear()
+            self._uveq_parts_event.wait(remaining)
+        return pending()
+
     def partition_change(self, parts, enl):
         """
         Call this function when getting or giving up
@@ -2147,9 +2754,11 @@ class Controller(object):
                 self.partition_log("Dup partitions %s" % \
                     str(parts.intersection(set(self._workers.keys()))))
             else:
+                acq_start = time.time()
                 lredis = self.get_redis_instance()
                 for partno in parts:
                     self.clear_agg_uve(lredis, self._instance_id, partno)
+                    self.restore_partition_checkpoint(partno)
                     ph = UveStreamProc(','.join(self._conf.kafka_broker_list()),
                             partno, self._conf.kafka_prefix()+"-uve-topic-" + str(partno),
                             self._logger,
@@ -2159,31 +2768,28 @@ class Controller(object):
                             self._conf.redis_server_port(),
                             self._conf.kafka_use_ssl(),
                             self._conf.kafka_ssl_params(),
-                            self._conf.kafka_prefix()+"-workers")
+                            self._conf.kafka_prefix()+"-workers",
+                            backlog_cb=self.uveq_size,
+                            backlog_limit=self._conf.uve_queue_limit())
                     ph.start()
                     self._workers[partno] = ph
                     self._uvestats[partno] = {}
                     self._alarmstats[partno] = {}
 
-                tout = 1200
-                idx = 0
-                while idx < tout:
-                    # When this partitions starts,
-                    # uveq will get created
-                    if len(parts - set(self._uveq.keys())) != 0:
-                        gevent.sleep(.1)
-                    else:
-                        break
-                    idx += 1
-                if len(parts - set(self._uveq.keys())) == 0:
+                # When this partitions starts, uveq will get created
+                # with the first UVEs read for it
+                not_started = self.wait_uveq_parts(parts, True, 120)
+                if not not_started:
                     status = True
+                    self.partition_log("Partitions %s started in %.3f sec" % \
+                            (str(parts), time.time() - acq_start))
                 else:
                     # TODO: The partition has not started yet,
                     #       but it still might start later.
                     #       We possibly need to exit
                     status = False
                     self.partition_log("Unable to start partitions %s" % \
-                            str(parts - set(self._uveq.keys())))
+                            str(not_started))
         else:
             if len(parts - set(self._workers.keys())) == 0:
                 for partno in parts:
@@ -2199,22 +2805,17 @@ class Controller(object):
                     self.partition_log("Partition %d kill returned %s" % \
                         (partno, str(res)))
                     self._uveqf[partno] = self._workers[partno].acq_time()
+                    self._uveq_event.set()
                     del self._workers[partno]
                     del self._uvestats[partno]
                     del self._alarmstats[partno]
+                    self._ckpt_uves.pop(partno, None)
 
-                tout = 1200
-                idx = 0
                 self.partition_log("Wait for partitions %s to exit" % str(parts))
-                while idx < tout:
-                    # When this partitions stop.s
-                    # uveq will get destroyed
-                    if len(parts - set(self._uveq.keys())) != len(parts):
-                        gevent.sleep(.1)
-                    else:
-                        break
-                    idx += 1
-                if len(parts - set(self._uveq.keys())) == len(parts):
+                # When this partitions stop.s
+                # uveq will get destroyed
+                not_stopped = self.wait_uveq_parts(parts, False, 120)
+                if not not_stopped:
                     status = True
                     self.partition_log("Wait done for partitions %s to exit" % str(parts))
                 else:
@@ -2223,7 +2824,7 @@ class Controller(object):
                     #       We possibly need to exit
                     status = False
                     self.partition_log("Unable to stop partitions %s" % \
-                            str(parts.intersection(set(self._uveq.keys()))))
+                            str(not_stopped))
             else:
                 self.partition_log("Partitions absent in %s" % str(parts))
 
@@ -2243,10 +2844,17 @@ class Controller(object):
             the previous time period over all partitions
             and send it out
         '''
-        self.tab_perf_prev = copy.deepcopy(self.tab_perf)
-        for kt in self.tab_perf.keys():
-            #self.tab_perf_prev[kt] = copy.deepcopy(self.tab_perf[kt])
-            self.tab_perf[kt].reset()
+        # Swap in new counters rather than copying the old ones
+        self.tab_perf_prev = self.tab_perf
+        self.tab_perf = dict((kt, AGTabStats()) for kt in self.tab_perf_prev)
+        self.part_perf_prev = self.part_perf
+        self.part_perf = {}
+        self.stage_hist_prev = self.stage_hist
+        self.stage_hist = self.new_stage_hists()
+        for pc in self._workers.values():
+            self.stage_hist_prev['kafka_to_uveq'].merge(pc.take_rx_hist())
+        for stage, hist in self.stage_hist_prev.items():
+            self.stage_hist_total[stage].merge(hist)
 
         s_partitions = set()
         s_keys = set()
@@ -2358,6 +2966,9 @@ class Controller(object):
         ags.partitions = len(s_partitions)
         ags.keys = len(s_keys)
         ags.updates = n_updates
+        ags.partition_stats = [self.partition_stats(pk) \
+                for pk in sorted(self._workers.keys())]
+        ags.stage_latency = self.stage_latency(self.stage_hist_prev)
         au.counters.append(ags)
 
         agname = self._sandesh._source + ':' + \
@@ -2387,6 +2998,10 @@ class Controller(object):
             if pt in self._workers:
                 resp.enabled = True
                 resp.offset = self._workers[pt]._partoffset
+                resp.uveq_size = self.uveq_size(pt)
+                resp.uveq_oldest_age = int(self.uveq_oldest_age(pt) * 1000)
+                resp.load_time = int(self._workers[pt]._load_time * 1000)
+                resp.load_uves = self._workers[pt]._load_uves
                 resp.uves = []
                 for kcoll,coll in self._workers[pt].contents().items():
                     uci = UVECollInfo()
@@ -64,6 +64,11 @@ class CfgParser(object):
             'zk_list'           : None,
             'alarmgen_list'     : ['127.0.0.1:0'],
             'cluster_id'        :'',
+            'uve_processing_target_msec' : 1000,
+            'uve_queue_limit'   : 50000,
+            'checkpoint_dir'    : None,
+            'checkpoint_interval' : 60,
+            'checkpoint_max_age' : 600,
         }
         defaults.update(SandeshConfig.get_default_options(['DEFAULTS']))
 
@@ -74,7 +79,9 @@ class CfgParser(object):
             'redis_use_ssl'      : False,
             'redis_keyfile'      : None,
             'redis_certfile'     : None,
-            'redis_ca_cert'      : None
+            'redis_ca_cert'      : None,
+            'redis_agg_inline_size' : 0,
+            'redis_agg_snapshot_interval' : 0
         }
 
         configdb_opts = {
@@ -177,6 +184,12 @@ class CfgParser(object):
             help="Location of redis ssl private key")
         parser.add_argument("--redis_ca_cert", type=str,
             help="Location of redis ssl CA certificate")
+        parser.add_argument("--redis_agg_inline_size", type=int,
+            help="Aggregated UVE structs up to this size (in bytes) are "
+                 "sent in the update notification itself; 0 to disable")
+        parser.add_argument("--redis_agg_snapshot_interval", type=int,
+            help="Interval (in seconds) at which a snapshot of each "
+                 "aggregated UVE partition is written; 0 to disable")
         parser.add_argument("--kafka_broker_list",
             help="List of bootstrap kafka brokers in ip:port format",
             nargs="+")
@@ -215,6 +228,20 @@ class CfgParser(object):
             nargs="+")
         parser.add_argument("--cluster_id",
             help="Analytics Cluster Id")
+        parser.add_argument("--uve_processing_target_msec", type=int,
+            help="Target time (in msec) for processing a batch of UVE "
+                 "changes; batches are sized from the measured time per UVE")
+        parser.add_argument("--uve_queue_limit", type=int,
+            help="Reading of a partition is paused when more UVEs than this "
+                 "wait to be processed for it, and resumed when down to half; "
+                 "0 to disable")
+        parser.add_argument("--checkpoint_dir",
+            help="Directory in which the state of the owned partitions is "
+                 "checkpointed, to be restored when they are acquired again")
+        parser.add_argument("--checkpoint_interval", type=int,
+            help="Interval (in seconds) at which partitions are checkpointed")
+        parser.add_argument("--checkpoint_max_age", type=int,
+            help="Checkpoints older than this (in seconds) are not restored")
         parser.add_argument("--kafka_ssl_enable", action='store_true',
             help="Enable SSL encryption for kafka connection")
         parser.add_argument("--kafka_keyfile", type=str,
@@ -298,6 +325,21 @@ class CfgParser(object):
     def partitions(self):
         return self._args.partitions
 
+    def uve_processing_target_msec(self):
+        return self._args.uve_processing_target_msec
+
+    def uve_queue_limit(self):
+        return self._args.uve_queue_limit
+
+    def checkpoint_dir(self):
+        return self._args.checkpoint_dir
+
+    def checkpoint_interval(self):
+        return self._args.checkpoint_interval
+
+    def checkpoint_max_age(self):
+        return self._args.checkpoint_max_age
+
     def redis_password(self):
         return self._args.redis_password
 
@@ -307,6 +349,12 @@ class CfgParser(object):
     def redis_use_ssl(self):
         return self._args.redis_use_ssl
 
+    def redis_agg_inline_size(self):
+        return self._args.redis_agg_inline_size
+
+    def redis_agg_snapshot_interval(self):
+        return self._args.redis_agg_snapshot_interval
+
     def redis_ssl_params(self):
         return {'ssl': self._args.redis_use_ssl,
                 'ssl_keyfile': self._args.redis_keyfile,
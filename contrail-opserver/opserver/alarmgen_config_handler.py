@@ -15,6 +15,7 @@ from .config_handler import ConfigHandler
 from .alarmgen_config_db import DBBaseAG, GlobalSystemConfigAG, AlarmAG
 from .opserver_util import camel_case_to_hyphen, inverse_dict
 from .plugins.alarm_base import AlarmBase 
+from .alarm_rules import AlarmRuleEvaluator
 from .sandesh.viz.constants import UVE_MAP
 
 
@@ -66,6 +67,15 @@ class AlarmGenConfigHandler(ConfigHandler):
     def _update_alarm_config_table(self, alarm_fqname, alarm_obj, uve_keys,
                                    operation):
         alarm_config_change_map = {}
+        # Compile the rules once, for all the tables of the alarm
+        evaluator = None
+        if operation == 'CREATE' or operation == 'UPDATE':
+            if isinstance(alarm_obj, AlarmBase):
+                alarm_cfg = alarm_obj.config()
+            else:
+                alarm_cfg = alarm_obj
+            if alarm_cfg is not None:
+                evaluator = AlarmRuleEvaluator(alarm_cfg, self._logger)
         for key in uve_keys:
             uve_type_name = key.split(':', 1)
             try:
@@ -94,6 +104,7 @@ class AlarmGenConfigHandler(ConfigHandler):
                                 alarm_table[alarm_fqname] = alarm_base_obj
                         else:
                             alarm_table[alarm_fqname] = alarm_obj
+                        alarm_table[alarm_fqname].set_evaluator(evaluator)
                     elif operation == 'DELETE':
                         if alarm_fqname in alarm_table:
                             del alarm_table[alarm_fqname]
@@ -66,7 +66,8 @@ from .overlay_to_underlay_mapper import OverlayToUnderlayMapper, \
      OverlayToUnderlayMapperError
 from .generator_introspect_util import GeneratorIntrospectUtil
 from stevedore import extension
-from .partition_handler import PartInfo, UveStreamer, UveCacheProcessor
+from .partition_handler import PartInfo, UveStreamer, UveCacheProcessor, \
+    UvePartFeeds, UveWatch
 from .vnc_cfg_api_client import VncCfgApiClient
 from .opserver_local import LocalApp
 from .opserver_util import AnalyticsDiscovery
@@ -427,12 +428,17 @@ class OpServer(object):
         * ``/analytics/query/<queryId>/chunk-final/<chunkId>``
         * ``/analytics/send-tracebuffer/<source>/<module>/<name>``
         * ``/analytics/operation/analytics-data-start-time``
+        * ``/analytics/uve-watch``
 
     The supported **POST** APIs are:
         * ``/analytics/query``:
         * ``/analytics/operation/database-purge``:
     """
 
+    # Default and maximum wait of /analytics/uve-watch, in seconds
+    _UVE_WATCH_TIMEOUT = 30
+    _UVE_WATCH_MAX_TIMEOUT = 300
+
     def validate_user_token(func=None, only_cloud_admin=True,
             get_token_info=False):
         def _validate_user_token_impl(func):
@@ -771,6 +777,7 @@ class OpServer(object):
                  for k, v in ModuleCategoryMap.items())
 
         self.agp = {}
+        self._uve_streamers = set()
         ConnectionState.update(conn_type = ConnectionType.UVEPARTITIONS,
             name = 'UVE-Aggregation', status = ConnectionStatus.UP,
             server_addrs = self._args.redis_uve_list,
@@ -800,6 +807,9 @@ class OpServer(object):
                                  None, False,
                                  freq = us_freq)
         self._state_server.update_redis_list(self.redis_uve_list) 
+        self._uve_part_feeds = UvePartFeeds(self._logger,
+                                 self._args.redis_password,
+                                 self.redis_ssl_params())
 
         if self._args.zk_list:
             self._ad = AnalyticsDiscovery(self._logger,
@@ -831,7 +841,8 @@ class OpServer(object):
         if qe_enable:
             self._analytics_links.extend(['tables', 'queries'])
         if alarm_enable:
-            self._analytics_links.extend(['alarms', 'uve-stream', 'alarm-stream'])
+            self._analytics_links.extend(['alarms', 'uve-stream', 'alarm-stream',
+                'uve-watch'])
         self._VIRTUAL_TABLES = copy.deepcopy(_TABLES)
 
         listmgrs = extension.ExtensionManager('contrail.analytics.alarms')
@@ -1027,6 +1038,7 @@ class OpServer(object):
         if alarm_enable:
             bottle.route('/analytics/uve-stream', 'GET', self.uve_stream)
             bottle.route('/analytics/alarm-stream', 'GET', self.alarm_stream)
+            bottle.route('/analytics/uve-watch', 'GET', self.uve_watch)
             bottle.route('/analytics/alarms', 'GET', self.alarms_http_get)
 
         bottle.route('/analytics/uves/<tables>', 'GET', self.dyn_list_http_get)
@@ -1345,6 +1357,7 @@ class OpServer(object):
 
     def cleanup_uve_streamer(self, gv):
         self.gevs.remove(gv)
+        self._uve_streamers.discard(gv)
 
     def _set_non_admin_tablefilt(self, filters):
         """
@@ -1375,6 +1388,20 @@ class OpServer(object):
 
         if alarmsonly:
             filters['cfilt'] = {'UVEAlarms':set()}
+        # In delta mode, a UVE type that was already sent on this stream
+        # is sent as a JSON Merge Patch against the previous value
+        delta = req.get('delta') in ['1', 'true']
+        # In batch mode, updates are grouped into 'updates' events holding
+        # a list, sent every batch_ms milliseconds or batch_bytes bytes
+        batch_interval = None
+        batch_size = 65536
+        try:
+            if req.get('batch_ms'):
+                batch_interval = int(req['batch_ms']) / 1000.0
+            if req.get('batch_bytes'):
+                batch_size = int(req['batch_bytes'])
+        except ValueError as e:
+            return bottle.HTTPError(_ERRORS[errno.EBADMSG], e)
 
         kfilter = filters.get('kfilt')
         patterns = None
@@ -1384,6 +1411,13 @@ class OpServer(object):
                 patterns.add(self._uve_server.get_uve_regex(filt))
 
         filters, token = self._set_non_admin_tablefilt(filters)
+        # A reconnecting client can resume from the last event it got.
+        # Non-admin streams always start with a full sync, since
+        # the read permission of a UVE needs its full contents.
+        since = None
+        last_event_id = bottle.request.get_header('Last-Event-ID')
+        if last_event_id and token is None:
+            since = self._uve_part_feeds.parse_event_id(last_event_id)
         bottle.response.set_header('Content-Type', 'text/event-stream')
         bottle.response.set_header('Cache-Control', 'no-cache')
         # This is needed to detect when the client hangs up
@@ -1392,9 +1426,13 @@ class OpServer(object):
         body = gevent.queue.Queue()
         ph = UveStreamer(self._logger, body, rfile, self.get_agp,
             self._args.redis_password, self.redis_ssl_params(),
-            filters['tablefilt'], filters['cfilt'], patterns, token=token)
+            filters['tablefilt'], filters['cfilt'], patterns, token=token,
+            feeds=self._uve_part_feeds, since=since, delta=delta,
+            agp_poll=None, batch_interval=batch_interval,
+            batch_size=batch_size)
         ph.set_cleanup_callback(self.cleanup_uve_streamer)
         self.gevs.append(ph)
+        self._uve_streamers.add(ph)
         ph.start()
         return body
 
@@ -1406,6 +1444,45 @@ class OpServer(object):
     def alarm_stream(self):
         return self._serve_streams(True)
 
+    @validate_user_token()
+    def uve_watch(self):
+        """
+        Long-poll for changes to the UVEs matching the filters, after the
+        version returned by an earlier call. Returns the new version and
+        the changed keys, or null keys when all UVEs must be read again
+        (first call, or the changes since that version are not known).
+        """
+        req = bottle.request.query
+        try:
+            filters = OpServer._uve_filter_set(req)
+            timeout = min(float(req.get('timeout', self._UVE_WATCH_TIMEOUT)),
+                          self._UVE_WATCH_MAX_TIMEOUT)
+        except Exception as e:
+            return bottle.HTTPError(_ERRORS[errno.EBADMSG], e)
+
+        kfilter = filters.get('kfilt')
+        patterns = None
+        if kfilter is not None:
+            patterns = set()
+            for filt in kfilter:
+                patterns.add(self._uve_server.get_uve_regex(filt))
+
+        version = req.get('version') or \
+            bottle.request.get_header('If-None-Match')
+        since = None
+        if version:
+            since = self._uve_part_feeds.parse_event_id(version.strip('"'))
+        watch = UveWatch(self._uve_part_feeds, self.get_agp(),
+            filters['tablefilt'], filters['cfilt'], patterns)
+        cursor, changed = watch.wait(since, timeout)
+        if changed is not None:
+            changed = sorted(changed)
+        version = self._uve_part_feeds.event_id(cursor)
+        bottle.response.set_header('Content-Type', 'application/json')
+        bottle.response.set_header('ETag', '"%s"' % version)
+        return json.dumps({'version': version, 'changed': changed})
+    # end uve_watch
+
     def documentation_http_get(self, filename):
         return bottle.static_file(
             filename, root='/usr/share/doc/contrail-analytics-api/html')
@@ -2597,7 +2674,14 @@ class OpServer(object):
                 server_addrs = server_list,
                 message = 'Partitions:%d' % len(new_agp))
             self._uvepartitions_state = ConnectionStatus.UP
-        self.agp = new_agp
+        if new_agp != self.agp:
+            self.agp = new_agp
+            # The feeds of the partitions that moved read from an
+            # alarmgen that no longer owns them
+            self._uve_part_feeds.update_agp(new_agp)
+            # Streams restart the partitions that moved right away
+            for streamer in self._uve_streamers:
+                streamer.agp_changed()
 
     def get_agp(self):
         return self.agp
@@ -59,6 +59,87 @@ def convert_to_string(item):
 # end convert_to_string
 
 
+class LatencyHistogram(object):
+    """ A fixed size histogram of latencies in usec, or of other
+        non-negative integers such as batch sizes. Values below
+        2^SUB_BITS have a bucket each, and every power of 2 above is
+        split into 2^(SUB_BITS-1) buckets, so that a value is known
+        within 1/16 of itself. Values above MAX_USEC (about 19 hours)
+        are counted in the last bucket.
+        Histograms are merged by adding the counts of their buckets.
+    """
+    SUB_BITS = 5
+    MAX_USEC = (1 << 36) - 1
+    _MAX_SHIFT = 36 - SUB_BITS
+    NBUCKETS = (_MAX_SHIFT + 2) << (SUB_BITS - 1)
+
+    def __init__(self):
+        self.counts = [0] * self.NBUCKETS
+
+    def record(self, usec, n=1):
+        # SUB_BITS is written out, to keep recording cheap
+        if usec < 32:
+            self.counts[usec if usec > 0 else 0] += n
+            return
+        shift = usec.bit_length() - 5
+        if shift > self._MAX_SHIFT:
+            self.counts[-1] += n
+            return
+        self.counts[(shift << 4) + (usec >> shift)] += n
+
+    @classmethod
+    def bucket_max(cls, idx):
+        ''' Returns the largest value counted in bucket idx '''
+        if idx < (1 << cls.SUB_BITS):
+            return idx
+        shift = (idx >> (cls.SUB_BITS - 1)) - 1
+        mant = idx - (shift << (cls.SUB_BITS - 1))
+        return ((mant + 1) << shift) - 1
+
+    def merge(self, other):
+        counts = self.counts
+        for idx, cnt in enumerate(other.counts):
+            if cnt:
+                counts[idx] += cnt
+
+    def reset(self):
+        self.counts = [0] * self.NBUCKETS
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentiles(self, pcts):
+        ''' Returns the values at the given percentiles (0 to 100),
+            as the largest value of the bucket that holds each of them,
+            or 0 if the histogram is empty
+        '''
+        total = self.count()
+        if not total:
+            return [0] * len(pcts)
+        ranks = sorted((max(int(total * pct / 100.0 + 0.5), 1), pos) \
+                       for pos, pct in enumerate(pcts))
+        result = [0] * len(pcts)
+        seen = 0
+        ridx = 0
+        for idx, cnt in enumerate(self.counts):
+            if not cnt:
+                continue
+            seen += cnt
+            while ridx < len(ranks) and ranks[ridx][0] <= seen:
+                result[ranks[ridx][1]] = self.bucket_max(idx)
+                ridx += 1
+            if ridx == len(ranks):
+                break
+        return result
+
+    def max(self):
+        for idx in range(self.NBUCKETS - 1, -1, -1):
+            if self.counts[idx]:
+                return self.bucket_max(idx)
+        return 0
+# end class LatencyHistogram
+
+
 from kazoo.client import KazooClient
 from kazoo.client import KazooState
 
@@ -8,7 +8,6 @@ from kafka import KafkaConsumer, structs, errors
 import os
 import ast
 import json
-import copy
 import traceback
 import cfgm_common
 import uuid
@@ -19,20 +18,57 @@ import select
 import redis
 import errno
 import time
-from collections import namedtuple
+import zlib
+import gevent.event
+import gevent.queue
+from collections import namedtuple, deque
 from .strict_redis_wrapper import StrictRedisWrapper
-from .opserver_util import convert_to_string
+from .opserver_util import convert_to_string, LatencyHistogram
 
 PartInfo = namedtuple("PartInfo",["ip_address","instance_id","redis_ip","redis_agg_db","acq_time","port"])
 
 def sse_pack(d):
     """Pack data in SSE format"""
     buffer = ''
-    for k in ['event','data']:
+    for k in ['id','event','data']:
         if k in list(d.keys()):
             buffer += '%s: %s\n' % (k, d[k])
     return buffer + '\n'
 
+def _has_null(d):
+    for v in d.values():
+        if v is None or (isinstance(v, dict) and _has_null(v)):
+            return True
+    return False
+
+def uve_merge_patch(old, new):
+    """
+    JSON Merge Patch (RFC 7396) that turns the old value of a UVE type
+    into the new one. Returns None if the new value has null attributes,
+    which a merge patch cannot express.
+    """
+    patch = {}
+    for k, v in new.items():
+        if v is None:
+            return None
+        if k in old:
+            ov = old[k]
+            if ov == v:
+                continue
+            if isinstance(v, dict) and isinstance(ov, dict):
+                v = uve_merge_patch(ov, v)
+                if v is None:
+                    return None
+            elif isinstance(v, dict) and _has_null(v):
+                return None
+        elif isinstance(v, dict) and _has_null(v):
+            return None
+        patch[k] = v
+    for k in old:
+        if k not in new:
+            patch[k] = None
+    return patch
+
 class UveCacheProcessor(object):
     def __init__(self, logger, rpass, redis_ssl_params):
         self._logger = logger
@@ -300,14 +336,406 @@ class UveCacheProcessor(object):
 # end class UveCacheProcessor
 
 
+class UvePartFeed(gevent.Greenlet):
+    """
+    Single subscription to the AGPARTPUB channel of a partition, shared
+    by all the UveStreamParts of this process. Every notification gets
+    a sequence number and is kept in a bounded changelog, so that a
+    stream can be resumed from any position still in the changelog.
+    A feed that replaces an earlier one of the partition continues
+    from its last position 'seq', so that no position is handed out twice.
+    """
+    def __init__(self, partno, pi, logger, rpass, redis_ssl_params, logsize,
+                 seq=0):
+        gevent.Greenlet.__init__(self)
+        self._partno = partno
+        self._pi = pi
+        self._logger = logger
+        self._rpass = rpass
+        self._redis_ssl_params = redis_ssl_params
+        self._log = deque(maxlen=logsize)
+        # Positions in [_start, _seq] can be resumed from, as long
+        # as the changelog still has the entries after them
+        self._seq = seq
+        self._start = seq
+        self._subs = set()
+        # Number of UveStreamParts and UveWatches using the feed
+        self._refs = 0
+        self._ready = gevent.event.Event()
+        # Sequence number of the last message from alarmgen, and of
+        # the message of each changelog entry
+        self._agseq = None
+        self._agseqs = deque(maxlen=logsize)
+        # All the messages from alarmgen after this sequence number are
+        # in the changelog, unless they were evicted
+        self._base = None
+
+    def pi(self):
+        return self._pi
+
+    def subscribe(self, q):
+        self._subs.add(q)
+
+    def unsubscribe(self, q):
+        self._subs.discard(q)
+
+    def attach(self):
+        self._refs += 1
+        return self._refs
+
+    def detach(self):
+        self._refs -= 1
+        return self._refs
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def position(self):
+        return self._seq
+
+    def changes(self, since):
+        """
+        Return the (seq, elems) changelog entries after position 'since',
+        or None if the changelog does not go back that far
+        """
+        if not self._ready.is_set():
+            return None
+        if since > self._seq or \
+                since < max(self._start, self._seq - len(self._log)):
+            return None
+        return list(self._log)[len(self._log) - (self._seq - since):]
+
+    def position_at(self, agseq):
+        """
+        Return the position after which the changelog has all the
+        messages from alarmgen with a sequence number above 'agseq',
+        or None if it does not have them all
+        """
+        if not self._ready.is_set() or self._base is None or \
+                agseq < self._base:
+            return None
+        pos = self._seq
+        for seq in reversed(self._agseqs):
+            if seq is None:
+                return None
+            if seq <= agseq:
+                return pos
+            pos -= 1
+        # The messages are in sequence, so the first one in the changelog
+        # follows the last one evicted from it
+        if pos != self._start and self._agseqs[0] != agseq + 1:
+            return None
+        return pos
+
+    def resync(self):
+        # Notifications may have been lost; none of the positions handed
+        # out so far can be resumed from, and subscribers must sync again
+        self._seq += 1
+        self._start = self._seq
+        self._log.clear()
+        self._agseqs.clear()
+        for q in self._subs:
+            q.put((self._seq, None))
+
+    def check_seq(self, elems):
+        """
+        Subscribers read the partition again if a message from alarmgen
+        was missed, or if alarmgen has reset the partition
+        """
+        if not elems or "seq" not in elems[0]:
+            return
+        agseq = elems[0]["seq"]
+        if self._agseq is not None and agseq != self._agseq + 1:
+            self._logger.error("AggUVE part %d gap in updates, seq %d "
+                "after %d" % (self._partno, agseq, self._agseq))
+            self.resync()
+            self._base = agseq - 1
+        self._agseq = agseq
+
+    def record(self, elems):
+        self._seq += 1
+        # Values sent inline are not kept; resumed streams read them back
+        lelems = elems
+        for elem in elems:
+            if "value" in elem:
+                lelems = [{"key":elem["key"], "type":elem["type"]} \
+                    for elem in elems]
+                break
+        self._log.append((self._seq, lelems))
+        self._agseqs.append(elems[0].get("seq") if elems else None)
+        for q in self._subs:
+            q.put((self._seq, elems))
+
+    def _run(self):
+        pb = None
+        pause = False
+        while True:
+            try:
+                if pause:
+                    gevent.sleep(2)
+                    pause = False
+                lredis = StrictRedisWrapper(
+                        host=self._pi.redis_ip,
+                        port=self._pi.port,
+                        password=self._rpass,
+                        db=self._pi.redis_agg_db, socket_timeout=30,
+                        **self._redis_ssl_params)
+                pb = lredis.pubsub()
+                pb.subscribe('AGPARTPUB:%s:%d' % \
+                        (self._pi.instance_id, self._partno))
+                self._agseq = None
+                self._base = None
+                self.resync()
+                self._ready.set()
+                while True:
+                    message = pb.get_message()
+                    if not message:
+                        gevent.sleep(0.001)
+                        continue
+                    if message["type"] == "subscribe":
+                        # Messages are received from here on
+                        self._base = int(lredis.get("AGPARTSEQ:%s:%d" % \
+                            (self._pi.instance_id, self._partno)) or 0)
+                    if message["type"] != "message":
+                        gevent.sleep(0)
+                        continue
+                    dataline = message["data"]
+                    try:
+                        elems = json.loads(dataline)
+                    except:
+                        self._logger.error("AggUVE Parsing failed: %s" % str(message))
+                        gevent.sleep(0)
+                        continue
+                    else:
+                         self._logger.info("AggUVE loading: %s" % str(elems))
+                    self.check_seq(elems)
+                    self.record(elems)
+                    gevent.sleep(0)
+            except gevent.GreenletExit:
+                break
+            except (redis.exceptions.ConnectionError,
+                    redis.exceptions.TimeoutError):
+                pass
+            except Exception as ex:
+                template = "Exception {0} in uve part feed. Arguments:\n{1!r}"
+                messag = template.format(type(ex).__name__, ex.args)
+                self._logger.error("[%s:%d] AlarmGen %s,%d %s : traceback %s" % \
+                                  (self._pi.ip_address, self._pi.port, \
+                                   self._pi.instance_id, self._partno, \
+                                   messag, traceback.format_exc()))
+            finally:
+                self._ready.clear()
+                if pb is not None:
+                    pb.close()
+                    pb = None
+                    pause = True
+        return None
+
+# end class UvePartFeed
+
+
+class UvePartFeeds(object):
+    """
+    The UvePartFeeds of this process, one per partition, and the
+    token that tells apart the stream positions handed out by it.
+    A feed is stopped 'linger' seconds after the last UveStreamPart or
+    UveWatch using it puts it back, so that clients can still resume
+    from its changelog for a while, and right away when the partition
+    is no longer owned by the alarmgen it reads from.
+    """
+    def __init__(self, logger, rpass, redis_ssl_params, logsize=1000,
+                 linger=60):
+        self._logger = logger
+        self._rpass = rpass
+        self._redis_ssl_params = redis_ssl_params
+        self._logsize = logsize
+        self._linger = linger
+        self._token = uuid.uuid4().hex[:8]
+        self._feeds = {}
+        # Timers stopping the feeds that are not in use
+        self._idle = {}
+        # Last position of the stopped feeds
+        self._positions = {}
+
+    def get(self, partno, pi):
+        """
+        Return the feed of the partition, started if need be. Every
+        get has to be matched by a put when the feed is no longer used.
+        """
+        feed = self._feeds.get(partno)
+        if feed is not None and feed.pi() != pi:
+            self._stop(partno)
+            feed = None
+        if feed is None:
+            self._logger.info("Starting agguve feed %d using %s" % (partno, pi))
+            feed = UvePartFeed(partno, pi, self._logger, self._rpass,
+                    self._redis_ssl_params, self._logsize,
+                    self._positions.get(partno, 0))
+            self._feeds[partno] = feed
+            feed.start()
+        idle = self._idle.pop(partno, None)
+        if idle is not None:
+            idle.kill(block=False)
+        feed.attach()
+        return feed
+
+    def put(self, partno, feed):
+        if feed.detach() > 0 or self._feeds.get(partno) is not feed:
+            return
+        self._idle[partno] = gevent.spawn_later(self._linger,
+                self._stop_idle, partno, feed)
+
+    def _stop_idle(self, partno, feed):
+        if self._feeds.get(partno) is feed:
+            self._idle.pop(partno, None)
+            self._stop(partno)
+
+    def _stop(self, partno):
+        feed = self._feeds.pop(partno)
+        idle = self._idle.pop(partno, None)
+        if idle is not None and idle is not gevent.getcurrent():
+            idle.kill(block=False)
+        self._positions[partno] = feed.position()
+        self._logger.info("Stopping agguve feed %d using %s" % \
+                (partno, feed.pi()))
+        feed.kill()
+
+    def update_agp(self, agp):
+        """
+        Stop the feeds of the partitions that are no longer owned, or
+        that are now owned by another alarmgen
+        """
+        for partno in list(self._feeds.keys()):
+            if agp.get(partno) != self._feeds[partno].pi():
+                self._stop(partno)
+
+    def event_id(self, cursor):
+        return "%s:%s" % (self._token, ",".join(["%d.%d" % (part, seq) \
+                for part, seq in sorted(cursor.items())]))
+
+    def parse_event_id(self, event_id):
+        """
+        Return the {partition: position} cursor of an event id,
+        or None if it was not handed out by this process
+        """
+        try:
+            token, positions = event_id.split(":", 1)
+            if token != self._token:
+                return None
+            cursor = {}
+            for pos in positions.split(","):
+                part, seq = pos.split(".")
+                cursor[int(part)] = int(seq)
+        except ValueError:
+            return None
+        return cursor
+
+# end class UvePartFeeds
+
+
+class UveWatch(object):
+    """
+    Long-poll for changes to the UVEs matching the given filters,
+    driven by the UvePartFeeds of the process
+    """
+    def __init__(self, feeds, agp, tablefilt = None, cfilter = None,
+                 patterns = None):
+        self._feeds = feeds
+        self._agp = agp
+        self._tablefilt = None
+        if tablefilt:
+            self._tablefilt = set(tablefilt)
+        self._cfilter = None
+        if cfilter:
+            self._cfilter = set(cfilter.keys())
+        self._patterns = patterns
+
+    def _match(self, elem):
+        table, barekey = elem["key"].split(":",1)
+        if self._tablefilt and not table in self._tablefilt:
+            return False
+        if self._patterns:
+            kfilter_match = False
+            for pattern in self._patterns:
+                if pattern.match(barekey):
+                    kfilter_match = True
+                    break
+            if not kfilter_match:
+                return False
+        if self._cfilter and elem["type"] is not None and \
+                elem["type"] not in self._cfilter:
+            return False
+        return True
+
+    def wait(self, since, timeout):
+        """
+        Wait up to 'timeout' seconds for changes after the cursor 'since'.
+        Returns the current cursor and the set of changed UVE keys. The
+        set is None if the changes after 'since' are not known, in which
+        case the caller has to read all the UVEs it is interested in.
+        """
+        deadline = time.time() + timeout
+        lfeeds = {}
+        q = gevent.queue.Queue()
+        try:
+            for partno, pi in self._agp.items():
+                lfeeds[partno] = self._feeds.get(partno, pi)
+            for feed in lfeeds.values():
+                feed.wait_ready(max(deadline - time.time(), 0))
+            if since is not None and set(since.keys()) != set(lfeeds.keys()):
+                since = None
+            for feed in lfeeds.values():
+                feed.subscribe(q)
+            while True:
+                cursor = {}
+                changed = set()
+                for partno, feed in lfeeds.items():
+                    cursor[partno] = feed.position()
+                    if changed is None or since is None:
+                        continue
+                    entries = feed.changes(since[partno])
+                    if entries is None:
+                        changed = None
+                        continue
+                    for seq, elems in entries:
+                        for elem in elems:
+                            if self._match(elem):
+                                changed.add(elem["key"])
+                if since is None or changed is None:
+                    return cursor, None
+                remaining = deadline - time.time()
+                if changed or remaining <= 0:
+                    return cursor, changed
+                try:
+                    q.get(timeout=remaining)
+                except gevent.queue.Empty:
+                    pass
+        finally:
+            for partno, feed in lfeeds.items():
+                feed.unsubscribe(q)
+                self._feeds.put(partno, feed)
+
+# end class UveWatch
+
+
 class UveStreamPart(gevent.Greenlet):
-    def __init__(self, partno, logger, cb, pi, rpass, redis_ssl_params, content = True, 
-                tablefilt = None, cfilter = None, patterns = None, token = None):
+    # Number of keys read per round trip during the initial sync
+    SYNC_BATCH = 100
+
+    def __init__(self, partno, logger, cb, pi, rpass, redis_ssl_params, content = True,
+                tablefilt = None, cfilter = None, patterns = None, token = None,
+                feeds = None, since = None, pcb = None):
         gevent.Greenlet.__init__(self)
         self._logger = logger
         self._cb = cb
         self._pi = pi
         self._partno = partno
+        if feeds is None:
+            feeds = UvePartFeeds(logger, rpass, redis_ssl_params)
+        self._feeds = feeds
+        # Last changelog position whose updates have all been reported
+        self._since = since
+        self._pcb = pcb
         # We need to keep track of UVE contents only for streaming case
         self._content = content
         self._rpass = rpass
@@ -324,13 +752,28 @@ class UveStreamPart(gevent.Greenlet):
         if token and 'token_info' in token:
             self._token_info = token['token_info']
         self._uvecache = {}
+        # key : (hash of ContrailConfig, read permission)
+        self._permcache = {}
 
-    def is_uve_read_permitted(self, uves):
+    def is_uve_read_permitted(self, uves, key=None):
         """
-        Check for permissions in ContrailConfig structure for given user
+        Check for permissions in ContrailConfig structure for given user.
+        The decision for a key is cached until its ContrailConfig changes.
         """
         if not self._token or self._token['is_global_read_only_role']:
             return True
+        cchash = hash(uves.get("ContrailConfig"))
+        if key is not None:
+            perm = self._permcache.get(key)
+            if perm is not None and perm[0] == cchash:
+                return perm[1]
+        permitted = self._is_uve_read_permitted(uves)
+        if key is not None:
+            self._permcache[key] = (cchash, permitted)
+        return permitted
+    # end is_uve_read_permitted
+
+    def _is_uve_read_permitted(self, uves):
         if "ContrailConfig" in list(uves.keys()):
             cc = json.loads(uves["ContrailConfig"])
             perms2 = ast.literal_eval(cc['elements']['perms2'])
@@ -374,13 +817,68 @@ class UveStreamPart(gevent.Greenlet):
         else:
             self._logger.error("no ContrailConfig structure %s" %list(uves.keys()))
         return False
-    # end is_uve_read_permitted
+    # end _is_uve_read_permitted
 
     def syncpart(self, redish):
+        """
+        Report the contents of the partition in batches of SYNC_BATCH
+        keys, yielding between batches. SSCAN can return a key more
+        than once; that only repeats its update. It can also return more
+        keys than asked for, which are then split into several batches.
+        """
         inst = self._pi.instance_id
         part = self._partno
-        keys = list(redish.smembers("AGPARTKEYS:%s:%d" % (inst, part)))
-        ppe = redish.pipeline()
+        for keys in redish.sscan_batches("AGPARTKEYS:%s:%d" % (inst, part),
+                                         self.SYNC_BATCH):
+            for idx in range(0, len(keys), self.SYNC_BATCH):
+                self._syncbatch(redish, keys[idx:idx + self.SYNC_BATCH])
+                gevent.sleep(0)
+
+    def syncsnap(self, redish, feed):
+        """
+        Report the contents of the partition from the snapshot written
+        by alarmgen, one chunk at a time, yielding between chunks.
+        Returns the position of 'feed' from which the updates written
+        since the snapshot was started are to be replayed, or None if
+        there is no usable snapshot.
+        """
+        inst = self._pi.instance_id
+        part = self._partno
+        head = redish.get("AGPARTSNAP:%s:%d" % (inst, part))
+        if head is None:
+            return None
+        try:
+            head = json.loads(head)
+        except ValueError as ex:
+            self._logger.error("AggUVE part %d bad snapshot : %s" % \
+                (part, str(ex)))
+            return None
+        if head["acq_time"] != self._pi.acq_time or \
+                feed.position_at(head["seq"]) is None:
+            return None
+        for idx in range(head["chunks"]):
+            blob = redish.get("AGPARTSNAP:%s:%d:%d:%d" % \
+                (inst, part, head["gen"], idx))
+            uves = None
+            try:
+                if blob is not None:
+                    uves = json.loads(zlib.decompress(blob))
+            except (zlib.error, ValueError) as ex:
+                self._logger.error("AggUVE part %d bad snapshot chunk %d "
+                    ": %s" % (part, idx, str(ex)))
+            if uves is None:
+                # The rest of the contents are read from the partition;
+                # the updates since the snapshot are still replayed
+                self._logger.info("AggUVE part %d snapshot chunk %d "
+                    "missing, doing full sync" % (part, idx))
+                self.syncpart(redish)
+                break
+            lkeys = self._filterkeys(list(uves.keys()))
+            self._syncvalues(lkeys, [uves[key] for key in lkeys])
+            gevent.sleep(0)
+        return feed.position_at(head["seq"])
+
+    def _filterkeys(self, keys):
         lkeys = []
         for key in keys:
             table, barekey = key.split(":",1)
@@ -396,20 +894,32 @@ class UveStreamPart(gevent.Greenlet):
                 if not kfilter_match:
                     continue
             lkeys.append(key)
+        return lkeys
+
+    def _syncbatch(self, redish, keys):
+        inst = self._pi.instance_id
+        part = self._partno
+        ppe = redish.pipeline()
+        lkeys = self._filterkeys([convert_to_string(key) for key in keys])
+        for key in lkeys:
             # We need to load full UVE contents for streaming case
             # For DBCache case, we only need the struct types
             if self._content:
                 ppe.hgetall("AGPARTVALUES:%s:%d:%s" % (inst, part, key))
-                if not key in self._uvecache:
-                    self._uvecache[key] = {}
             else:
                 ppe.hkeys("AGPARTVALUES:%s:%d:%s" % (inst, part, key))
-        pperes = ppe.execute()
+        if not lkeys:
+            return
+        self._syncvalues(lkeys, ppe.execute())
+
+    def _syncvalues(self, lkeys, pperes):
         idx=0
         for res in pperes:
             if self._content:
+                if not lkeys[idx] in self._uvecache:
+                    self._uvecache[lkeys[idx]] = {}
                 if self._token is not None:
-                    if not self.is_uve_read_permitted(res):
+                    if not self.is_uve_read_permitted(res, lkeys[idx]):
                         idx += 1
                         continue
                 for tk,tv in res.items():
@@ -427,10 +937,124 @@ class UveStreamPart(gevent.Greenlet):
                     self._cb(self._partno, self._pi, lkeys[idx], telem, {})
 
             idx += 1
-        
+
+    def resync(self, redish, feed, seq):
+        """
+        Report the full contents of the partition, as of changelog
+        position 'seq' or later. The contents are read from the snapshot
+        written by alarmgen if there is a usable one, and the updates
+        since it are replayed from the changelog of 'feed'.
+        """
+        self._since = None
+        if callable(self._pcb):
+            self._pcb(self._partno, None)
+        since = self.syncsnap(redish, feed)
+        entries = None
+        if since is not None:
+            entries = feed.changes(since)
+        if entries is None:
+            self.syncpart(redish)
+            since = seq
+            entries = []
+        self._since = since
+        if callable(self._pcb):
+            self._pcb(self._partno, since)
+        for eseq, elems in entries:
+            self.handle_update(redish, eseq, elems)
+
+    def handle_update(self, redish, seq, elems):
+        inst = self._pi.instance_id
+        part = self._partno
+        if self._content:
+            ppe = redish.pipeline()
+        nreads = 0
+        lelems = []
+        for elem in elems:
+            table, barekey = elem["key"].split(":",1)
+            if self._tablefilt:
+                if not table in self._tablefilt:
+                    gevent.sleep(0)
+                    continue
+            if self._patterns:
+                kfilter_match = False
+                for pattern in self._patterns:
+                    if pattern.match(barekey):
+                        kfilter_match = True
+                        break
+                if not kfilter_match:
+                    gevent.sleep(0)
+                    continue
+            if self._cfilter:
+                if elem["type"] not in self._cfilter:
+                    gevent.sleep(0)
+                    continue
+            lelems.append(elem)
+            # Values may have been sent inline with the notification
+            if self._content and elem["type"] is not None and \
+                    "value" not in elem:
+                ppe.hget("AGPARTVALUES:%s:%d:%s" % \
+                    (inst, part, elem["key"]), elem["type"])
+                nreads += 1
+
+        # We need to execute this pipeline read only if we are
+        # keeping track of UVE contents (streaming case)
+        if nreads:
+            pperes = ppe.execute()
+        idx = 0
+        updates = []
+        for elem in lelems:
+
+            key = elem["key"]
+            typ = elem["type"]
+            vdata = None
+
+            if not typ is None:
+                if self._content:
+                    if not key in self._uvecache:
+                        self._uvecache[key] = {}
+
+                    if "value" in elem:
+                        vdata = elem["value"]
+                        vjson = None
+                        if vdata is not None:
+                            vjson = json.dumps(vdata)
+                    else:
+                        vjson = pperes[idx]
+                        idx += 1
+                        if vjson is not None:
+                            vdata = json.loads(vjson)
+                    if vjson is None:
+                        if typ in self._uvecache[key]:
+                            del self._uvecache[key][typ]
+                    else:
+                        self._uvecache[key][typ] = vjson
+                    if self._token is not None:
+                        if not self.is_uve_read_permitted(\
+                                self._uvecache[key], key):
+                            gevent.sleep(0)
+                            continue
+                else:
+                    vdata = {}
+            else:
+                self._uvecache.pop(key, None)
+                self._permcache.pop(key, None)
+            updates.append((key, typ, vdata))
+        # The position moves to 'seq' before the last update is reported,
+        # so that the event sent with it names the position after it
+        last = updates.pop() if updates else None
+        for key, typ, vdata in updates:
+            self._cb(self._partno, self._pi, key, typ, vdata)
+        self._since = seq
+        if callable(self._pcb):
+            self._pcb(self._partno, seq)
+        if last is not None:
+            key, typ, vdata = last
+            self._cb(self._partno, self._pi, key, typ, vdata)
+
     def _run(self):
         lredis = None
-        pb = None
+        feed = None
+        sub = None
         pause = False
         self.redis_prev_time = 0
         while True:
@@ -444,93 +1068,31 @@ class UveStreamPart(gevent.Greenlet):
                         password=self._rpass,
                         db=self._pi.redis_agg_db, socket_timeout=30,
                         **self._redis_ssl_params)
-                pb = lredis.pubsub()
-                inst = self._pi.instance_id
-                part = self._partno
-                pb.subscribe('AGPARTPUB:%s:%d' % (inst, part))
-                self.syncpart(lredis)
+                feed = self._feeds.get(self._partno, self._pi)
+                feed.wait_ready()
+                # No yield between subscribing and reading the changelog,
+                # so that every update is either replayed or queued
+                sub = gevent.queue.Queue()
+                feed.subscribe(sub)
+                entries = None
+                if self._since is not None:
+                    entries = feed.changes(self._since)
+                    if entries is None:
+                        self._logger.info("AggUVE part %d position %d "
+                            "not in changelog, doing full sync" % \
+                            (self._partno, self._since))
+                if entries is None:
+                    self.resync(lredis, feed, feed.position())
+                else:
+                    for seq, elems in entries:
+                        self.handle_update(lredis, seq, elems)
                 while True:
-                    message = pb.get_message()
-                    if not message:
-                        gevent.sleep(0.001)
-                        continue
-                    if message["type"] != "message":
-                        gevent.sleep(0)
-                        continue
-                    dataline = message["data"]
-                    try:
-                        elems = json.loads(dataline)
-                    except:
-                        self._logger.error("AggUVE Parsing failed: %s" % str(message))
-                        gevent.sleep(0)
-                        continue
-                    else:
-                         self._logger.info("AggUVE loading: %s" % str(elems))
-                    if self._content:
-                        ppe = lredis.pipeline()
-                    lelems = []
-                    for elem in elems:
-                        table, barekey = elem["key"].split(":",1)
-                        if self._tablefilt:
-                            if not table in self._tablefilt:
-                                gevent.sleep(0)
-                                continue
-                        if self._patterns:
-                            kfilter_match = False
-                            for pattern in self._patterns:
-                                if pattern.match(barekey):
-                                    kfilter_match = True
-                                    break
-                            if not kfilter_match:
-                                gevent.sleep(0)
-                                continue
-                        if self._cfilter:
-                            if elem["type"] not in self._cfilter:
-                                gevent.sleep(0)
-                                continue
-                        lelems.append(elem)
-                        if self._content:
-                            # This UVE was deleted
-                            if elem["type"] is None:
-                                ppe.exists("AGPARTVALUES:%s:%d:%s" % \
-                                    (inst, part, elem["key"]))
-                            else:
-                                ppe.hget("AGPARTVALUES:%s:%d:%s" % \
-                                    (inst, part, elem["key"]), elem["type"])
-
-                    # We need to execute this pipeline read only if we are
-                    # keeping track of UVE contents (streaming case)
-                    if self._content:
-                        pperes = ppe.execute()
-                    idx = 0
-                    for elem in lelems:
-
-                        key = elem["key"]
-                        typ = elem["type"]
-                        vdata = None
-
-                        if not typ is None:
-                            if self._content:
-                                if not key in self._uvecache:
-                                    self._uvecache[key] = {}
-
-                                vjson = pperes[idx]
-                                if vjson is None:
-                                    vdata = None
-                                    if typ in self._uvecache[key]:
-                                        del self._uvecache[key][typ]
-                                else:
-                                    vdata = json.loads(vjson)
-                                    self._uvecache[key][typ] = vjson
-                                if self._token is not None:
-                                    if not self.is_uve_read_permitted(\
-                                            self._uvecache[key]):
-                                        gevent.sleep(0)
-                                        continue
-                            else:
-                                vdata = {}
-                        self._cb(self._partno, self._pi, key, typ, vdata)
-                        idx += 1
+                    seq, elems = sub.get()
+                    if elems is None:
+                        self.resync(lredis, feed, seq)
+                    elif seq > self._since:
+                        # Updates replayed by a resync are also queued
+                        self.handle_update(lredis, seq, elems)
                     gevent.sleep(0)
             except gevent.GreenletExit:
                 break
@@ -556,22 +1118,36 @@ class UveStreamPart(gevent.Greenlet):
                                        messag))
             finally:
                 lredis = None
-                if pb is not None:
-                    pb.close()
-                    pb = None
+                if sub is not None:
+                    feed.unsubscribe(sub)
+                    sub = None
                     pause = True
+                if feed is not None:
+                    self._feeds.put(self._partno, feed)
+                    feed = None
         return None
 
 class UveStreamer(gevent.Greenlet):
+    # In delta mode, a UVE type is sent in full after this many patches
+    DELTA_FULL_INTERVAL = 20
+
     def __init__(self, logger, q, rfile, agp_cb, rpass, redis_ssl_params, \
             tablefilt = None, cfilter = None, patterns = None,
-            USP_class = UveStreamPart, token=None):
+            USP_class = UveStreamPart, token=None, feeds=None, since=None,
+            delta=False, agp_poll=1, batch_interval=None,
+            batch_size=65536):
         gevent.Greenlet.__init__(self)
         self._logger = logger
         self._q = q
         self._rfile = rfile
         self._agp_cb = agp_cb
         self._agp = {}
+        # Partition ownership is read again when agp_changed is called,
+        # and also every agp_poll seconds if agp_poll is not None
+        self._agp_poll = agp_poll
+        self._agp_event = gevent.event.Event()
+        self._agp_event.set()
+        self._hangup = False
         self._parts = {}
         self._rpass = rpass
         self._redis_ssl_params = redis_ssl_params
@@ -582,6 +1158,27 @@ class UveStreamer(gevent.Greenlet):
         self._cfilter = cfilter
         self._patterns = patterns
         self._token = token
+        if feeds is None:
+            feeds = UvePartFeeds(logger, rpass, redis_ssl_params)
+        self._feeds = feeds
+        # Changelog position of each partition, as of the last event
+        # sent. A client can resume the stream from these positions
+        # by passing back the id of the last event it got.
+        self._since = since
+        self._cursor = {}
+        self._event_id = None
+        # In delta mode, the last value sent for each UVE type, and the
+        # number of patches sent since that type was last sent in full
+        self._delta = delta
+        self._sent = {}
+        # In batch mode, updates are sent as one SSE event holding a list,
+        # once batch_interval seconds have passed since the first update
+        # of the batch or the batch holds batch_size bytes
+        self._batch_interval = batch_interval
+        self._batch_size = batch_size
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_timer = None
 
     def get_uve(self, key, filters=None):
         return False, self._uvedbcache.get_cache_uve(key, filters)
@@ -601,20 +1198,82 @@ class UveStreamer(gevent.Greenlet):
         return self._uvedbcache.get_uvedb_cache_uve(table, uve_key)
     # end get_uvedb_cache_uve
 
+    def _sse_pack(self, msg):
+        if self._event_id is None:
+            self._event_id = self._feeds.event_id(self._cursor)
+        msg['id'] = self._event_id
+        return sse_pack(msg)
+
+    def position_callback(self, partition, seq):
+        if seq is None:
+            self._cursor.pop(partition, None)
+        else:
+            self._cursor[partition] = seq
+        self._event_id = None
+
+    def _delta_encode(self, key, type, value, dt):
+        if type is None:
+            self._sent.pop(key, None)
+            return
+        ksent = self._sent.setdefault(key, {})
+        if value is None:
+            ksent.pop(type, None)
+            dt['value'] = value
+            return
+        patch = None
+        if type in ksent:
+            old, npatch = ksent[type]
+            if npatch < self.DELTA_FULL_INTERVAL and \
+                    isinstance(old, dict) and isinstance(value, dict):
+                patch = uve_merge_patch(old, value)
+        if patch is None:
+            ksent[type] = (value, 0)
+            dt['value'] = value
+        else:
+            ksent[type] = (value, npatch + 1)
+            dt['delta'] = patch
+
+    def _send_update(self, dt):
+        data = json.dumps(dt)
+        if self._batch_interval is None:
+            msg = {'event': 'update', 'data':data}
+            self._q.put(self._sse_pack(msg))
+            return
+        self._batch.append(data)
+        self._batch_bytes += len(data)
+        if self._batch_bytes >= self._batch_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = gevent.spawn_later(self._batch_interval,
+                    self._flush_batch)
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            if self._batch_timer is not gevent.getcurrent():
+                self._batch_timer.kill(block=False)
+            self._batch_timer = None
+        if not self._batch:
+            return
+        msg = {'event': 'updates', 'data':'[%s]' % ','.join(self._batch)}
+        self._batch = []
+        self._batch_bytes = 0
+        self._q.put(self._sse_pack(msg))
+
     def clear_callback(self, key):
         if self._q:
+            self._sent.pop(key, None)
             dt = {'key':key, 'type':None}
-            msg = {'event': 'update', 'data':json.dumps(dt)}
-            self._q.put(sse_pack(msg))
+            self._send_update(dt)
 
     def partition_callback(self, partition, pi, key, type, value):
         # gevent is non-premptive; we don't need locks
         if self._q:
             dt = {'key':key, 'type':type}
-            if not type is None:
+            if self._delta:
+                self._delta_encode(key, type, value, dt)
+            elif not type is None:
                 dt['value'] = value
-            msg = {'event': 'update', 'data':json.dumps(dt)}
-            self._q.put(sse_pack(msg))
+            self._send_update(dt)
             # If this stream is being used for SSE, we have the UVE value,
             # but do not need to report it to the cache
             if not value is None:
@@ -625,22 +1284,51 @@ class UveStreamer(gevent.Greenlet):
     def set_cleanup_callback(self, cb):
         self._ccb = cb
 
+    def _resumable(self, agp):
+        """
+        A stream is resumed only if the changelog of every partition still
+        has the changes after the client's position; otherwise the client
+        gets a full sync
+        """
+        if set(agp.keys()) != set(self._since.keys()):
+            return False
+        for partno, pi in agp.items():
+            feed = self._feeds.get(partno, pi)
+            try:
+                if feed.changes(self._since[partno]) is None:
+                    return False
+            finally:
+                self._feeds.put(partno, feed)
+        return True
+
+    def agp_changed(self):
+        self._agp_event.set()
+
+    def _watch_hangup(self):
+        # The client does not send anything on the stream,
+        # so any input or error means that it hung up
+        select.select([self._rfile], [], [self._rfile])
+        self._hangup = True
+        self._agp_event.set()
+
     def _run(self):
-        inputs = [ self._rfile ]
-        outputs = [ ]
-        if self._q:
+        watcher = None
+        if self._rfile is not None:
+            watcher = gevent.spawn(self._watch_hangup)
+        if self._since is not None and not self._resumable(self._agp_cb()):
+            self._logger.info("UveStreamer cannot resume from %s" % \
+                    str(self._since))
+            self._since = None
+        if self._q and self._since is None:
             msg = {'event': 'init', 'data':json.dumps(None)}
-            self._q.put(sse_pack(msg))
+            self._q.put(self._sse_pack(msg))
         self._logger.info("Starting UveStreamer")
         while True:
             try:
-                if self._rfile is not None:
-                    readable, writable, exceptional = \
-                        select.select(inputs, outputs, inputs, 1)
-                    if (readable or writable or exceptional):
-                        break
-                else:
-                    gevent.sleep(1)
+                self._agp_event.wait(self._agp_poll)
+                self._agp_event.clear()
+                if self._hangup:
+                    break
                 newagp = self._agp_cb()
                 set_new, set_old = set(newagp.keys()), set(self._agp.keys())
                 intersect = set_new.intersection(set_old)
@@ -658,17 +1346,24 @@ class UveStreamer(gevent.Greenlet):
                         self.partition_stop(elem)
                         self._uvedbcache.clear_partition(elem, self.clear_callback)
                         self.partition_start(elem, newagp[elem])
-                self._agp = copy.deepcopy(newagp)
+                # PartInfo is immutable
+                self._agp = dict(newagp)
                 self._uvedbcache.update_agp(self._agp)
+                # Positions from the client only apply to the
+                # partitions started at the beginning of the stream
+                self._since = None
             except gevent.GreenletExit:
                 break
         self._logger.info("Stopping UveStreamer")
+        if watcher is not None:
+            watcher.kill()
         for part, pi in self._agp.items():
             self.partition_stop(part)
-            self._uvedbcache.clear_partition(elem, self.clear_callback)
+            self._uvedbcache.clear_partition(part, self.clear_callback)
         if self._q:
+            self._flush_batch()
             msg = {'event': 'stop', 'data':json.dumps(None)}
-            self._q.put(sse_pack(msg))
+            self._q.put(self._sse_pack(msg))
         if callable(self._ccb):
             self._ccb(self) #remove myself
 
@@ -680,16 +1375,30 @@ class UveStreamer(gevent.Greenlet):
             content = True
         else:
             content = False
+        since = None
+        if self._since is not None:
+            since = self._since.get(partno)
+        self.position_callback(partno, None)
         self._parts[partno] = self._USP_class(partno, self._logger,
             self.partition_callback, pi, self._rpass, self._redis_ssl_params, content,
-            self._tablefilt, self._cfilter, self._patterns, self._token)
+            self._tablefilt, self._cfilter, self._patterns, self._token,
+            feeds=self._feeds, since=since, pcb=self.position_callback)
         self._parts[partno].start()
 
     def partition_stop(self, partno):
         self._logger.info("Stopping agguve part %d" % partno)
+        self.position_callback(partno, None)
         self._parts[partno].kill()
         del self._parts[partno]
 
+# Bounds on the number of records read by one poll of a partition
+_POLL_RECORDS_MIN = 50
+_POLL_RECORDS_MAX = 2000
+# Time (in msec) that a poll waits for records when the partition is idle
+_POLL_IDLE_TIMEOUT_MS = 500
+# Minimum time (in seconds) between resource checks
+_RESOURCE_CHECK_INTERVAL = 0.1
+
 class PartitionHandler(gevent.Greenlet):
     def __init__(self, brokers, group, topic, logger, limit, kafka_use_ssl,
                  kafka_ssl_params):
@@ -705,13 +1414,71 @@ class PartitionHandler(gevent.Greenlet):
         self._failed = False
         self._kafka_use_ssl = kafka_use_ssl
         self._kafka_ssl_params = kafka_ssl_params
+        # Reading is paused while backlog() is above this (0 to disable)
+        self._backlog_limit = 0
+        self._paused = False
+        # Number of records of the partition not read yet
+        self._lag = 0
 
     def failed(self):
         return self._failed
 
+    def paused(self):
+        return self._paused
+
+    def lag(self):
+        return self._lag
+
+    def lag_check(self, consumer, tp):
+        '''
+        Update the lag of the partition, using the high watermark
+        returned with the last fetch, so that no request is made.
+        The lag is only a statistic; a failure to get it is logged
+        and does not stop reading the partition.
+        '''
+        try:
+            highwater = consumer.highwater(tp)
+            if highwater is None:
+                return
+            position = consumer.position(tp)
+        except Exception as ex:
+            self._logger.error("%s lag check failed: %s" % \
+                    (self._topic, str(ex)))
+            return
+        if not isinstance(highwater, int) or not isinstance(position, int):
+            self._logger.debug("%s lag check: highwater %s, position %s" % \
+                    (self._topic, str(highwater), str(position)))
+            return
+        self._lag = max(highwater - position, 0)
+
     def resource_check(self):
         self._logger.info("%s Resource check" % self._topic)
 
+    def backlog(self):
+        ''' Return the number of items read that are waiting to be
+            processed downstream
+        '''
+        return 0
+
+    def backlog_check(self, consumer, tp):
+        '''
+        Pause reading the partition when the backlog goes above the
+        limit, and resume it when the backlog is down to half the limit
+        '''
+        if not self._backlog_limit:
+            return
+        backlog = self.backlog()
+        if not self._paused and backlog > self._backlog_limit:
+            self._logger.info("%s paused, backlog %d" % \
+                    (self._topic, backlog))
+            consumer.pause(tp)
+            self._paused = True
+        elif self._paused and backlog <= self._backlog_limit // 2:
+            self._logger.info("%s resumed, backlog %d" % \
+                    (self._topic, backlog))
+            consumer.resume(tp)
+            self._paused = False
+
     def msg_handler(self, mlist):
         self._logger.info("%s Reading %s" % (self._topic, str(mlist)))
         return True
@@ -739,7 +1506,10 @@ class PartitionHandler(gevent.Greenlet):
                              security_protocol='SSL',
                              ssl_check_hostname=False,
                              **self._kafka_ssl_params)
-                    consumer.assign([structs.TopicPartition(self._topic,0)])
+                    tp = structs.TopicPartition(self._topic,0)
+                    consumer.assign([tp])
+                    self._paused = False
+                    self._lag = 0
                 except Exception as ex:
                     self.part_cur_time = time.time()
                     if self.part_prev_time == 0 or self.part_cur_time - self.part_prev_time > 60:
@@ -761,26 +1531,45 @@ class PartitionHandler(gevent.Greenlet):
                 if self._limit:
                     raise gevent.GreenletExit
 
+                max_records = _POLL_RECORDS_MIN
+                timeout_ms = 0
+                last_check = 0
                 while True:
                     try:
+                        self.backlog_check(consumer, tp)
                         #Alarmgen should not poll all records present in Kafka at once
                         #That can cause the CPU %age to increase and hence, miss Zookeeper timeout
                         #max_record value is added,so that only those many records are fetched at once
-                        mdict = consumer.poll(max_records=50)
-                        gevent.sleep(0.1)
-                        self.resource_check()
+                        mdict = consumer.poll(timeout_ms=timeout_ms,
+                                              max_records=max_records)
+                        if time.time() - last_check >= _RESOURCE_CHECK_INTERVAL:
+                            last_check = time.time()
+                            self.resource_check()
+                        nrecords = 0
                         if len(mdict):
                             counts = {}
-                            for tp,tv in mdict.items():
-                                if tp not in counts:
-                                    counts[tp] = 0
-                                counts[tp] += len(tv)
+                            for ktp,tv in mdict.items():
+                                if ktp not in counts:
+                                    counts[ktp] = 0
+                                counts[ktp] += len(tv)
                                 if not self.msg_handler(tv):
                                     raise gevent.GreenletExit
                                 pcount += len(tv)
+                                nrecords += len(tv)
                             self._logger.debug("poll for topic %s : %s" % (self._topic, str(counts)))
+                        self.lag_check(consumer, tp)
+                        # Read larger batches while the partition is lagging,
+                        # and wait for records in the poll when it is idle
+                        if nrecords >= max_records:
+                            max_records = min(max_records * 2, _POLL_RECORDS_MAX)
+                            timeout_ms = 0
+                        elif nrecords:
+                            max_records = max(max_records // 2, _POLL_RECORDS_MIN)
+                            timeout_ms = 0
                         else:
-                            gevent.sleep(0.5)
+                            max_records = _POLL_RECORDS_MIN
+                            timeout_ms = _POLL_IDLE_TIMEOUT_MS
+                        gevent.sleep(0)
 
                     except TypeError as ex:
                         self._logger.error("Type Error: %s trace %s" % \
@@ -831,9 +1620,13 @@ class UveStreamProc(PartitionHandler):
     #              and get sync contents for new collectors
     #  aginst    : instance_id of alarmgen
     #  rport     : redis server port
+    #  backlog_cb: Callback function returning the number of UVEs of
+    #              the partition that are waiting to be processed
+    #  backlog_limit : Reading is paused when backlog_cb returns more
+    #              than this, until it is down to half (0 to disable)
     def __init__(self, brokers, partition, uve_topic, logger, callback,
             host_ip, rsc, aginst, rport, kafka_use_ssl, kafka_ssl_params,
-            group="-workers"):
+            group="-workers", backlog_cb=None, backlog_limit=0):
         super(UveStreamProc, self).__init__(brokers, group,
             uve_topic, logger, False, kafka_use_ssl, kafka_ssl_params)
         self._uvedb = {}
@@ -849,6 +1642,15 @@ class UveStreamProc(PartitionHandler):
         self._acq_time = UTCTimestampUsec()
         self._up = True
         self._rport = rport
+        self._backlog_cb = backlog_cb
+        if backlog_cb is not None:
+            self._backlog_limit = backlog_limit
+        # Time (in seconds) taken to load the UVEs of the partition
+        # from the collectors, and the number of UVEs loaded
+        self._load_time = 0
+        self._load_uves = 0
+        # Time (in usec) from reading messages to queueing their UVEs
+        self._rx_hist = LatencyHistogram()
 
     def reset_acq_time(self):
         self._acq_time = UTCTimestampUsec()
@@ -856,19 +1658,50 @@ class UveStreamProc(PartitionHandler):
     def acq_time(self):
         return self._acq_time
 
+    def backlog(self):
+        return self._backlog_cb(self._partno)
+
+    def take_rx_hist(self):
+        '''
+        Return the histogram of the time taken from reading messages
+        to queueing their UVEs, and start a new one
+        '''
+        rx_hist = self._rx_hist
+        self._rx_hist = LatencyHistogram()
+        return rx_hist
+
     def resource_check(self):
         '''
         This function compares the known collectors with the
         list from discovery, and syncs UVE keys accordingly
         '''
-        newset , coll_delete, chg_res = self._resource_cb(self._partno, self.disc_rset)
+        load_start = time.time()
+        # The UVEs of new collectors are passed on for processing as
+        # they are read, before all of them are loaded
+        newset , coll_delete, chg_res = self._resource_cb(self._partno,
+                self.disc_rset, self.notify_partition_batch)
         for coll in coll_delete:
             self._logger.info("Part %d lost collector %s" % (self._partno, coll))
             self.stop_partition(coll)
         if len(chg_res):
-            self.start_partition(chg_res)
+            self._load_uves = self.start_partition(chg_res, notify=False)
+            self._load_time = time.time() - load_start
+            self._logger.info("Part %d loaded %d UVEs from %s in %.3f sec" % \
+                    (self._partno, self._load_uves, str(list(chg_res.keys())),
+                     self._load_time))
         self.disc_rset = newset
 
+    def notify_partition_batch(self, kcoll, gen_uves):
+        ''' Report the UVEs of a batch of the initial contents
+            of the partition, read from collector kcoll
+        '''
+        uves = {}
+        for gen in gen_uves.values():
+            for kk in gen.keys():
+                uves[kk] = None
+        if uves:
+            self._callback(self._partno, uves)
+
     def stop_partition(self, kcoll=None):
         clist = []
         if not kcoll:
@@ -903,9 +1736,11 @@ class UveStreamProc(PartitionHandler):
 
         return partdb
 
-    def start_partition(self, cbdb):
+    def start_partition(self, cbdb, notify=True):
         ''' This function loads the initial UVE database.
             for the partition
+            If notify is False, the UVEs have already been reported
+            It returns the number of UVEs loaded
         '''
         self._up = True
         self._logger.info("Starting part %d collectors %s" % \
@@ -935,7 +1770,13 @@ class UveStreamProc(PartitionHandler):
                     
         self._logger.info("Starting part %d UVEs %d" % \
                            (self._partno, len(uves)))
-        self._callback(self._partno, uves)
+        if notify:
+            self._callback(self._partno, uves)
+        else:
+            # The UVE queue of the partition is created even if
+            # there were no UVEs to report
+            self._callback(self._partno, {})
+        return len(uves)
 
     def contents(self):
         return self._uvedb
@@ -946,59 +1787,83 @@ class UveStreamProc(PartitionHandler):
             Also, the stats should be cleared to prepare
             for the next period of collection.
         '''
-        ret_in  = copy.deepcopy(self._uvein)
+        ret_in = self._uvein
         self._uvein = {}
         return ret_in
 
     def msg_handler(self, mlist):
+        '''
+        Handle the messages of a poll. Repeated changes of the same
+        UVE struct are collapsed, their values are decoded once, and
+        the changes are reported with a single callback.
+        '''
+        rx_time = UTCTimestampUsec()
+        chg = {}
+        ret = True
         for mm in mlist:
-            if not self.msg_handler_single(mm):
+            if not self.msg_handler_single(mm, chg):
                 self._logger.info("%s could not handle %s" % \
                     (self._topic, str(mm)))
-                return False
-        return True
-
-    def msg_handler_single(self, om):
+                ret = False
+                break
+        if not chg:
+            return ret
+        for key, types in chg.items():
+            for typ, value in types.items():
+                if value is None:
+                    continue
+                try:
+                    types[typ] = json.loads(convert_to_string(value))
+                except ValueError as ex:
+                    self._logger.info("%s could not decode %s:%s : %s" % \
+                        (self._topic, key, typ, str(ex)))
+                    types[typ] = {}
+                    ret = False
+        self._callback(self._partno, chg)
+        self._rx_hist.record(UTCTimestampUsec() - rx_time, len(mlist))
+        return ret
+
+    def msg_handler_single(self, om, chg):
+        '''
+        Apply one message to the UVE DB, and add its change to chg.
+        The value is added as read from kafka; it is decoded once for
+        the whole batch by msg_handler.
+        '''
         self._partoffset = om.offset
-        chg = {}
         try:
             params = convert_to_string(om.key).split("|")
             gen = params[2]
             coll = params[3]
-            uv = {}
-            uv["type"] = params[1]
-            uv["key"] = params[0]
+            key = params[0]
+            typ = params[1]
             if om.value is None or len(om.value) == 0:
-                uv["value"] = None
+                value = None
             else:
-                uv["value"] = json.loads(convert_to_string(om.value))
+                value = om.value
 
-            if coll not in self._uvedb:
+            uvedb = self._uvedb.get(coll)
+            if uvedb is None:
                 # This partition is not synced yet.
                 # Ignore this message
                 self._logger.debug("%s Ignoring UVE %s" % (self._topic, str(om)))
                 return True
 
-            if gen not in self._uvedb[coll]:
-                self._uvedb[coll][gen] = {}
-
-            tabl = uv["key"].split(":",1)
-            tab = tabl[0]
-            rkey = tabl[1]
-            
-            if tab not in self._uvedb[coll][gen]:
-                self._uvedb[coll][gen][tab] = {}
-
-            if not rkey in self._uvedb[coll][gen][tab]:
-                self._uvedb[coll][gen][tab][rkey] = {}
-     
-            removed = False
+            tab, rkey = key.split(":",1)
+            gdb = uvedb.get(gen)
+            if gdb is None:
+                gdb = uvedb[gen] = {}
+            tdb = gdb.get(tab)
+            if tdb is None:
+                tdb = gdb[tab] = {}
+            rdb = tdb.get(rkey)
+            if rdb is None:
+                rdb = tdb[rkey] = {}
 
-            # uv["type"] and uv["value"] can be decoded as follows:
+            # typ and value can be decoded as follows:
 
-            # uv["type"] refers to a struct name
+            # typ refers to a struct name
 
-            # uv["value"] can be one of the following:
+            # value can be one of the following:
             # - None      # This Type has been deleted.
             # - {}        # The Type has a value, which is 
             #               not available in this message.
@@ -1006,42 +1871,34 @@ class UveStreamProc(PartitionHandler):
             # - {<Value>} # The Value of the Type
             #               (this option is only for agg UVE updates)
 
-            if uv["value"] is None:
-                if uv["type"] in self._uvedb[coll][gen][tab][rkey]:
-                    del self._uvedb[coll][gen][tab][rkey][uv["type"]]
-                if not len(self._uvedb[coll][gen][tab][rkey]):
-                    del self._uvedb[coll][gen][tab][rkey]
-                removed = True
-
-            if not removed: 
-                if uv["type"] in self._uvedb[coll][gen][tab][rkey]:
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]]["c"] +=1
+            if value is None:
+                if typ in rdb:
+                    del rdb[typ]
+                if not len(rdb):
+                    del tdb[rkey]
+            else:
+                tc = rdb.get(typ)
+                if tc is not None:
+                    tc["c"] +=1
                 else:
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]] = {}
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]]["c"] = 1
-                    self._uvedb[coll][gen][tab][rkey][uv["type"]]["u"] = \
-                        uuid.uuid1(self._ip_code)
-            chg[uv["key"]] = { uv["type"] : uv["value"] }
+                    rdb[typ] = {"c": 1, "u": uuid.uuid1(self._ip_code)}
+            # A later change of the same struct in the batch replaces
+            # this one
+            kchg = chg.get(key)
+            if kchg is None:
+                kchg = chg[key] = {}
+            kchg[typ] = value
 
             # Record stats on the input UVE Notifications
-            if tab not in self._uvein:
-                self._uvein[tab] = {}
-            if coll not in self._uvein[tab]:
-                self._uvein[tab][coll] = {}
-            if gen not in self._uvein[tab][coll]:
-                self._uvein[tab][coll][gen] = {}
-            if uv["type"] not in self._uvein[tab][coll][gen]:
-                self._uvein[tab][coll][gen][uv["type"]] = 1
-            else:
-                self._uvein[tab][coll][gen][uv["type"]] += 1
+            gin = self._uvein.setdefault(tab, {}).setdefault(coll, {}).\
+                    setdefault(gen, {})
+            gin[typ] = gin.get(typ, 0) + 1
 
         except Exception as ex:
             template = "An exception of type {0} in uve proc . Arguments:\n{1!r}"
             messag = template.format(type(ex).__name__, ex.args)
             self._logger.info("%s" % messag)
             return False
-        else:
-            self._callback(self._partno, chg)
         return True
 
 if __name__ == '__main__':
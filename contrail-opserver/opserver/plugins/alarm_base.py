@@ -6,6 +6,8 @@ class AlarmBase(object):
 
     _RULES = None
 
+    _evaluator = None
+
     def __init__(self, sev=None, at=0, it=0, fec=False,
                  fcs=0, fct=0, config=None):
         self._sev = sev or self.ALARM_MAJOR
@@ -72,6 +74,17 @@ class AlarmBase(object):
         """Set the alarm config object for this alarm
         """
         self._config = alarm_cfg_obj
+        self._evaluator = None
+
+    def evaluator(self):
+        """Return the compiled rules of the alarm config, if any
+        """
+        return self._evaluator
+
+    def set_evaluator(self, evaluator):
+        """Set the compiled rules of the alarm config
+        """
+        self._evaluator = evaluator
 
     def is_enabled(self):
         if self._config:
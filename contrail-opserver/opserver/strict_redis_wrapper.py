@@ -20,3 +20,24 @@ class StrictRedisWrapper(redis.StrictRedis):
                           socket_keepalive=True,
                           socket_keepalive_options=tcp_keepalive_opts,
                           **kwargs)
+
+    def sscan_batches(self, name, count):
+        """
+        Iterate over the members of a set, in batches of about
+        'count' members. Falls back to SMEMBERS if the server does
+        not support SSCAN (before Redis 2.8).
+        """
+        try:
+            cursor, members = self.sscan(name, 0, count=count)
+        except redis.exceptions.ResponseError:
+            members = list(self.smembers(name))
+            for idx in range(0, len(members), count):
+                yield members[idx:idx + count]
+            return
+        while True:
+            if members:
+                yield members
+            if int(cursor) == 0:
+                break
+            cursor, members = self.sscan(name, cursor, count=count)
+    # end sscan_batches
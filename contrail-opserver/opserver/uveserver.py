@@ -15,18 +15,26 @@ import xmltodict
 import socket
 from .opserver_util import OpServerUtils
 import re
+import hashlib
 from pysandesh.util import UTCTimestampUsec
 from pysandesh.connection_info import ConnectionState
 from .sandesh.viz.constants import UVE_MAP
 from pysandesh.gen_py.process_info.ttypes import ConnectionType,\
      ConnectionStatus
 import traceback
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from .strict_redis_wrapper import StrictRedisWrapper
 from .opserver_util import convert_to_string
 
 more_than_100k = 0 
 
+# Fingerprints of UVE structs are sums of 64-bit hashes of their
+# attribute values
+_FPRINT_MASK = (1 << 64) - 1
+
+# Number of partition keys read at a time when loading a partition
+_PART_SCAN_COUNT = 1000
+
 RedisInfo = namedtuple("RedisInfo",["ip","port","pid"])
 
 RedisInstKey = namedtuple("RedisInstKey",["ip","port"])
@@ -204,31 +212,36 @@ class UVEServer(object):
                     return True
         return False
 
-    def get_part(self, part, r_inst):
+    def get_part(self, part, r_inst, batch_cb=None):
         # Get UVE and Type contents of given partition on given
         # collector/redis instance.
-        uves = {}
+        # The contents are read in batches; if batch_cb is given, it is
+        # called with the collector and the contents of each batch, so
+        # that they can be processed while the next batch is read.
+        r_ip = r_inst[0]
+        r_port = r_inst[1]
+        coll = r_ip + ":" + str(r_port)
+        gen_uves = {}
         try:
-            r_ip = r_inst[0]
-            r_port = r_inst[1]
             rik = RedisInstKey(ip=r_ip,port=r_port)
             redish = self._redis_uve_map[rik].redis_handle
-            gen_uves = {}
-            for elems in redish.smembers("PART2KEY:" + str(part)):
-                elems = convert_to_string(elems)
-                info = elems.split(":", 5)
-                gen = info[0] + ":" + info[1] + ":" + info[2] + ":" + info[3]
-                typ = info[4]
-                key = info[5]
-                if not gen in gen_uves:
-                     gen_uves[gen] = {}
-                if not key in gen_uves[gen]:
-                     gen_uves[gen][key] = {}
-                gen_uves[gen][key][typ] = {}
+            for batch in redish.sscan_batches("PART2KEY:" + str(part),
+                                              _PART_SCAN_COUNT):
+                batch_uves = {}
+                for elems in batch:
+                    elems = convert_to_string(elems)
+                    info = elems.split(":", 5)
+                    gen = info[0] + ":" + info[1] + ":" + info[2] + ":" + info[3]
+                    typ = info[4]
+                    key = info[5]
+                    gen_uves.setdefault(gen, {}).setdefault(key, {})[typ] = {}
+                    batch_uves.setdefault(gen, {}).setdefault(key, {})[typ] = {}
+                if batch_cb is not None:
+                    batch_cb(coll, batch_uves)
         except Exception as e:
             self._logger.error("get_part failed %s for : %s:%d tb %s" \
                                % (str(e), r_ip, r_port, traceback.format_exc()))
-        return r_ip + ":" + str(r_port) , gen_uves
+        return coll, gen_uves
 
     def get_tables(self):
         tables = set()
@@ -249,154 +262,33 @@ class UVEServer(object):
 
     def get_uve(self, key, flat, filters=None, base_url=None):
 
-        global more_than_100k
         filters = filters or {}
         sfilter = filters.get('sfilt')
         mfilter = filters.get('mfilt')
-        tfilter = filters.get('cfilt')
-        ackfilter = filters.get('ackfilt')
         if flat and not sfilter and not mfilter and self._usecache:
             return self._uvedbcache.get_uve(key, filters)
 
-        is_alarm = False
-        if tfilter == "UVEAlarms":
-            is_alarm = True
-
         state = {}
         state[key] = {}
         rsp = {}
         failures = False
 
-        tab = key.split(":",1)[0]
-
         for r_key, r_inst in self._redis_uve_map.items():
             if r_inst.redis_handle is None or r_inst.collector_pid is None:
                 continue
             else:
                 redish = r_inst.redis_handle
             try:
-                qmap = {}
-
                 ppe = redish.pipeline()
-                ppe.smembers("ALARM_ORIGINS:" + key)
-                if not is_alarm:
-                    ppe.smembers("ORIGINS:" + key)
-                pperes = ppe.execute()
-                origins = set()
-                for origset in pperes:
-                    for smt in origset:
-                        smt = convert_to_string(smt)
-                        tt = smt.rsplit(":",1)[1]
-                        sm = smt.rsplit(":",1)[0]
-                        source = sm.split(":", 1)[0]
-                        mdule = sm.split(":", 1)[1]
-                        if tfilter is not None:
-                            if tt not in tfilter:
-                                continue
-                        if sfilter is not None:
-                            if sfilter != source:
-                                continue
-                        if mfilter is not None:
-                            if mfilter != mdule:
-                                continue
-                        origins.add(smt)
+                self._read_origins(ppe, key, filters)
+                origins = self._filter_origins(ppe.execute(), filters)
 
                 ppeval = redish.pipeline()
                 for origs in origins:
                     ppeval.hgetall("VALUES:" + key + ":" + origs)
                 odictlist = ppeval.execute()
 
-                idx = 0
-                for origs in origins:
-
-                    odict = odictlist[idx]
-                    idx = idx + 1
-
-                    info = origs.rsplit(":", 1)
-                    dsource = info[0]
-                    typ = info[1]
-
-                    afilter_list = set()
-                    if tfilter is not None:
-                        afilter_list = tfilter[typ]
-
-                    del_uvealarms = False
-                    for attr, value in odict.items():
-                        attr = convert_to_string(attr)
-                        value = convert_to_string(value)
-                        if len(afilter_list):
-                            if attr not in afilter_list:
-                                continue
-
-                        if value[0] == '<':
-                            try:
-                                #Adding this below If condition as part of CEM-11076
-                                if len(value) >= 100000:
-                                    more_than_100k += 1
-                                    #Finding the sub_type of UVE
-                                    start = value.find("<") + len("<")
-                                    end = value.find(" ")
-                                    sub_uve = value[start:end]
-                                    self._logger.error("Dropping large UVE, from source %s and type %s and sub_type %s" \
-                                        % (str(dsource), str(typ), str(sub_uve)))
-                                    self._logger.debug("Count of UVE being dropped is %s" %str(more_than_100k))
-                                    continue
-                                snhdict = xmltodict.parse(value)
-                            except:
-                                self._logger.error("xml parsing failed key %s, struct %s: %s" \
-                                    % (key, typ, str(value)))
-                                continue
-
-                            if snhdict[attr]['@type'] == 'list':
-                                sname = ParallelAggregator.get_list_name(
-                                        snhdict[attr])
-                                if snhdict[attr]['list']['@size'] == '0':
-                                    continue
-                                elif snhdict[attr]['list']['@size'] == '1':
-                                    if not isinstance(
-                                        snhdict[attr]['list'][sname], list):
-                                        snhdict[attr]['list'][sname] = [
-                                            snhdict[attr]['list'][sname]]
-                                if typ == 'UVEAlarms' and attr == 'alarms' and \
-                                        ackfilter is not None:
-                                    alarms = []
-                                    for alarm in snhdict[attr]['list'][sname]:
-                                        ack_attr = alarm.get('ack')
-                                        if ack_attr:
-                                            ack = ack_attr['#text']
-                                        else:
-                                            ack = 'false'
-                                        if ack == ackfilter:
-                                            alarms.append(alarm)
-                                    if not len(alarms):
-                                        del_uvealarms = True
-                                        continue
-                                    snhdict[attr]['list'][sname] = alarms
-                                    snhdict[attr]['list']['@size'] = \
-                                        str(len(alarms))
-                        else:
-                            continue
-
-                        # print "Attr %s Value %s" % (attr, snhdict)
-                        if typ not in state[key]:
-                            state[key][typ] = {}
-                        if attr not in state[key][typ]:
-                            state[key][typ][attr] = {}
-                        if dsource in state[key][typ][attr]:
-                            self._logger.debug(\
-                            "Found Dup %s:%s:%s:%s:%s = %s" % \
-                                (key, typ, attr, source, mdule, state[
-                                key][typ][attr][dsource]))
-                        # To timestamp, we only keep latest source
-                        if attr == '__T' and flat:
-                            if len(state[key][typ][attr]) > 0:
-                                if list(state[key][typ][attr].values())[0]['#text'] > snhdict[attr]['#text']:
-                                    continue
-                                else:
-                                    state[key][typ][attr].clear()
-                        state[key][typ][attr][dsource] = snhdict[attr]
-                    if del_uvealarms and 'UVEAlarms' in state[key]:
-                        del state[key]['UVEAlarms']
+                self._fill_state(state, key, origins, odictlist, flat, filters)
 
                 pa = ParallelAggregator(state, self._uve_reverse_map)
                 rsp = pa.aggregate(key, flat, base_url)
@@ -411,6 +303,231 @@ class UVEServer(object):
         return failures, rsp
     # end get_uve
 
+    def get_uves(self, keys, flat, base_url=None, fprints=None):
+        """
+        Read several UVEs. Unlike calling get_uve for each of them, the
+        reads of all the UVEs are sent together, in two pipelines per
+        collector redis.
+        Args:
+            keys : dict, where the key is the UVE key and the value is
+                   the filters for that UVE, as for get_uve
+            fprints : if given, a dict that is filled with a fingerprint
+                   of the contents read for each struct of each UVE,
+                   keyed by UVE key and struct type. If the fingerprint
+                   of a struct has not changed, neither has the struct.
+        Returns:
+            dict, where the key is the UVE key and the value is the
+            (failures, UVE) tuple that get_uve would have returned
+        """
+        uves = {}
+        state = {}
+        failures = set()
+        for key, filters in keys.items():
+            filters = filters or {}
+            if flat and not filters.get('sfilt') and \
+                    not filters.get('mfilt') and self._usecache:
+                uves[key] = self._uvedbcache.get_uve(key, filters)
+            else:
+                state[key] = {}
+                if fprints is not None:
+                    fprints[key] = {}
+        rkeys = list(state.keys())
+        if not rkeys:
+            return uves
+
+        for r_key, r_inst in self._redis_uve_map.items():
+            if r_inst.redis_handle is None or r_inst.collector_pid is None:
+                continue
+            else:
+                redish = r_inst.redis_handle
+            try:
+                ppe = redish.pipeline()
+                ncmds = []
+                for key in rkeys:
+                    ncmds.append(self._read_origins(ppe, key, keys[key] or {}))
+                pperes = ppe.execute()
+
+                korigins = []
+                ppeval = redish.pipeline()
+                idx = 0
+                for key, ncmd in zip(rkeys, ncmds):
+                    origins = self._filter_origins(pperes[idx:idx + ncmd],
+                                                   keys[key] or {})
+                    idx += ncmd
+                    korigins.append(origins)
+                    for origs in origins:
+                        ppeval.hgetall("VALUES:" + key + ":" + origs)
+                odictlist = ppeval.execute()
+
+                idx = 0
+                for key, origins in zip(rkeys, korigins):
+                    self._fill_state(state, key, origins,
+                        odictlist[idx:idx + len(origins)], flat,
+                        keys[key] or {},
+                        fprints[key] if fprints is not None else None)
+                    idx += len(origins)
+            except Exception as e:
+                self._logger.error("redis-uve failed %s for %d keys: (%s,%s) tb %s" \
+                               % (str(e), len(rkeys), str(r_key),
+                                  str(r_inst.collector_pid),
+                                  traceback.format_exc()))
+                failures.update(rkeys)
+
+        pa = ParallelAggregator(state, self._uve_reverse_map)
+        for key in rkeys:
+            try:
+                rsp = pa.aggregate(key, flat, base_url)
+            except Exception as e:
+                self._logger.error("uve aggregation failed %s for key %s tb %s" \
+                               % (str(e), key, traceback.format_exc()))
+                uves[key] = (True, {})
+            else:
+                uves[key] = (key in failures, rsp)
+        return uves
+    # end get_uves
+
+    def _read_origins(self, ppe, key, filters):
+        # Add the reads of the origins of the UVE to the pipeline,
+        # and return the number of reads added
+        ppe.smembers("ALARM_ORIGINS:" + key)
+        if filters.get('cfilt') == "UVEAlarms":
+            return 1
+        ppe.smembers("ORIGINS:" + key)
+        return 2
+
+    def _filter_origins(self, pperes, filters):
+        sfilter = filters.get('sfilt')
+        mfilter = filters.get('mfilt')
+        tfilter = filters.get('cfilt')
+        # Keep the origins in the order read, without duplicates
+        origins = OrderedDict()
+        for origset in pperes:
+            for smt in origset:
+                smt = convert_to_string(smt)
+                tt = smt.rsplit(":",1)[1]
+                sm = smt.rsplit(":",1)[0]
+                source = sm.split(":", 1)[0]
+                mdule = sm.split(":", 1)[1]
+                if tfilter is not None:
+                    if tt not in tfilter:
+                        continue
+                if sfilter is not None:
+                    if sfilter != source:
+                        continue
+                if mfilter is not None:
+                    if mfilter != mdule:
+                        continue
+                origins[smt] = None
+        return list(origins)
+
+    def _fill_state(self, state, key, origins, odictlist, flat, filters,
+                    fprints=None):
+        # Add the UVE structs read from one collector redis to the state
+        # to be aggregated, and the hashes of the values read to the
+        # fingerprints of the structs
+        global more_than_100k
+        tfilter = filters.get('cfilt')
+        ackfilter = filters.get('ackfilt')
+
+        idx = 0
+        for origs in origins:
+
+            odict = odictlist[idx]
+            idx = idx + 1
+
+            info = origs.rsplit(":", 1)
+            dsource = info[0]
+            typ = info[1]
+
+            afilter_list = set()
+            if tfilter is not None:
+                afilter_list = tfilter[typ]
+
+            del_uvealarms = False
+            for attr, value in odict.items():
+                attr = convert_to_string(attr)
+                value = convert_to_string(value)
+                if len(afilter_list):
+                    if attr not in afilter_list:
+                        continue
+                if fprints is not None:
+                    vhash = int.from_bytes(hashlib.md5(('%s\0%s\0%s' % \
+                        (dsource, attr, value)).encode()).digest()[:8],
+                        'little')
+                    fprints[typ] = (fprints.get(typ, 0) + vhash) & \
+                        _FPRINT_MASK
+
+                if value[0] == '<':
+                    try:
+                        #Adding this below If condition as part of CEM-11076
+                        if len(value) >= 100000:
+                            more_than_100k += 1
+                            #Finding the sub_type of UVE
+                            start = value.find("<") + len("<")
+                            end = value.find(" ")
+                            sub_uve = value[start:end]
+                            self._logger.error("Dropping large UVE, from source %s and type %s and sub_type %s" \
+                                % (str(dsource), str(typ), str(sub_uve)))
+                            self._logger.debug("Count of UVE being dropped is %s" %str(more_than_100k))
+                            continue
+                        snhdict = xmltodict.parse(value)
+                    except:
+                        self._logger.error("xml parsing failed key %s, struct %s: %s" \
+                            % (key, typ, str(value)))
+                        continue
+
+                    if snhdict[attr]['@type'] == 'list':
+                        sname = ParallelAggregator.get_list_name(
+                                snhdict[attr])
+                        if snhdict[attr]['list']['@size'] == '0':
+                            continue
+                        elif snhdict[attr]['list']['@size'] == '1':
+                            if not isinstance(
+                                snhdict[attr]['list'][sname], list):
+                                snhdict[attr]['list'][sname] = [
+                                    snhdict[attr]['list'][sname]]
+                        if typ == 'UVEAlarms' and attr == 'alarms' and \
+                                ackfilter is not None:
+                            alarms = []
+                            for alarm in snhdict[attr]['list'][sname]:
+                                ack_attr = alarm.get('ack')
+                                if ack_attr:
+                                    ack = ack_attr['#text']
+                                else:
+                                    ack = 'false'
+                                if ack == ackfilter:
+                                    alarms.append(alarm)
+                            if not len(alarms):
+                                del_uvealarms = True
+                                continue
+                            snhdict[attr]['list'][sname] = alarms
+                            snhdict[attr]['list']['@size'] = \
+                                str(len(alarms))
+                else:
+                    continue
+
+                # print "Attr %s Value %s" % (attr, snhdict)
+                if typ not in state[key]:
+                    state[key][typ] = {}
+                if attr not in state[key][typ]:
+                    state[key][typ][attr] = {}
+                if dsource in state[key][typ][attr]:
+                    self._logger.debug(\
+                    "Found Dup %s:%s:%s:%s = %s" % \
+                        (key, typ, attr, dsource, state[
+                        key][typ][attr][dsource]))
+                # To timestamp, we only keep latest source
+                if attr == '__T' and flat:
+                    if len(state[key][typ][attr]) > 0:
+                        if list(state[key][typ][attr].values())[0]['#text'] > snhdict[attr]['#text']:
+                            continue
+                        else:
+                            state[key][typ][attr].clear()
+                state[key][typ][attr][dsource] = snhdict[attr]
+            if del_uvealarms and 'UVEAlarms' in state[key]:
+                del state[key]['UVEAlarms']
+    # end _fill_state
+
     def get_uve_regex(self, key):
         regex = ''
         if key[0] != '*':
@@ -9,25 +9,30 @@ monkey.patch_all()
 import gevent
 import time
 import json
+import zlib
 import signal
 import socket
 import copy
 import logging
 import mock
 import unittest
+import redis
 import collections
-from .utils.util import retry
-from collections import namedtuple
+from .utils.util import retry, find_buildroot
+from .utils.analytics_fixture import Redis
+from collections import namedtuple, OrderedDict
 from kafka.consumer.fetcher import ConsumerRecord
 
 import sys
 import os
+import shutil
+import tempfile
 import cfgm_common.tests
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(cfgm_common.tests.__file__), "./mocked_libs")))
 
 from vnc_api.gen.resource_client import Alarm
 from vnc_api.gen.resource_xsd import AlarmExpression, AlarmOperand2, \
-    AlarmAndList, AlarmOrList, UveKeysType
+    AlarmAndList, AlarmOrList, UveKeysType, IdPermsType
 from pysandesh.util import UTCTimestampUsec
 from pysandesh.gen_py.sandesh_alarm.ttypes import SandeshAlarmAckRequest, \
     SandeshAlarmAckResponseCode
@@ -39,10 +44,15 @@ from opserver.sandesh.alarmgen_ctrl.ttypes import UVEAlarmOperState, \
     UVEAlarmStateMachineInfo, UVEAlarmState
 from opserver.uveserver import UVEServer, RedisInfo
 from opserver.partition_handler import PartitionHandler, UveStreamProc, \
-    UveStreamer, UveStreamPart, PartInfo
-from opserver.alarmgen import Controller, AlarmStateMachine, AlarmProcessor
+    UveStreamer, UveStreamPart, PartInfo, UvePartFeed, UvePartFeeds, sse_pack, \
+    uve_merge_patch, UveWatch
+from opserver.alarmgen import Controller, AlarmStateMachine, AlarmProcessor, \
+    OutputRow, AGTabStats, AGKeyInfo
+from opserver.strict_redis_wrapper import StrictRedisWrapper
 from opserver.alarmgen_cfg import CfgParser
+from opserver.opserver_util import LatencyHistogram
 from opserver.plugins.alarm_base import AlarmBase
+from opserver.alarm_rules import AlarmRuleEvaluator
 from gevent import signal_handler as gevent_signal
 
 logging.basicConfig(level=logging.DEBUG,
@@ -121,26 +131,29 @@ class Mock_get_part(Mock_base):
     def __init__(self, *args, **kwargs):
         Mock_base.__init__(self, *args, **kwargs)
 
-    def __call__(self, part, r_inst):
+    def __call__(self, part, r_inst, batch_cb=None):
         key = (part, r_inst)
         if key not in self.store:
             return {}
+        if batch_cb is not None:
+            batch_cb(*self.store[key])
         return self.store[key]
 
-class Mock_get_uve(Mock_base):
+class Mock_get_uves(Mock_base):
     def __init__(self, *args, **kwargs):
         Mock_base.__init__(self, *args, **kwargs)
 
-    def __call__(self, key, flat, filters):
-        if key not in self.store:
-            return False, {}
-        return False, self.store[key]
+    def __call__(self, keys, flat, fprints=None):
+        ret = {}
+        for key in keys:
+            ret[key] = (False, self.store.get(key, {}))
+        return ret
 
 class Mock_poll(Mock_base):
     def __init__(self, *args, **kwargs):
         Mock_base.__init__(self)
 
-    def __call__(self, max_records=None):
+    def __call__(self, timeout_ms=0, max_records=None):
         vals = []
         for key in list(self.store.keys()):
             vals.append(self.store[key])
@@ -148,6 +161,7 @@ class Mock_poll(Mock_base):
         if len(vals):
             return {None:vals}
         else:
+            gevent.sleep(timeout_ms / 1000.0)
             return {}
 
 class Mock_agp(Mock_base):
@@ -161,7 +175,8 @@ class Mock_agp(Mock_base):
 
 class Mock_usp(object):
     def __init__(self, partno, logger, cb, pi, rpass, redis_ssl_params, content,\
-            tablefilt, cfilter, patterns, token=None):
+            tablefilt, cfilter, patterns, token=None, feeds=None, since=None,
+            pcb=None):
         self._cb = cb
         self._partno = partno
         self._pi = pi
@@ -181,6 +196,14 @@ class Mock_usp(object):
                     value = {}
             self._cb(self._partno, self._pi, key, type, value)
 
+# PartInfo of a partition in the local redis
+mock_pi = PartInfo(ip_address=socket.getfqdn("127.0.0.1"),
+                   acq_time=666,
+                   redis_ip="127.0.0.1",
+                   redis_agg_db=0,
+                   instance_id="0",
+                   port=6379)
+
 # Tests for UveStreamer and UveCache
 class TestUveStreamer(unittest.TestCase, TestChecker):
     @classmethod
@@ -264,6 +287,791 @@ class TestUveStreamer(unittest.TestCase, TestChecker):
                 set(),
                 self.ustr._uvedbcache._partkeys[0]))
 
+    #@unittest.skip('Skipping UveStreamer')
+    def test_01_agp_changed(self):
+        mock_agp = Mock_agp()
+        ustr = UveStreamer(logging, None, None, mock_agp, None,\
+                None, None, None, None, Mock_usp, agp_poll=None)
+        ustr.start()
+        try:
+            mock_agp[2] = self.mock_agp[0]
+            # Without a notification, ownership is not read again
+            gevent.sleep(1.5)
+            self.assertNotIn(2, ustr._parts)
+            ustr.agp_changed()
+            self.assertTrue(self.checker_dict([2], ustr._parts))
+        finally:
+            ustr.kill()
+
+
+# Tests for the changelog used to resume UVE streams
+class TestUvePartFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.pi = mock_pi
+        self.feed = UvePartFeed(0, self.pi, logging, None, {}, 3)
+        self.feed._ready.set()
+        self.feed.resync()
+
+    def test_00_changes(self):
+        start = self.feed.position()
+        self.assertEqual(self.feed.changes(start), [])
+        sub = gevent.queue.Queue()
+        self.feed.subscribe(sub)
+        self.feed.record([{"key":"ObjectXX:uve1", "type":"type1"}])
+        self.feed.record([{"key":"ObjectXX:uve2", "type":"type1"}])
+        self.assertEqual(sub.qsize(), 2)
+        self.assertEqual(self.feed.changes(start + 1),
+            [(start + 2, [{"key":"ObjectXX:uve2", "type":"type1"}])])
+        self.assertEqual(len(self.feed.changes(start)), 2)
+        # positions that were never handed out
+        self.assertIsNone(self.feed.changes(start + 3))
+        self.assertIsNone(self.feed.changes(start - 1))
+
+    def test_01_evicted(self):
+        start = self.feed.position()
+        for idx in range(4):
+            self.feed.record([{"key":"ObjectXX:uve%d" % idx, "type":"type1"}])
+        self.assertIsNone(self.feed.changes(start))
+        self.assertEqual(len(self.feed.changes(start + 1)), 3)
+
+    def test_02_resync(self):
+        sub = gevent.queue.Queue()
+        self.feed.subscribe(sub)
+        self.feed.record([{"key":"ObjectXX:uve1", "type":"type1"}])
+        pos = self.feed.position()
+        self.feed.resync()
+        self.assertIsNone(self.feed.changes(pos))
+        self.assertEqual(self.feed.changes(self.feed.position()), [])
+        sub.get()
+        self.assertEqual(sub.get(), (self.feed.position(), None))
+
+    def test_03_gap(self):
+        sub = gevent.queue.Queue()
+        self.feed.subscribe(sub)
+        for seq in [7, 8, 10]:
+            elems = [{"key":"ObjectXX:uve1", "type":"type1", "seq":seq}]
+            self.feed.check_seq(elems)
+            self.feed.record(elems)
+        items = [sub.get() for idx in range(4)]
+        self.assertEqual([elems is None for seq, elems in items],
+            [False, False, True, False])
+
+    def test_04_event_id(self):
+        feeds = UvePartFeeds(logging, None, {})
+        cursor = {0:12, 3:7}
+        event_id = feeds.event_id(cursor)
+        self.assertEqual(feeds.parse_event_id(event_id), cursor)
+        self.assertIsNone(UvePartFeeds(logging, None, {}).\
+            parse_event_id(event_id))
+        self.assertIsNone(feeds.parse_event_id("garbage"))
+        self.assertEqual(sse_pack({'id': event_id, 'event': 'update',
+            'data': '{}'}), 'id: %s\nevent: update\ndata: {}\n\n' % event_id)
+
+    def test_05_feed_refs(self):
+        feeds = UvePartFeeds(logging, None, {}, linger=0.1)
+        with mock.patch.object(UvePartFeed, 'start'), \
+                mock.patch.object(UvePartFeed, 'kill') as kill:
+            feed = feeds.get(0, self.pi)
+            feed.resync()
+            self.assertIs(feeds.get(0, self.pi), feed)
+            feeds.put(0, feed)
+            gevent.sleep(0.2)
+            kill.assert_not_called()
+            # a feed put back by its last user is kept for a while
+            feeds.put(0, feed)
+            gevent.sleep(0.05)
+            self.assertIs(feeds.get(0, self.pi), feed)
+            gevent.sleep(0.2)
+            kill.assert_not_called()
+            feeds.put(0, feed)
+            gevent.sleep(0.2)
+            kill.assert_called_once_with()
+            self.assertEqual(feeds._feeds, {})
+
+            # a new feed of the partition does not reuse positions
+            pos = feed.position()
+            feed = feeds.get(0, self.pi)
+            self.assertEqual(feed.position(), pos)
+            feed._ready.set()
+            feed.resync()
+            self.assertIsNone(feed.changes(pos))
+
+            # the feed of a partition that moved is stopped
+            kill.reset_mock()
+            feeds.update_agp({0: self.pi})
+            kill.assert_not_called()
+            feeds.update_agp({0: self.pi._replace(acq_time=777)})
+            kill.assert_called_once_with()
+            self.assertEqual(feeds._feeds, {})
+            feeds.put(0, feed)
+            self.assertEqual(feeds._idle, {})
+
+    def test_06_position_at(self):
+        start = self.feed.position()
+        # the sequence number of alarmgen at subscription is not known
+        self.assertIsNone(self.feed.position_at(3))
+        self.feed._base = 3
+        self.assertEqual(self.feed.position_at(3), start)
+        self.assertIsNone(self.feed.position_at(2))
+        for seq in [4, 5]:
+            self.feed.record([{"key":"ObjectXX:uve1", "type":"type1",
+                               "seq":seq}])
+        self.assertEqual(self.feed.position_at(3), start)
+        self.assertEqual(self.feed.position_at(4), start + 1)
+        self.assertEqual(self.feed.position_at(5), start + 2)
+        self.assertEqual(self.feed.position_at(9), start + 2)
+        # the messages after 3 are no longer all in the changelog
+        for seq in [6, 7]:
+            self.feed.record([{"key":"ObjectXX:uve1", "type":"type1",
+                               "seq":seq}])
+        self.assertIsNone(self.feed.position_at(3))
+        self.assertEqual(self.feed.position_at(4), start + 1)
+        # messages without a sequence number
+        self.feed.record([{"key":"ObjectXX:uve1", "type":"type1"}])
+        self.assertIsNone(self.feed.position_at(6))
+
+
+# Tests for the long-poll watch of UVE keys
+class TestUveWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.pi = mock_pi
+        self.feeds = UvePartFeeds(logging, None, {})
+        self.feed = UvePartFeed(0, self.pi, logging, None, {}, 10)
+        self.feed._ready.set()
+        self.feed.resync()
+        self.feeds._feeds[0] = self.feed
+        self.watch = UveWatch(self.feeds, {0: self.pi}, ["ObjectXX"])
+
+    def test_00_no_version(self):
+        cursor, changed = self.watch.wait(None, 1)
+        self.assertEqual(cursor, {0: self.feed.position()})
+        self.assertIsNone(changed)
+
+    def test_01_changed(self):
+        since = {0: self.feed.position()}
+        self.feed.record([{"key":"ObjectYY:uve1", "type":"type1"}])
+        gevent.spawn_later(0.2, self.feed.record,
+            [{"key":"ObjectXX:uve1", "type":"type1"},
+             {"key":"ObjectXX:uve2", "type":None}])
+        cursor, changed = self.watch.wait(since, 5)
+        self.assertEqual(changed, set(["ObjectXX:uve1", "ObjectXX:uve2"]))
+        self.assertEqual(cursor, {0: self.feed.position()})
+
+    def test_02_timeout(self):
+        since = {0: self.feed.position()}
+        self.feed.record([{"key":"ObjectYY:uve1", "type":"type1"}])
+        cursor, changed = self.watch.wait(since, 0.5)
+        self.assertEqual(changed, set())
+        self.assertEqual(cursor, {0: self.feed.position()})
+        # changes no longer in the changelog
+        self.feed.resync()
+        cursor, changed = self.watch.wait(since, 0.5)
+        self.assertIsNone(changed)
+
+
+# Tests for the delta mode of UVE streams
+class TestUveStreamDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.q = gevent.queue.Queue()
+        self.ustr = UveStreamer(logging, self.q, None, None, None, {},
+                delta=True)
+        self.pi = mock_pi
+
+    def get_update(self):
+        lines = self.q.get().splitlines()
+        return json.loads(lines[2].split(': ', 1)[1])
+
+    def test_00_merge_patch(self):
+        old = {"a": 1, "b": {"c": 2, "d": 3}, "e": [1, 2]}
+        new = {"a": 1, "b": {"c": 4, "d": 3}, "f": "x"}
+        self.assertEqual(uve_merge_patch(old, new),
+            {"b": {"c": 4}, "e": None, "f": "x"})
+        self.assertEqual(uve_merge_patch(old, old), {})
+        # null attributes cannot be expressed by a merge patch
+        self.assertIsNone(uve_merge_patch(old, {"a": None}))
+        self.assertIsNone(uve_merge_patch(old, {"g": {"h": None}}))
+
+    def test_01_delta_stream(self):
+        self.ustr.partition_callback(0, self.pi, "ObjectXX:uve1", "type1",
+            {"x": 1, "y": 2})
+        self.assertEqual(self.get_update(), {"key": "ObjectXX:uve1",
+            "type": "type1", "value": {"x": 1, "y": 2}})
+        self.ustr.partition_callback(0, self.pi, "ObjectXX:uve1", "type1",
+            {"x": 3, "y": 2})
+        self.assertEqual(self.get_update(), {"key": "ObjectXX:uve1",
+            "type": "type1", "delta": {"x": 3}})
+        for idx in range(UveStreamer.DELTA_FULL_INTERVAL - 1):
+            self.ustr.partition_callback(0, self.pi, "ObjectXX:uve1", "type1",
+                {"x": idx, "y": 2})
+            self.assertIn("delta", self.get_update())
+        # periodic full value
+        self.ustr.partition_callback(0, self.pi, "ObjectXX:uve1", "type1",
+            {"x": 1, "y": 2})
+        self.assertIn("value", self.get_update())
+        # a deleted UVE is sent in full when it comes back
+        self.ustr.partition_callback(0, self.pi, "ObjectXX:uve1", None, None)
+        self.assertEqual(self.get_update(), {"key": "ObjectXX:uve1",
+            "type": None})
+        self.ustr.partition_callback(0, self.pi, "ObjectXX:uve1", "type1",
+            {"x": 1, "y": 2})
+        self.assertIn("value", self.get_update())
+
+
+# Tests for the batched reads of the initial sync of UVE streams
+class TestUveStreamSync(unittest.TestCase):
+
+    def test_00_sscan_batches(self):
+        redish = StrictRedisWrapper()
+        with mock.patch.object(redish, 'sscan', side_effect=[
+                (7, ['a', 'b']), (3, []), (0, ['c'])]):
+            self.assertEqual(list(redish.sscan_batches('x', 2)),
+                [['a', 'b'], ['c']])
+        # Redis without SSCAN
+        with mock.patch.object(redish, 'sscan',
+                side_effect=redis.exceptions.ResponseError()), \
+             mock.patch.object(redish, 'smembers',
+                return_value=set(['a', 'b', 'c'])):
+            self.assertEqual(sorted(sum(redish.sscan_batches('x', 2), [])),
+                ['a', 'b', 'c'])
+            self.assertEqual(len(list(redish.sscan_batches('x', 2))), 2)
+
+    def test_01_snapshot(self):
+        pi = mock_pi
+        updates = []
+        def cb(partno, pi, key, typ, value):
+            updates.append((key, typ, value))
+        usp = UveStreamPart(0, logging, cb, pi, None, {})
+        feed = UvePartFeed(0, pi, logging, None, {}, 10)
+        feed._ready.set()
+        feed.resync()
+        feed._base = 4
+        # uve2 changed after the snapshot was started, uve3 was added
+        for seq, key in [(5, "ObjectXX:uve1"), (6, "ObjectXX:uve2"),
+                         (7, "ObjectXX:uve3")]:
+            feed.record([{"key":key, "type":"type1", "seq":seq}])
+        head = json.dumps({"acq_time": 666, "seq": 5, "gen": 9,
+                           "chunks": 2, "prev": []})
+        chunks = [zlib.compress(json.dumps({
+            "ObjectXX:uve%d" % idx: {"type1": json.dumps({"x": idx})}}
+            ).encode()) for idx in [1, 2]]
+        redish = mock.MagicMock()
+        redish.get.side_effect = [head] + chunks
+        redish.pipeline.return_value.execute.side_effect = [
+            [json.dumps({"x": 3})], [json.dumps({"x": 4})]]
+        usp.resync(redish, feed, feed.position())
+        self.assertEqual([args[0][0] for args in redish.get.call_args_list],
+            ["AGPARTSNAP:0:0", "AGPARTSNAP:0:0:9:0", "AGPARTSNAP:0:0:9:1"])
+        self.assertFalse(redish.sscan_batches.called)
+        self.assertEqual(updates, [
+            ("ObjectXX:uve1", "type1", {"x": 1}),
+            ("ObjectXX:uve2", "type1", {"x": 2}),
+            ("ObjectXX:uve2", "type1", {"x": 3}),
+            ("ObjectXX:uve3", "type1", {"x": 4})])
+        self.assertEqual(usp._since, feed.position())
+
+        # a chunk replaced while the snapshot is read
+        updates[:] = []
+        redish.get.side_effect = [head, chunks[0], None]
+        redish.pipeline.return_value.execute.side_effect = [
+            [json.dumps({"x": 3})], [json.dumps({"x": 4})]]
+        with mock.patch.object(usp, 'syncpart') as syncpart:
+            usp.resync(redish, feed, feed.position())
+            syncpart.assert_called_once_with(redish)
+        self.assertEqual(updates, [
+            ("ObjectXX:uve1", "type1", {"x": 1}),
+            ("ObjectXX:uve2", "type1", {"x": 3}),
+            ("ObjectXX:uve3", "type1", {"x": 4})])
+
+        # the updates since the snapshot are not all in the changelog
+        feed._base = 6
+        updates[:] = []
+        redish.get.side_effect = [head]
+        with mock.patch.object(usp, 'syncpart') as syncpart:
+            usp.resync(redish, feed, feed.position())
+            syncpart.assert_called_once_with(redish)
+        self.assertEqual(updates, [])
+        self.assertEqual(usp._since, feed.position())
+
+        # snapshot of an older ownership of the partition
+        feed._base = 4
+        redish.get.side_effect = [head]
+        usp._pi = pi._replace(acq_time=667)
+        with mock.patch.object(usp, 'syncpart') as syncpart:
+            usp.resync(redish, feed, feed.position())
+            syncpart.assert_called_once_with(redish)
+        self.assertEqual(updates, [])
+
+    def test_02_syncpart_batches(self):
+        pi = mock_pi
+        events = []
+        def cb(partno, pi, key, typ, value):
+            events.append(key)
+        usp = UveStreamPart(0, logging, cb, pi, None, {})
+        # SSCAN may return more keys than asked for
+        sizes = [usp.SYNC_BATCH, 2 * usp.SYNC_BATCH + 1, 3]
+        batches = []
+        for size in sizes:
+            start = sum(len(batch) for batch in batches)
+            batches.append(["ObjectXX:uve%d" % idx \
+                for idx in range(start, start + size)])
+        redish = mock.MagicMock()
+        redish.sscan_batches.return_value = iter(batches)
+        pipes = []
+        def pipeline(*args, **kwargs):
+            ppe = mock.MagicMock()
+            ppe.execute.side_effect = lambda: \
+                [{"type1": json.dumps({"x": 1})}] * ppe.hgetall.call_count
+            pipes.append(ppe)
+            return ppe
+        redish.pipeline.side_effect = pipeline
+        with mock.patch.object(gevent, 'sleep',
+                side_effect=lambda *args: events.append(None)):
+            usp.syncpart(redish)
+        redish.sscan_batches.assert_called_once_with("AGPARTKEYS:0:0",
+                                                     usp.SYNC_BATCH)
+        self.assertEqual([ppe.hgetall.call_count for ppe in pipes],
+            [usp.SYNC_BATCH, usp.SYNC_BATCH, usp.SYNC_BATCH, 1, 3])
+        # each batch is reported, with a yield, before the next one
+        expected = []
+        for ppe in pipes:
+            expected += [args[0][0].split(':', 3)[3] \
+                for args in ppe.hgetall.call_args_list]
+            expected.append(None)
+        self.assertEqual(events, expected)
+
+
+
+# Tests for the updates of UVE streams
+class TestUveStreamUpdate(unittest.TestCase):
+
+    def test_00_inline_values(self):
+        pi = mock_pi
+        updates = []
+        def cb(partno, pi, key, typ, value):
+            updates.append((key, typ, value))
+        usp = UveStreamPart(0, logging, cb, pi, None, {})
+        redish = mock.MagicMock()
+        redish.pipeline.return_value.execute.return_value = \
+            [json.dumps({"x": 2})]
+        usp.handle_update(redish, 1, [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": {"x": 1}},
+            {"key": "ObjectXX:uve1", "type": "type2"},
+            {"key": "ObjectXX:uve2", "type": None}])
+        redish.pipeline.return_value.hget.assert_called_once_with(
+            "AGPARTVALUES:0:0:ObjectXX:uve1", "type2")
+        self.assertEqual(updates, [
+            ("ObjectXX:uve1", "type1", {"x": 1}),
+            ("ObjectXX:uve1", "type2", {"x": 2}),
+            ("ObjectXX:uve2", None, None)])
+        # all values inline, no read back
+        redish.reset_mock()
+        usp.handle_update(redish, 2, [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": None}])
+        self.assertFalse(redish.pipeline.return_value.execute.called)
+        self.assertEqual(updates[-1], ("ObjectXX:uve1", "type1", None))
+
+    def test_01_resume_position(self):
+        pi = mock_pi
+        q = gevent.queue.Queue()
+        feeds = UvePartFeeds(logging, None, {})
+        feed = UvePartFeed(0, pi, logging, None, {}, 10)
+        feed._ready.set()
+        feed.resync()
+        feeds._feeds[0] = feed
+        ustr = UveStreamer(logging, q, None, None, None, {}, feeds=feeds)
+        usp = UveStreamPart(0, logging, ustr.partition_callback, pi, None,
+            {}, feeds=feeds, pcb=ustr.position_callback)
+        redish = mock.MagicMock()
+        redish.get.return_value = None
+        usp.resync(redish, feed, feed.position())
+        elems = [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": {"x": 1}},
+            {"key": "ObjectXX:uve2", "type": "type1", "value": {"x": 2}}]
+        feed.record(elems)
+        usp.handle_update(redish, feed.position(), elems)
+        ids = [q.get().splitlines()[0].split(': ', 1)[1] for elem in elems]
+        # a stream resumed from the last event does not get the
+        # update again, nor one resumed from an earlier event miss it
+        since = feeds.parse_event_id(ids[-1])
+        self.assertEqual(since, {0: feed.position()})
+        self.assertEqual(feed.changes(since[0]), [])
+        since = feeds.parse_event_id(ids[0])
+        self.assertEqual([seq for seq, lelems in feed.changes(since[0])],
+                         [feed.position()])
+
+
+# Tests for the batch mode of UVE streams
+class TestUveStreamBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.q = gevent.queue.Queue()
+        self.pi = mock_pi
+
+    def get_updates(self):
+        lines = self.q.get().splitlines()
+        self.assertEqual(lines[1], 'event: updates')
+        return json.loads(lines[2].split(': ', 1)[1])
+
+    def test_00_interval(self):
+        ustr = UveStreamer(logging, self.q, None, None, None, {},
+                batch_interval=0.2)
+        ustr.partition_callback(0, self.pi, "ObjectXX:uve1", "type1", {"x":1})
+        ustr.partition_callback(0, self.pi, "ObjectXX:uve2", "type1", {"x":2})
+        self.assertTrue(self.q.empty())
+        gevent.sleep(0.5)
+        self.assertEqual(self.get_updates(), [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": {"x": 1}},
+            {"key": "ObjectXX:uve2", "type": "type1", "value": {"x": 2}}])
+        self.assertTrue(self.q.empty())
+
+    def test_01_size(self):
+        ustr = UveStreamer(logging, self.q, None, None, None, {},
+                batch_interval=60, batch_size=100)
+        for idx in range(3):
+            ustr.partition_callback(0, self.pi, "ObjectXX:uve%d" % idx,
+                "type1", {"x": "y" * 40})
+        self.assertEqual(len(self.get_updates()), 2)
+        self.assertTrue(self.q.empty())
+        ustr._flush_batch()
+        self.assertEqual(len(self.get_updates()), 1)
+
+
+# Tests for the permission check of non-admin UVE streams
+class TestUveStreamPerm(unittest.TestCase):
+
+    def setUp(self):
+        pi = mock_pi
+        token = {'is_global_read_only_role': False,
+                 'token_info': {'token': {}}}
+        self.usp = UveStreamPart(0, logging, None, pi, None, {},
+                token=token)
+
+    def test_00_cached_decision(self):
+        uves = {"ContrailConfig": json.dumps({"elements": {}}),
+                "type1": json.dumps({"x": 1})}
+        with mock.patch.object(self.usp, '_is_uve_read_permitted',
+                return_value=True) as perm:
+            self.assertTrue(self.usp.is_uve_read_permitted(uves, "X:uve1"))
+            uves["type1"] = json.dumps({"x": 2})
+            self.assertTrue(self.usp.is_uve_read_permitted(uves, "X:uve1"))
+            self.assertEqual(perm.call_count, 1)
+            # ContrailConfig changed
+            uves["ContrailConfig"] = json.dumps({"elements": {"a": 1}})
+            perm.return_value = False
+            self.assertFalse(self.usp.is_uve_read_permitted(uves, "X:uve1"))
+            self.assertFalse(self.usp.is_uve_read_permitted(uves, "X:uve1"))
+            self.assertEqual(perm.call_count, 2)
+
+
+# Tests for the change detection of UVE contents
+class TestPartitionBacklog(unittest.TestCase):
+
+    def test_00_pause_resume(self):
+        backlog = {1: 0}
+        ph = UveStreamProc('127.0.0.1:9092', 1, 'uve-1', logging, None,
+                           '127.0.0.1', None, '0', 6379, False, {},
+                           backlog_cb=backlog.get, backlog_limit=100)
+        consumer = mock.MagicMock()
+        ph.backlog_check(consumer, 'tp')
+        self.assertFalse(ph.paused())
+        backlog[1] = 101
+        ph.backlog_check(consumer, 'tp')
+        self.assertTrue(ph.paused())
+        consumer.pause.assert_called_once_with('tp')
+        # resumed only when down to half the limit
+        backlog[1] = 60
+        ph.backlog_check(consumer, 'tp')
+        self.assertTrue(ph.paused())
+        backlog[1] = 50
+        ph.backlog_check(consumer, 'tp')
+        self.assertFalse(ph.paused())
+        consumer.resume.assert_called_once_with('tp')
+    # end test_00_pause_resume
+
+    def test_01_batch_handler(self):
+        calls = []
+        ph = UveStreamProc('127.0.0.1:9092', 1, 'uve-1', logging,
+                           lambda part, chg: calls.append((part, chg)),
+                           '127.0.0.1', None, '0', 6379, False, {})
+        ph._uvedb['coll1'] = {}
+        def record(offset, key, value):
+            return ConsumerRecord(topic='-uve', partition=0, offset=offset,
+                timestamp=None, timestamp_type=None, key=key, value=value,
+                checksum=None, serialized_key_size=None,
+                serialized_value_size=None, leader_epoch=None, headers=[],
+                serialized_header_size=-1)
+        mlist = [record(idx, 'ObjectXX:uve1|type1|gen1|coll1',
+                        '{"x": %d}' % idx) for idx in range(100)]
+        mlist.append(record(100, 'ObjectXX:uve1|type2|gen1|coll1', ''))
+        mlist.append(record(101, 'ObjectXX:uve2|type1|gen1|coll2', '{}'))
+        self.assertTrue(ph.msg_handler(mlist))
+        # one callback, with the last value of each struct
+        self.assertEqual(calls, [(1, {'ObjectXX:uve1':
+            {'type1': {'x': 99}, 'type2': None}})])
+        self.assertEqual(ph._partoffset, 101)
+        self.assertEqual(
+            ph._uvedb['coll1']['gen1']['ObjectXX']['uve1']['type1']['c'], 100)
+        self.assertEqual(ph.stats(),
+            {'ObjectXX': {'coll1': {'gen1': {'type1': 100, 'type2': 1}}}})
+    # end test_01_batch_handler
+
+    def test_02_lag(self):
+        ph = UveStreamProc('127.0.0.1:9092', 1, 'uve-1', logging, None,
+                           '127.0.0.1', None, '0', 6379, False, {})
+        consumer = mock.MagicMock()
+        consumer.highwater.return_value = None
+        ph.lag_check(consumer, 'tp')
+        self.assertEqual(ph.lag(), 0)
+        consumer.highwater.return_value = 1500
+        consumer.position.return_value = 1000
+        ph.lag_check(consumer, 'tp')
+        self.assertEqual(ph.lag(), 500)
+        consumer.highwater.assert_called_with('tp')
+        # the last lag is kept if it cannot be read
+        consumer.highwater.return_value = mock.MagicMock()
+        ph.lag_check(consumer, 'tp')
+        self.assertEqual(ph.lag(), 500)
+        consumer.highwater.side_effect = AssertionError('not assigned')
+        ph.lag_check(consumer, 'tp')
+        self.assertEqual(ph.lag(), 500)
+    # end test_02_lag
+
+# end class TestPartitionBacklog
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_00_buckets(self):
+        for usec in [0, 1, 31, 32, 33, 100, 1000, 123456, 10**9,
+                     LatencyHistogram.MAX_USEC]:
+            hist = LatencyHistogram()
+            hist.record(usec)
+            self.assertEqual(hist.count(), 1)
+            bmax = hist.max()
+            self.assertTrue(usec <= bmax <= usec + usec // 16, (usec, bmax))
+        hist = LatencyHistogram()
+        hist.record(LatencyHistogram.MAX_USEC * 2)
+        hist.record(-5)
+        self.assertEqual(hist.counts[-1], 1)
+        self.assertEqual(hist.counts[0], 1)
+        self.assertEqual(len(hist.counts), LatencyHistogram.NBUCKETS)
+    # end test_00_buckets
+
+    def test_01_percentiles_merge(self):
+        hist = LatencyHistogram()
+        self.assertEqual(hist.percentiles([50, 99]), [0, 0])
+        for usec in range(1, 10001):
+            hist.record(usec)
+        p50, p99, p999 = hist.percentiles([50, 99, 99.9])
+        self.assertTrue(5000 <= p50 <= 5000 + 5000 // 16)
+        self.assertTrue(9900 <= p99 <= 9900 + 9900 // 16)
+        self.assertTrue(9990 <= p999 <= 9990 + 9990 // 16)
+        other = LatencyHistogram()
+        other.record(1000000, 10000)
+        hist.merge(other)
+        self.assertEqual(hist.count(), 20000)
+        self.assertEqual(hist.percentiles([25])[0], p50)
+        self.assertTrue(hist.percentiles([99])[0] >= 1000000)
+        hist.reset()
+        self.assertEqual(hist.count(), 0)
+    # end test_01_percentiles_merge
+
+    def test_02_record_benchmark(self):
+        hist = LatencyHistogram()
+        nsamples = 100000
+        samples = [(idx * 7919) % 2000000 for idx in range(nsamples)]
+        record = hist.record
+        start = time.time()
+        for usec in samples:
+            record(usec)
+        elapsed = time.time() - start
+        logging.info('latency histogram: %.3f usec per record' %
+                     (elapsed * 1000000 / nsamples))
+        self.assertEqual(hist.count(), nsamples)
+    # end test_02_record_benchmark
+
+# end class TestLatencyHistogram
+
+
+class TestAGKeyInfo(unittest.TestCase):
+
+    def test_00_fingerprints(self):
+        ki = AGKeyInfo(0)
+        ki.update({"type1": {"x": 1}, "type2": {"y": 1}},
+                  {"type1": 11, "type2": 21})
+        self.assertEqual(ki.added(), set(["type1", "type2"]))
+        ki.update({"type1": {"x": 1}, "type2": {"y": 2}},
+                  {"type1": 11, "type2": 22})
+        self.assertEqual(ki.changed(), set(["type2"]))
+        self.assertEqual(ki.unchanged(), set(["type1"]))
+        # fingerprints are compared instead of contents
+        ki.update({"type1": {"x": 1}, "type2": {"y": 3}},
+                  {"type1": 10, "type2": 22})
+        self.assertEqual(ki.changed(), set(["type1"]))
+        self.assertEqual(ki.unchanged(), set(["type2"]))
+        ki.update_single("type1", {"x": 2}, 12)
+        self.assertEqual(ki.changed(), set(["type1"]))
+        ki.update_single("type1", {"x": 2}, 12)
+        self.assertEqual(ki.changed(), set())
+        # contents are compared if there is no fingerprint
+        ki.update_single("type1", {"x": 3})
+        self.assertEqual(ki.changed(), set(["type1"]))
+        ki.update_single("type1", {"x": 3}, 13)
+        self.assertEqual(ki.changed(), set())
+        ki.update_single("type1", None)
+        self.assertEqual(ki.removed(), set(["type1"]))
+        self.assertEqual(ki.values(), {"type2": {"y": 3}})
+
+
+class TestAlarmRuleEvaluator(unittest.TestCase):
+
+    def alarm_config(self, and_list, parent_type='global-system-config'):
+        """ and_list has (operand1, operation, operand2, variables) """
+        exps = [AlarmExpression(operation=operation, operand1=operand1,
+                    operand2=AlarmOperand2(**operand2), variables=variables) \
+                for operand1, operation, operand2, variables in and_list]
+        if parent_type == 'project':
+            fq_name = ['default-domain', 'project1', 'alarm1']
+        else:
+            fq_name = ['default-global-system-config', 'alarm1']
+        return Alarm(name='alarm1', uve_keys=UveKeysType(['ObjectXX']),
+                     alarm_severity=AlarmBase.ALARM_MAJOR,
+                     alarm_rules=AlarmOrList([AlarmAndList(exps)]),
+                     parent_type=parent_type, fq_name=fq_name)
+
+    def test_00_operations(self):
+        # (operation, UVE value, json_value, result of the interpreter
+        # that evaluated the rules before they were compiled)
+        cases = [
+            ('==', 5, '5', True), ('==', '5', '5', True),
+            ('==', '"up"', '"up"', True), ('==', 'up', '"up"', True),
+            ('==', None, 'null', True), ('!=', 5, '5', False),
+            ('!=', '"down"', '"up"', True),
+            ('<', 3, '5', True), ('<', 7, '5', False),
+            ('<', None, '5', True), ('<', None, 'null', False),
+            ('<', 3, 'null', False),
+            ('<=', 5, '5', True), ('<=', None, '5', True),
+            ('<=', 3, 'null', False),
+            ('>', 7, '5', True), ('>', None, '5', False),
+            ('>', 3, 'null', True), ('>', None, 'null', False),
+            ('>=', 5, '5', True), ('>=', None, '5', False),
+            ('>=', None, 'null', True),
+            ('in', 2, '[1, 2]', True), ('in', 3, '[1, 2]', False),
+            ('in', 2, '2', False),
+            ('not in', 3, '[1, 2]', True), ('not in', 2, '[1, 2]', False),
+            ('not in', 2, '2', True),
+            ('range', 500, '[500, 1000]', True),
+            ('range', 1001, '[500, 1000]', False),
+            ('size==', '[1, 2]', '2', True),
+            ('size==', '[1, 2, 3]', '2', False), ('size==', 2, '2', False),
+            ('size!=', '[1, 2, 3]', '2', True),
+            ('size!=', '[1, 2]', '2', False), ('size!=', 2, '2', True),
+        ]
+        for operation, val, json_value, result in cases:
+            evaluator = AlarmRuleEvaluator(self.alarm_config(
+                [('T.a', operation, {'json_value': json_value}, None)]),
+                mock.MagicMock())
+            or_list = evaluator('ObjectXX:uve1', {'T': {'a': val}})
+            self.assertEqual(or_list is not None, result,
+                (operation, val, json_value))
+            if result:
+                match = or_list[0].and_list[0].match[0]
+                self.assertEqual(match.json_operand1_value,
+                    val if isinstance(val, str) and val != 'up' \
+                        else json.dumps(val))
+                self.assertIsNone(match.json_operand2_value)
+    # end test_00_operations
+
+    def test_01_lists(self):
+        uve = {'T': {'l': [{'x': 1, 'y': '"a"'}, {'x': 5, 'y': '"b"'}],
+                     'n': [{'v': 2}, {'v': 7}]}}
+        # operand1 is a list
+        evaluator = AlarmRuleEvaluator(self.alarm_config(
+            [('T.l.x', '>', {'json_value': '2'}, ['T.l.y'])]),
+            mock.MagicMock())
+        or_list = evaluator('ObjectXX:uve1', uve)
+        self.assertEqual(or_list, [SandeshAlarmAndList([AlarmConditionMatch(
+            condition=AlarmCondition(operation='>', operand1='T.l.x',
+                operand2=SandeshAlarmOperand2(json_value='2'),
+                variables=['T.l.y']),
+            match=[AlarmMatch(json_operand1_value='5',
+                json_operand2_value=None,
+                json_variables={'T.l.y': '"b"'})])])])
+        # both operands are lists, compared element by element
+        evaluator = AlarmRuleEvaluator(self.alarm_config(
+            [('T.l.x', '<', {'uve_attribute': 'T.n.v'}, None)]),
+            mock.MagicMock())
+        or_list = evaluator('ObjectXX:uve1', uve)
+        self.assertEqual([(m.json_operand1_value, m.json_operand2_value) \
+            for m in or_list[0].and_list[0].match], [('1', '2'), ('5', '7')])
+        # lists of different lengths do not match
+        uve['T']['n'] = [{'v': 2}]
+        self.assertIsNone(AlarmRuleEvaluator(self.alarm_config(
+            [('T.l.x', '<', {'uve_attribute': 'T.n.v'}, None)]),
+            mock.MagicMock())('ObjectXX:uve1', uve))
+        # a missing attribute fails the and_list
+        self.assertIsNone(AlarmRuleEvaluator(self.alarm_config(
+            [('T.a', '==', {'json_value': '1'}, None),
+             ('T.z.w', '==', {'json_value': 'null'}, None)]),
+            mock.MagicMock())('ObjectXX:uve1', {'T': {'a': 1}}))
+    # end test_01_lists
+
+    def test_02_uve_types(self):
+        def uve_types(and_list, parent_type='global-system-config'):
+            return AlarmRuleEvaluator(self.alarm_config(and_list,
+                parent_type), mock.MagicMock()).uve_types
+        self.assertEqual(uve_types(
+            [('type1.x', '==', {'json_value': '1'}, None)]), set(['type1']))
+        self.assertEqual(uve_types(
+            [('type1.x', '==', {'uve_attribute': 'type2.y'}, ['type3.z']),
+             ('type4', '!=', {'json_value': 'null'}, None)]),
+            set(['type1', 'type2', 'type3', 'type4']))
+        self.assertEqual(uve_types(
+            [('type1.x', '==', {'json_value': '1'}, None)], 'project'),
+            set(['type1', 'UveVirtualMachineAgent']))
+        for operand in ['*.x', '__key', '__value.x']:
+            self.assertIsNone(uve_types(
+                [('type1.x', '==', {'uve_attribute': operand}, None)]))
+            self.assertIsNone(uve_types(
+                [(operand, '==', {'json_value': '1'}, None)]))
+        self.assertIsNone(uve_types(
+            [('type1.x', '==', {'json_value': '1'}, ['__key'])]))
+    # end test_02_uve_types
+
+    def test_03_parse_warnings(self):
+        logger = mock.MagicMock()
+        evaluator = AlarmRuleEvaluator(self.alarm_config(
+            [('T.a', '==', {'json_value': '5'}, None)]), logger)
+        # values that are not strings are compared as they are,
+        # without a warning (the interpreter logged one for each)
+        self.assertIsNotNone(evaluator('ObjectXX:uve1', {'T': {'a': 5}}))
+        self.assertIsNone(evaluator('ObjectXX:uve1', {'T': {'a': {}}}))
+        logger.warning.assert_not_called()
+        # strings that are not JSON are still reported
+        self.assertIsNone(evaluator('ObjectXX:uve1', {'T': {'a': 'x'}}))
+        self.assertEqual(logger.warning.call_count, 1)
+    # end test_03_parse_warnings
+
+    def test_04_no_rules(self):
+        alarm_cfg = self.alarm_config([])
+        alarm_cfg.alarm_rules = None
+        evaluator = AlarmRuleEvaluator(alarm_cfg, mock.MagicMock())
+        # An alarm with no rules fails to evaluate, whatever the UVE
+        self.assertRaises(ValueError, evaluator, 'ObjectXX:uve1',
+                          {'T': {'a': 1}})
+        self.assertIsNone(evaluator.uve_types)
+        # an empty list of rules never matches
+        alarm_cfg.alarm_rules = AlarmOrList([])
+        evaluator = AlarmRuleEvaluator(alarm_cfg, mock.MagicMock())
+        self.assertIsNone(evaluator('ObjectXX:uve1', {'T': {'a': 1}}))
+        self.assertEqual(evaluator.uve_types, set())
+    # end test_04_no_rules
+
+# end class TestAlarmRuleEvaluator
+
 
 # Tests for all AlarmGenerator code, using mocks for
 # external interfaces for UVEServer, Kafka, libpartition
@@ -381,13 +1189,13 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
     @mock.patch('opserver.alarmgen.Controller.send_agg_uve')
     @mock.patch.object(UVEServer, 'redis_instances')
     @mock.patch.object(UVEServer, 'get_part')
-    @mock.patch.object(UVEServer, 'get_uve')
+    @mock.patch.object(UVEServer, 'get_uves')
     @mock.patch('opserver.partition_handler.KafkaConsumer')
     # Test partition Initialization, including boot-straping using UVEServer
     # Test partition shutdown as well
     def test_00_init(self,
             mock_KafkaConsumer,
-            mock_get_uve, mock_get_part, mock_redis_instances,
+            mock_get_uves, mock_get_part, mock_redis_instances,
             mock_send_agg_uve, mock_clear_agg_uve, mock_reconnect_agg_uve):
 
         m_get_part = Mock_get_part()
@@ -396,9 +1204,9 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                 { "ObjectXX:uve1" : {"type1":{}}  }}
         mock_get_part.side_effect = m_get_part
 
-        m_get_uve = Mock_get_uve()
-        m_get_uve["ObjectXX:uve1"] = {"type1": {"xx": 0}}
-        mock_get_uve.side_effect = m_get_uve
+        m_get_uves = Mock_get_uves()
+        m_get_uves["ObjectXX:uve1"] = {"type1": {"xx": 0}}
+        mock_get_uves.side_effect = m_get_uves
 
         m_redis_instances = Mock_redis_instances()
         m_redis_instances[(socket.getfqdn("127.0.0.1"),0)] = 0
@@ -424,13 +1232,13 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
     @mock.patch('opserver.alarmgen.Controller.send_agg_uve')
     @mock.patch.object(UVEServer, 'redis_instances')
     @mock.patch.object(UVEServer, 'get_part')
-    @mock.patch.object(UVEServer, 'get_uve')
+    @mock.patch.object(UVEServer, 'get_uves')
     @mock.patch('opserver.partition_handler.KafkaConsumer')
     # Test initialization followed by read from Kafka
     # Also test for deletetion of a boot-straped UVE
     def test_01_rxmsg(self,
             mock_KafkaConsumer,
-            mock_get_uve, mock_get_part, mock_redis_instances,
+            mock_get_uves, mock_get_part, mock_redis_instances,
             mock_send_agg_uve, mock_clear_agg_uve, mock_reconnect_agg_uve):
 
         m_get_part = Mock_get_part()
@@ -440,9 +1248,9 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
         mock_get_part.side_effect = m_get_part
 
         # Boostraped UVE ObjectXX:uve1 is not present!
-        m_get_uve = Mock_get_uve()
-        m_get_uve["ObjectYY:uve2"] = {"type2": {"yy": 1}}
-        mock_get_uve.side_effect = m_get_uve
+        m_get_uves = Mock_get_uves()
+        m_get_uves["ObjectYY:uve2"] = {"type2": {"yy": 1}}
+        mock_get_uves.side_effect = m_get_uves
 
         m_redis_instances = Mock_redis_instances()
         m_redis_instances[(socket.getfqdn("127.0.0.1"),0)] = 0
@@ -471,13 +1279,13 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
     @mock.patch('opserver.alarmgen.Controller.send_agg_uve')
     @mock.patch.object(UVEServer, 'redis_instances')
     @mock.patch.object(UVEServer, 'get_part')
-    @mock.patch.object(UVEServer, 'get_uve')
+    @mock.patch.object(UVEServer, 'get_uves')
     @mock.patch('opserver.partition_handler.KafkaConsumer')
     # Test late bringup of collector
     # Also test collector shutdown
     def test_02_collectorha(self,
             mock_KafkaConsumer,
-            mock_get_uve, mock_get_part, mock_redis_instances,
+            mock_get_uves, mock_get_part, mock_redis_instances,
             mock_send_agg_uve, mock_clear_agg_uve, mock_reconnect_agg_uve):
 
         m_get_part = Mock_get_part()
@@ -489,11 +1297,11 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                 { "ObjectZZ:uve3" : { "type3":{}}  }}
         mock_get_part.side_effect = m_get_part
 
-        m_get_uve = Mock_get_uve()
-        m_get_uve["ObjectXX:uve1"] = {"type1": {"xx": 0}}
-        m_get_uve["ObjectYY:uve2"] = {"type2": {"yy": 1}}
-        m_get_uve["ObjectZZ:uve3"] = {"type3": {"zz": 2}}
-        mock_get_uve.side_effect = m_get_uve
+        m_get_uves = Mock_get_uves()
+        m_get_uves["ObjectXX:uve1"] = {"type1": {"xx": 0}}
+        m_get_uves["ObjectYY:uve2"] = {"type2": {"yy": 1}}
+        m_get_uves["ObjectZZ:uve3"] = {"type3": {"zz": 2}}
+        mock_get_uves.side_effect = m_get_uves
 
         m_redis_instances = Mock_redis_instances()
         m_redis_instances[(socket.getfqdn("127.0.0.1"),0)] = 0
@@ -532,7 +1340,7 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
 
         # Withdraw collector 127.0.0.1
         self.assertTrue(self.checker_dict([1, "ObjectXX", "uve1"], self._ag.ptab_info))
-        del m_get_uve["ObjectXX:uve1"]
+        del m_get_uves["ObjectXX:uve1"]
         del m_redis_instances[(socket.getfqdn("127.0.0.1"),0)]
         self.assertTrue(self.checker_dict([1, "ObjectXX", "uve1"], self._ag.ptab_info, False))
 
@@ -4229,6 +5037,580 @@ class TestAlarmGen(unittest.TestCase, TestChecker):
                 asm.is_new_alarm_same(new_alarm_obj))
     # end test_06_is_new_alarm_same
 
+    def test_07_send_agg_uve_inline(self):
+        self._ag._conf._args.redis_agg_inline_size = 20
+        self.addCleanup(setattr, self._ag._conf._args,
+            'redis_agg_inline_size', 0)
+        redish = mock.MagicMock()
+        script = redish.register_script.return_value
+        script.return_value = [5, 0, [], b'666']
+        rows = [OutputRow(key="ObjectXX:uve1", typ="type1", val={"x": 1}),
+                OutputRow(key="ObjectXX:uve1", typ="type2", val={"x": "y"*20}),
+                OutputRow(key="ObjectXX:uve1", typ="type3", val=None),
+                OutputRow(key="ObjectXX:uve2", typ=None, val=None)]
+        self.assertEqual(self._ag.send_agg_uve(redish, "0", 1, 666, rows), 5)
+        # one script call for the whole batch
+        script.assert_called_once()
+        # every key the script writes is declared, one AGPARTVALUES per row
+        self.assertEqual(script.call_args[1]['keys'], ["AGPARTS:0",
+            "AGPARTKEYS:0:1", "AGPARTSEQ:0:1", "AGPARTDIRTY:0:1",
+            "AGPARTVALUES:0:1:ObjectXX:uve1", "AGPARTVALUES:0:1:ObjectXX:uve1",
+            "AGPARTVALUES:0:1:ObjectXX:uve1", "AGPARTVALUES:0:1:ObjectXX:uve2"])
+        args = script.call_args[1]['args']
+        self.assertEqual(args[:4], [1, 666, 0, "AGPARTPUB:0:1"])
+        rargs = [args[idx:idx + 6] for idx in range(4, len(args), 6)]
+        self.assertEqual([r[:3] for r in rargs], [
+            ['U', "ObjectXX:uve1", "type1"],
+            ['U', "ObjectXX:uve1", "type2"],
+            ['R', "ObjectXX:uve1", "type3"],
+            ['D', "ObjectXX:uve2", '']])
+        # the published elements, as completed by the script
+        pub = [r[4] + (', "value": ' + r[3] if r[5] else '') + \
+               ', "seq": 5}' for r in rargs]
+        self.assertEqual(json.loads('[%s]' % ', '.join(pub)), [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": {"x": 1},
+             "seq": 5},
+            {"key": "ObjectXX:uve1", "type": "type2", "seq": 5},
+            {"key": "ObjectXX:uve1", "type": "type3", "value": None,
+             "seq": 5},
+            {"key": "ObjectXX:uve2", "type": None, "seq": 5}])
+        redish.pipeline.assert_not_called()
+        redish.publish.assert_not_called()
+    # end test_07_send_agg_uve_inline
+
+    def test_08_send_agg_snapshot(self):
+        self._ag._conf._args.redis_agg_snapshot_interval = 30
+        self.addCleanup(setattr, self._ag._conf._args,
+            'redis_agg_snapshot_interval', 0)
+        redish = mock.MagicMock()
+        redish.get.return_value = 5
+        script = redish.register_script.return_value
+        script.return_value = [5, 0, [], b'666']
+        self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve1", typ="type1", val={"x": 1}),
+            OutputRow(key="ObjectXX:uve1", typ="type2", val={"x": 2}),
+            OutputRow(key="ObjectXX:uve2", typ="type1", val={"x": 3})])
+        self.assertEqual(script.call_args[1]['args'][2], 1)
+
+        # the script found stale contents, which are cleared
+        # before the rows are written again
+        script.reset_mock()
+        script.side_effect = [[0, 2, [], b'555'], [1, 0, [], b'666']]
+        self.assertEqual(self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve3", typ="type1", val={"x": 4})]), 1)
+        self.assertEqual(script.call_count, 2)
+        redish.pipeline.return_value.hset.assert_called_with(
+            "AGPARTS:0", 1, 666)
+    # end test_08_send_agg_snapshot
+
+    def test_09_alarm_uve_types(self):
+        def alarm_config(name, operand1, operand2, variables=None):
+            return self.get_alarm_config_object({
+                'name': name,
+                'uve_keys': ['ObjectXX'],
+                'alarm_severity': AlarmBase.ALARM_MAJOR,
+                'alarm_rules': {'or_list': [{'and_list': [{
+                    'operand1': operand1,
+                    'operation': '==',
+                    'operand2': operand2,
+                    'variables': variables}]}]},
+                'kwargs': {
+                    'parent_type': 'global-system-config',
+                    'fq_name': ['default-global-system-config', name],
+                    'id_perms': IdPermsType(enable=True, description=name)}})
+
+        alarm1 = AlarmBase(config=alarm_config('alarm1', 'type1.x',
+            {'json_value': '1'}))
+        alarm2 = AlarmBase(config=alarm_config('alarm2', 'type2.x',
+            {'uve_attribute': 'type3.y'}, ['type2.z']))
+        alarm3 = AlarmBase(config=alarm_config('alarm3', '*.x',
+            {'json_value': '1'}))
+        for alarm in [alarm1, alarm2, alarm3]:
+            alarm.set_evaluator(AlarmRuleEvaluator(alarm.config(), logging))
+        self.assertEqual(alarm1.evaluator().uve_types, set(['type1']))
+        self.assertEqual(alarm2.evaluator().uve_types,
+                         set(['type2', 'type3']))
+        self.assertIsNone(alarm3.evaluator().uve_types)
+
+        uve = {'type1': {'x': 1}, 'type2': {'x': 2}, 'type3': {'y': 2}}
+        aproc = AlarmProcessor(self._ag._sandesh)
+        for name, alarm in [('alarm1', alarm1), ('alarm2', alarm2),
+                            ('alarm3', alarm3)]:
+            aproc.process_alarms(name, alarm, 'ObjectXX:uve1', uve,
+                                 set(['type3']))
+        self.assertEqual(aproc.skipped, set(['alarm1']))
+        self.assertEqual(set(aproc.uve_alarms.keys()),
+                         set(['alarm2', 'alarm3']))
+    # end test_09_alarm_uve_types
+
+    def test_10_examine_uve_benchmark(self):
+        alarm = AlarmBase(config=self.get_alarm_config_object({
+            'name': 'alarm1',
+            'uve_keys': ['ObjectXX'],
+            'alarm_severity': AlarmBase.ALARM_MAJOR,
+            'alarm_rules': {'or_list': [{'and_list': [{
+                'operand1': 'type1.x',
+                'operation': '==',
+                'operand2': {'json_value': '1'}}]}]},
+            'kwargs': {
+                'parent_type': 'global-system-config',
+                'fq_name': ['default-global-system-config', 'alarm1'],
+                'id_perms': IdPermsType(enable=True, description='alarm1')}}))
+        alarm_config_db = self._ag._config_handler.alarm_config_db()
+        alarm_config_db['ObjectXX'] = {'alarm1': alarm}
+        self.addCleanup(alarm_config_db.pop, 'ObjectXX')
+        self._ag.alarm_config_change_callback({})
+        self._ag._alarm_config_change_map = {}
+        self._ag.tab_perf['ObjectXX'] = AGTabStats()
+
+        nupdates = 10000
+        with mock.patch('opserver.alarmgen.AlarmProcessor',
+                        wraps=AlarmProcessor) as aproc_cls:
+            start = time.time()
+            for idx in range(nupdates):
+                self._ag.examine_uve_for_alarms(0,
+                    'ObjectXX:uve%d' % (idx % 100),
+                    {'type1': {'x': 0, 'y': idx}, 'type2': {'z': idx}},
+                    set(['type1'] if idx % 2 else ['type2']))
+            elapsed = time.time() - start
+        logging.info('examine_uve_for_alarms: %d updates, %.2f usec each' %
+                     (nupdates, elapsed * 1000000 / nupdates))
+        # one AlarmProcessor for the partition, for all the updates
+        self.assertEqual(aproc_cls.call_count, 1)
+        self.assertEqual(self._ag.tab_perf['ObjectXX'].call_n, nupdates)
+        self.assertEqual(self._ag.tab_perf['ObjectXX'].skip_n, nupdates // 2)
+        self.assertFalse(self._ag.tab_alarms['ObjectXX'])
+    # end test_10_examine_uve_benchmark
+
+    def test_11_alarm_timers_benchmark(self):
+        AlarmStateMachine.clear_timers()
+        self.addCleanup(AlarmStateMachine.clear_timers)
+        ntimers = 100000
+        tab_alarms = {'table1': {}}
+        curr_time = int(time.time())
+        start = time.time()
+        for idx in range(ntimers):
+            uv = 'table1:name%d' % idx
+            asm = AlarmStateMachine('table1', uv, 'type1', self._ag._sandesh,
+                1 + idx % 100, 0, 0, 0, False)
+            asm.set_uai(UVEAlarmInfo(type='type1', timestamp=0))
+            asm.set_alarms()
+            tab_alarms['table1'][uv] = {'type1': asm}
+        # cancel every 10th timer
+        for idx in range(0, ntimers, 10):
+            asm = tab_alarms['table1']['table1:name%d' % idx]['type1']
+            self.assertTrue(asm.clear_alarms())
+        elapsed = time.time() - start
+        logging.info('alarm timers: %d pending, %.2f usec per insert' %
+                     (ntimers, elapsed * 1000000 / ntimers))
+
+        # no timer is due yet
+        start = time.time()
+        delete_alarms, update_alarms = AlarmStateMachine.run_timers(
+            curr_time, tab_alarms)
+        logging.info('alarm timers: %.2f usec for run with no due timer' %
+                     ((time.time() - start) * 1000000))
+        self.assertEqual(update_alarms, [])
+        self.assertEqual(delete_alarms, [])
+
+        start = time.time()
+        delete_alarms, update_alarms = AlarmStateMachine.run_timers(
+            curr_time + 200, tab_alarms)
+        elapsed = time.time() - start
+        logging.info('alarm timers: %.2f usec per expired timer' %
+                     (elapsed * 1000000 / len(update_alarms)))
+        self.assertEqual(len(update_alarms), ntimers - ntimers // 10)
+        self.assertEqual(delete_alarms, [])
+        self.assertFalse(AlarmStateMachine.tab_alarms_timer)
+        self.assertFalse(AlarmStateMachine.timer_heap)
+    # end test_11_alarm_timers_benchmark
+
+    def test_12_uveq_fifo(self):
+        self._ag.handle_uve_notifq(5, OrderedDict([
+            ('ObjectXX:uve1', {'type1': {}}),
+            ('ObjectXX:uve2', {'type1': {}})]))
+        self.addCleanup(self._ag._uveq.pop, 5)
+        self.addCleanup(self._ag._uveq_ts.pop, 5)
+        enq_ts = self._ag._uveq_ts[5]['ObjectXX:uve1']
+        self._ag.handle_uve_notifq(5, OrderedDict([
+            ('ObjectXX:uve3', None),
+            ('ObjectXX:uve1', {'type2': {}})]))
+        # an updated key keeps its place and its enqueue time
+        self.assertEqual(list(self._ag._uveq[5].keys()),
+            ['ObjectXX:uve1', 'ObjectXX:uve2', 'ObjectXX:uve3'])
+        self.assertEqual(self._ag._uveq[5]['ObjectXX:uve1'],
+                         {'type1': {}, 'type2': {}})
+        self.assertEqual(self._ag._uveq_ts[5]['ObjectXX:uve1'], enq_ts)
+        self.assertTrue(self._ag.uveq_oldest_age(5) >= 0)
+
+        # failed UVEs go back to the head, with their enqueue time
+        kp, vp = self._ag._uveq[5].popitem(last=False)
+        self.assertEqual(kp, 'ObjectXX:uve1')
+        self._ag._uveq_ts[5].pop(kp)
+        self._ag.requeue_uve_notifq(5, OrderedDict([(kp, vp)]),
+                                    {kp: enq_ts - 10})
+        self.assertEqual(next(iter(self._ag._uveq[5])), 'ObjectXX:uve1')
+        self.assertTrue(self._ag.uveq_oldest_age(5) >= 10)
+        self.assertEqual(self._ag.uveq_oldest_age(6), 0)
+    # end test_12_uveq_fifo
+
+    def test_13_uve_batch_size(self):
+        self._ag._uve_key_time = None
+        self.assertEqual(self._ag.uve_batch_size(1), 200)
+        # 100 usec per UVE, and a target of 1 sec
+        self._ag.update_uve_key_time(0.02, 200)
+        self.assertAlmostEqual(self._ag.uve_batch_size(1), 10000, delta=1)
+        self.assertAlmostEqual(self._ag.uve_batch_size(4), 2500, delta=1)
+        self.assertEqual(self._ag.uve_batch_size(100), 200)
+        self._ag.update_uve_key_time(0.0, 200)
+        self.assertAlmostEqual(self._ag._uve_key_time, 0.00008)
+        self.assertAlmostEqual(self._ag.uve_batch_size(1), 12500, delta=1)
+        self._ag._uve_key_time = 0.000001
+        self.assertEqual(self._ag.uve_batch_size(1), 20000)
+
+        # queued UVEs wake up the UVE processing
+        self._ag._uveq_event.clear()
+        self._ag.handle_uve_notifq(5, {'ObjectXX:uve1': None})
+        self.addCleanup(self._ag._uveq.pop, 5, None)
+        self.addCleanup(self._ag._uveq_ts.pop, 5, None)
+        self.assertTrue(self._ag._uveq_event.is_set())
+    # end test_13_uve_batch_size
+
+    def test_14_partition_checkpoint(self):
+        ckpt_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ckpt_dir)
+        self._ag._conf._args.checkpoint_dir = ckpt_dir
+        self.addCleanup(setattr, self._ag._conf._args, 'checkpoint_dir', None)
+        AlarmStateMachine.clear_timers()
+        self.addCleanup(AlarmStateMachine.clear_timers)
+        self.addCleanup(self._ag._uveq.pop, 7, None)
+        self.addCleanup(self._ag._uveq_ts.pop, 7, None)
+        self.addCleanup(self._ag.ptab_info.pop, 7, None)
+        self.addCleanup(self._ag._ckpt_uves.pop, 7, None)
+        self._ag.tab_alarms = {}
+        alarm_config = {
+            'name': 'alarm1',
+            'uve_keys': ['ObjectXX'],
+            'alarm_severity': AlarmBase.ALARM_MAJOR,
+            'alarm_rules': {'or_list': [{'and_list': [{
+                'operand1': 'type1.x',
+                'operation': '==',
+                'operand2': {'json_value': '1'}}]}]},
+            'kwargs': {
+                'parent_type': 'global-system-config',
+                'fq_name': ['default-global-system-config', 'alarm1'],
+                'id_perms': IdPermsType(enable=True, description='alarm1')}}
+        alarm_config_db = self._ag._config_handler.alarm_config_db()
+        alarm_config_db['ObjectXX'] = {'alarm1': AlarmBase(
+            config=self.get_alarm_config_object(alarm_config))}
+        self.addCleanup(alarm_config_db.pop, 'ObjectXX')
+
+        self._ag.ptab_info[7] = {'ObjectXX': {}}
+        for idx in range(3):
+            kinfo = AGKeyInfo(7)
+            kinfo.update({'type1': {'x': idx}, 'type2': {'y': idx}},
+                         {'type1': 100 + idx, 'type2': 200 + idx})
+            self._ag.ptab_info[7]['ObjectXX']['uve%d' % idx] = kinfo
+        self.add_test_alarm('ObjectXX', 'uve1', 'alarm1')
+        asm = self._ag.tab_alarms['ObjectXX']['ObjectXX:uve1']['alarm1']
+        asm.get_uas().state = UVEAlarmState.Idle
+        asm.get_uac().ActiveTimer = 30
+        asm.set_alarms()
+        active_timeout = asm.activeTimeout
+        self._ag.write_partition_checkpoint(7)
+        self.assertFalse(self._ag.restore_partition_checkpoint(8))
+
+        # restart with an empty state
+        AlarmStateMachine.clear_timers()
+        self._ag.ptab_info.pop(7)
+        self._ag.tab_alarms = {}
+        self.assertTrue(self._ag.restore_partition_checkpoint(7))
+        # the restored UVEs are queued when the worker creates the queue
+        self.assertFalse(7 in self._ag._uveq)
+        self._ag.handle_uve_notifq(7, {'ObjectXX:uve0': {'type1': {}},
+                                       'ObjectXX:uve3': {'type1': {}}})
+        self.assertEqual(dict(self._ag._uveq[7]), {'ObjectXX:uve0': None,
+            'ObjectXX:uve1': None, 'ObjectXX:uve2': None,
+            'ObjectXX:uve3': {'type1': {}}})
+        kinfo = self._ag.ptab_info[7]['ObjectXX']['uve1']
+        self.assertEqual(kinfo.fingerprints(), {'type1': 101, 'type2': 201})
+        asm = self._ag.tab_alarms['ObjectXX']['ObjectXX:uve1']['alarm1']
+        self.assertEqual(asm.get_uas().state, UVEAlarmState.Soak_Active)
+        self.assertEqual(asm.get_uai().type, 'alarm1')
+        self.assertEqual(AlarmStateMachine.tab_alarms_timer,
+            {active_timeout: set([('ObjectXX', 'ObjectXX:uve1', 'alarm1')])})
+
+        # only the structs that changed since the checkpoint
+        # are evaluated for alarms
+        kinfo.update({'type1': {'x': 1}, 'type2': {'y': 5}},
+                     {'type1': 101, 'type2': 205})
+        self.assertEqual(kinfo.added(), set(['type1', 'type2']))
+        self.assertEqual(kinfo.reconcile(), set(['type2']))
+        self.assertEqual(kinfo.reconcile(), None)
+
+        # the alarm states evaluated with a different alarm config are
+        # not restored, and the UVEs are evaluated for all the alarms
+        alarm_config['alarm_severity'] = AlarmBase.ALARM_CRITICAL
+        alarm_config_db['ObjectXX'] = {'alarm1': AlarmBase(
+            config=self.get_alarm_config_object(alarm_config))}
+        AlarmStateMachine.clear_timers()
+        self._ag._uveq.pop(7)
+        self._ag.ptab_info.pop(7)
+        self._ag.tab_alarms = {}
+        self.assertTrue(self._ag.restore_partition_checkpoint(7))
+        self.assertEqual(self._ag.tab_alarms['ObjectXX'], {})
+        self.assertEqual(AlarmStateMachine.tab_alarms_timer, {})
+        kinfo = self._ag.ptab_info[7]['ObjectXX']['uve1']
+        self.assertEqual(kinfo.fingerprints(), {})
+        kinfo.update({'type1': {'x': 1}, 'type2': {'y': 1}},
+                     {'type1': 101, 'type2': 201})
+        self.assertEqual(kinfo.reconcile(), None)
+
+        # an old checkpoint is not restored
+        self._ag._ckpt_uves.pop(7)
+        self._ag.ptab_info.pop(7)
+        self._ag._conf._args.checkpoint_max_age = 1
+        self.addCleanup(setattr, self._ag._conf._args, 'checkpoint_max_age',
+                        600)
+        with mock.patch('opserver.alarmgen.time.time',
+                        return_value=time.time() + 10):
+            self.assertFalse(self._ag.restore_partition_checkpoint(7))
+        self.assertFalse(7 in self._ag.ptab_info)
+    # end test_14_partition_checkpoint
+
+    def test_15_partition_stats(self):
+        self._ag.handle_uve_notifq(3, {'ObjectXX:uve1': None,
+                                       'ObjectXX:uve2': None})
+        self._ag.record_part_batch(3, 100, 2000, 30)
+        self._ag.record_part_batch(3, 300, 6000, 10)
+        # the counters are reported for the previous stats interval
+        ps = self._ag.partition_stats(3)
+        self.assertEqual(ps.batches, 0)
+        self.assertEqual(ps.uveq_size, 2)
+        self._ag.process_stats()
+        ps = self._ag.partition_stats(3)
+        self.assertEqual(ps.batches, 2)
+        self.assertEqual(ps.batch_uves_avg, 200)
+        self.assertEqual(ps.batch_uves_max, 300)
+        self.assertEqual(ps.batch_time_avg, 4000)
+        self.assertEqual(ps.batch_time_max, 6000)
+        self.assertEqual(ps.processing_age_max, 30)
+        # percentiles are within 1/16 above the values recorded
+        for val, pct in [(100, ps.batch_uves_p50), (300, ps.batch_uves_p99),
+                         (2000, ps.batch_time_p50), (6000, ps.batch_time_p99),
+                         (6000, ps.batch_time_p999)]:
+            self.assertTrue(val <= pct <= val + val // 16, (val, pct))
+        self.assertEqual(self._ag.part_perf, {})
+        self._ag.process_stats()
+        self.assertEqual(self._ag.partition_stats(3).batches, 0)
+
+        # the time of each partition is added up separately
+        part_timing = {}
+        self.assertEqual(self._ag.run_timed(part_timing, 3, abs, -1), 1)
+        self.assertEqual(self._ag.run_timed(part_timing, 3, abs, -2), 2)
+        self.assertRaises(TypeError, self._ag.run_timed, part_timing, 4,
+                          abs, 'x')
+        self.assertEqual(set(part_timing.keys()), set([3, 4]))
+        self.assertTrue(part_timing[3][1] <= part_timing[4][1])
+    # end test_15_partition_stats
+
+    def test_16_stage_latency(self):
+        self._ag.stage_hist['get_uve'].record(1000)
+        self._ag.stage_hist['uveq_wait'].record(50, 4)
+        # stage latency is reported for the previous stats interval,
+        # and since the start
+        self._ag.process_stats()
+        latency = dict((sl.stage, sl) for sl in \
+            self._ag.stage_latency(self._ag.stage_hist_prev))
+        self.assertEqual(len(latency), 5)
+        self.assertEqual(latency['get_uve'].count, 1)
+        self.assertTrue(1000 <= latency['get_uve'].p50 <= 1063)
+        self.assertEqual(latency['uveq_wait'].count, 4)
+        self.assertEqual(latency['uveq_wait'].p999, latency['uveq_wait'].max)
+        self.assertEqual(latency['alarm_eval'].count, 0)
+        self._ag.stage_hist['get_uve'].record(3000)
+        self._ag.process_stats()
+        self.assertEqual(self._ag.stage_hist_prev['get_uve'].count(), 1)
+        self.assertEqual(self._ag.stage_hist_total['get_uve'].count(), 2)
+    # end test_16_stage_latency
+
+    def start_agg_redis(self):
+        redis_uve = Redis(find_buildroot(os.getcwd()))
+        redis_uve.start()
+        self.addCleanup(redis_uve.stop)
+        return StrictRedisWrapper(host='127.0.0.1', port=redis_uve.port,
+                                  db=self._ag._conf.get_redis_agg_db())
+    # end start_agg_redis
+
+    def test_17_agg_uve_script(self):
+        redish = self.start_agg_redis()
+        pubsub = redish.pubsub()
+        pubsub.subscribe('AGPARTPUB:0:1')
+        self.addCleanup(pubsub.close)
+        def published():
+            while True:
+                msg = pubsub.get_message(timeout=5)
+                self.assertIsNotNone(msg)
+                if msg['type'] == 'message':
+                    return json.loads(msg['data'])
+
+        # the script is run on the redis server, and its results are kept
+        results = []
+        script = self._ag.agg_uve_script(redish)
+        def run_script(**kwargs):
+            results.append(script(**kwargs))
+            return results[-1]
+        self._ag._agg_script = mock.Mock(side_effect=run_script,
+                                         registered_client=redish)
+        self._ag._conf._args.redis_agg_inline_size = 20
+        self.addCleanup(setattr, self._ag._conf._args,
+            'redis_agg_inline_size', 0)
+        self._ag._conf._args.redis_agg_snapshot_interval = 30
+        self.addCleanup(setattr, self._ag._conf._args,
+            'redis_agg_snapshot_interval', 0)
+
+        # new partition
+        self.assertEqual(self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve1", typ="type1", val={"x": 1}),
+            OutputRow(key="ObjectXX:uve1", typ="type2", val={"x": "y"*20}),
+            OutputRow(key="ObjectXX:uve2", typ="type1", val={"x": 3})]), 1)
+        self.assertEqual(results[-1][1], 1)
+        self.assertEqual(redish.hget("AGPARTS:0", 1), b'666')
+        self.assertEqual(redish.smembers("AGPARTKEYS:0:1"),
+                         set([b'ObjectXX:uve1', b'ObjectXX:uve2']))
+        self.assertEqual(redish.hgetall("AGPARTVALUES:0:1:ObjectXX:uve1"),
+            {b'type1': json.dumps({"x": 1}).encode(),
+             b'type2': json.dumps({"x": "y"*20}).encode()})
+        self.assertEqual(redish.smembers("AGPARTDIRTY:0:1"),
+                         set([b'ObjectXX:uve1', b'ObjectXX:uve2']))
+        self.assertEqual(published(), [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": {"x": 1},
+             "seq": 1},
+            {"key": "ObjectXX:uve1", "type": "type2", "seq": 1},
+            {"key": "ObjectXX:uve2", "type": "type1", "value": {"x": 3},
+             "seq": 1}])
+
+        # the rows that remove all the structs of a UVE, or the UVE
+        redish.delete("AGPARTDIRTY:0:1")
+        self.assertEqual(self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve1", typ="type1", val=None),
+            OutputRow(key="ObjectXX:uve1", typ="type2", val=None),
+            OutputRow(key="ObjectXX:uve2", typ=None, val=None)]), 2)
+        self.assertEqual(results[-1][1:3], [0, [b'ObjectXX:uve1']])
+        self.assertEqual(redish.smembers("AGPARTKEYS:0:1"), set())
+        self.assertFalse(redish.exists("AGPARTVALUES:0:1:ObjectXX:uve1"))
+        self.assertFalse(redish.exists("AGPARTVALUES:0:1:ObjectXX:uve2"))
+        self.assertEqual(redish.smembers("AGPARTDIRTY:0:1"),
+                         set([b'ObjectXX:uve1', b'ObjectXX:uve2']))
+        self.assertEqual(published(), [
+            {"key": "ObjectXX:uve1", "type": "type1", "value": None,
+             "seq": 2},
+            {"key": "ObjectXX:uve1", "type": "type2", "value": None,
+             "seq": 2},
+            {"key": "ObjectXX:uve2", "type": None, "seq": 2}])
+
+        # AGPARTDIRTY is not maintained without snapshots
+        self._ag._conf._args.redis_agg_snapshot_interval = 0
+        redish.delete("AGPARTDIRTY:0:1")
+        self.assertEqual(self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve3", typ="type1", val={"x": 4})]), 3)
+        self.assertFalse(redish.exists("AGPARTDIRTY:0:1"))
+        self.assertEqual(published(), [
+            {"key": "ObjectXX:uve3", "type": "type1", "value": {"x": 4},
+             "seq": 3}])
+
+        # the partition has stale contents; the script writes nothing,
+        # and the contents are cleared before the rows are written again
+        redish.set("AGPARTSNAP:0:1", json.dumps({"acq_time": 666, "seq": 3,
+            "gen": 9, "chunks": 1, "prev": [[8, 1]]}))
+        redish.set("AGPARTSNAP:0:1:9:0", b'chunk')
+        redish.set("AGPARTSNAP:0:1:8:0", b'chunk')
+        self.assertEqual(self._ag.send_agg_uve(redish, "0", 1, 777, [
+            OutputRow(key="ObjectXX:uve4", typ="type1", val={"x": 5})]), 1)
+        self.assertEqual(results[-2], [0, 2, [], b'666'])
+        self.assertEqual(results[-1][1], 0)
+        self.assertEqual(redish.hget("AGPARTS:0", 1), b'777')
+        self.assertEqual(redish.smembers("AGPARTKEYS:0:1"),
+                         set([b'ObjectXX:uve4']))
+        self.assertFalse(redish.exists("AGPARTVALUES:0:1:ObjectXX:uve3"))
+        self.assertEqual(redish.keys("AGPARTSNAP:0:1*"), [])
+        self.assertEqual(published(), [
+            {"key": "ObjectXX:uve4", "type": "type1", "value": {"x": 5},
+             "seq": 1}])
+    # end test_17_agg_uve_script
+
+    def test_18_agg_snapshot(self):
+        redish = self.start_agg_redis()
+        self._ag._conf._args.redis_agg_snapshot_interval = 30
+        self.addCleanup(setattr, self._ag._conf._args,
+            'redis_agg_snapshot_interval', 0)
+        worker = mock.MagicMock()
+        worker.acq_time.return_value = 666
+        self._ag._workers[1] = worker
+        self.addCleanup(self._ag._workers.pop, 1)
+        self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve1", typ="type1", val={"x": 1}),
+            OutputRow(key="ObjectXX:uve1", typ="type2", val={"x": 2}),
+            OutputRow(key="ObjectXX:uve2", typ="type1", val={"x": 3})])
+        self._ag.send_agg_snapshot(redish, "0", 1, 666)
+        head = json.loads(redish.get("AGPARTSNAP:0:1"))
+        self.assertEqual(dict((k, head[k]) for k in
+            ["acq_time", "seq", "chunks", "prev"]),
+            {"acq_time": 666, "seq": 1, "chunks": 1, "prev": []})
+        self.assertEqual(json.loads(zlib.decompress(
+            redish.get("AGPARTSNAP:0:1:%d:0" % head["gen"]))), {
+                "ObjectXX:uve1": {"type1": json.dumps({"x": 1}),
+                                  "type2": json.dumps({"x": 2})},
+                "ObjectXX:uve2": {"type1": json.dumps({"x": 3})}})
+        self.assertFalse(redish.exists("AGPARTDIRTY:0:1"))
+
+        # the partition changes while the next snapshot is built; the
+        # snapshot has the sequence number from when the build started
+        self._ag.send_agg_uve(redish, "0", 1, 666, [
+            OutputRow(key="ObjectXX:uve1", typ="type2", val=None)])
+        sscan_batches = redish.sscan_batches
+        def sscan_during_write(name, count):
+            for keys in sscan_batches(name, count):
+                yield keys
+            self._ag.send_agg_uve(redish, "0", 1, 666, [
+                OutputRow(key="ObjectXX:uve2", typ="type1", val={"x": 4})])
+        with mock.patch.object(redish, 'sscan_batches',
+                               side_effect=sscan_during_write), \
+             mock.patch('opserver.alarmgen._AGG_SNAP_BATCH', 1):
+            self._ag.send_agg_snapshot(redish, "0", 1, 666)
+        head2 = json.loads(redish.get("AGPARTSNAP:0:1"))
+        self.assertEqual(head2["seq"], 2)
+        self.assertEqual(head2["chunks"], 2)
+        self.assertEqual(head2["prev"], [[head["gen"], 1]])
+        uves = {}
+        for idx in range(2):
+            chunk = json.loads(zlib.decompress(redish.get(
+                "AGPARTSNAP:0:1:%d:%d" % (head2["gen"], idx))))
+            self.assertEqual(len(chunk), 1)
+            uves.update(chunk)
+        self.assertEqual(uves, {
+            "ObjectXX:uve1": {"type1": json.dumps({"x": 1})},
+            "ObjectXX:uve2": {"type1": json.dumps({"x": 3})}})
+        self.assertEqual(redish.smembers("AGPARTDIRTY:0:1"),
+                         set([b'ObjectXX:uve2']))
+        # the chunks of the previous snapshot are kept until the next one
+        self.assertTrue(redish.exists("AGPARTSNAP:0:1:%d:0" % head["gen"]))
+        self._ag.send_agg_snapshot(redish, "0", 1, 666)
+        head3 = json.loads(redish.get("AGPARTSNAP:0:1"))
+        self.assertEqual(head3["seq"], 3)
+        self.assertEqual(head3["prev"], [[head2["gen"], 2]])
+        self.assertFalse(redish.exists("AGPARTSNAP:0:1:%d:0" % head["gen"]))
+
+        # the snapshot of a partition released during the build is dropped
+        worker.acq_time.return_value = 777
+        self._ag.send_agg_snapshot(redish, "0", 1, 666)
+        self.assertEqual(json.loads(redish.get("AGPARTSNAP:0:1")), head3)
+        self.assertEqual(len(redish.keys("AGPARTSNAP:0:1:*")), 3)
+
+        self._ag.clear_agg_uve(redish, "0", 1)
+        self.assertEqual(redish.keys("AGPARTSNAP:0:1*"), [])
+    # end test_18_agg_snapshot
+
 
 # end class TestAlarmGen
 
@@ -715,6 +715,8 @@ class TestAlarmGenConfigHandler(unittest.TestCase):
                     self.assertTrue(fq_name in test.output.alarm_config_db[table])
                     self.assertEqual(alarm_cfg.config(),
                         test.output.alarm_config_db[table][fq_name].config())
+                    # the rules are compiled when the config is loaded
+                    self.assertIsNotNone(alarm_cfg.evaluator())
             if test.output.alarm_config_change_map:
                 alarmgen_config_handler._alarm_config_change_callback.\
                     assert_called_with(test.output.alarm_config_change_map)
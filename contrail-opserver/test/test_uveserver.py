@@ -17,6 +17,7 @@ import json
 
 from opserver.uveserver import UVEServer
 from opserver.uveserver import ParallelAggregator
+from opserver.uveserver import RedisInst, RedisInstKey
 
 
 logging.basicConfig(level=logging.INFO,
@@ -26,6 +27,38 @@ class RedisMock(object):
     pass
 
 
+class RedisPipelineMock(object):
+    def __init__(self, data):
+        self._data = data
+        self._res = []
+
+    def smembers(self, key):
+        self._res.append(self._data.get(key, set()))
+
+    def hgetall(self, key):
+        self._res.append(self._data.get(key, {}))
+
+    def execute(self):
+        res = self._res
+        self._res = []
+        return res
+
+
+class RedisDataMock(object):
+    def __init__(self, data):
+        self._data = data
+        self.npipes = 0
+
+    def pipeline(self):
+        self.npipes += 1
+        return RedisPipelineMock(self._data)
+
+    def sscan_batches(self, name, count):
+        members = sorted(self._data.get(name, set()))
+        for idx in range(0, len(members), count):
+            yield members[idx:idx + count]
+
+
 def MakeBasic(typ, val, aggtype=None):
     item = {}
     item['@type'] = typ
@@ -422,6 +455,73 @@ class UVEServerTest(unittest.TestCase):
             "UVEVirtualNetwork"]["in_stats"]["sample"]
         self.assertEqual(in_stats, res['UVEVirtualNetwork']['in_stats'])
 
+    def test_get_uves(self):
+        logging.info("%%% Running test_get_uves %%%")
+
+        data = {}
+        for idx in range(3):
+            key = "ObjectVNTable:vn-%02d" % idx
+            data["ORIGINS:" + key] = set(["src1:mod1:UVEVirtualNetwork"])
+            data["VALUES:" + key + ":src1:mod1:UVEVirtualNetwork"] = {
+                "name": '<name type="string">vn-%02d</name>' % idx,
+                "count": '<count type="u32">%d</count>' % idx}
+        redish = RedisDataMock(data)
+        oss = UVEServer([], logging)
+        rinst = RedisInst()
+        rinst.redis_handle = redish
+        rinst.collector_pid = "host:Analytics:contrail-collector:100"
+        oss._redis_uve_map[RedisInstKey(ip="127.0.0.1", port=6379)] = rinst
+
+        keys = dict(("ObjectVNTable:vn-%02d" % idx, {}) for idx in range(3))
+        keys["ObjectVNTable:vn-02"] = {
+            "cfilt": {"UVEVirtualNetwork": set(["count"])}}
+        keys["ObjectVNTable:vn-03"] = {}
+        res = oss.get_uves(keys, True)
+        self.assertEqual(redish.npipes, 2)
+        for key, filters in keys.items():
+            self.assertEqual(res[key], oss.get_uve(key, True, filters))
+        self.assertEqual(res["ObjectVNTable:vn-01"],
+            (False, {"UVEVirtualNetwork": {"name": "vn-01", "count": 1}}))
+        self.assertEqual(res["ObjectVNTable:vn-02"],
+            (False, {"UVEVirtualNetwork": {"count": 2}}))
+        self.assertEqual(res["ObjectVNTable:vn-03"], (False, {}))
+
+        # fingerprints change only with the contents read
+        fprints = {}
+        oss.get_uves({"ObjectVNTable:vn-01": {}}, True, fprints=fprints)
+        fprints2 = {}
+        oss.get_uves({"ObjectVNTable:vn-01": {}}, True, fprints=fprints2)
+        self.assertEqual(fprints, fprints2)
+        self.assertTrue("UVEVirtualNetwork" in fprints["ObjectVNTable:vn-01"])
+        data["VALUES:ObjectVNTable:vn-01:src1:mod1:UVEVirtualNetwork"][
+            "count"] = '<count type="u32">5</count>'
+        oss.get_uves({"ObjectVNTable:vn-01": {}}, True, fprints=fprints2)
+        self.assertNotEqual(fprints, fprints2)
+
+    def test_get_part(self):
+        logging.info("%%% Running test_get_part %%%")
+
+        nuves = 2500
+        data = {"PART2KEY:3": set(
+            "host:Analytics:contrail-collector:0:UveType%d:ObjectXX:uve%d" %
+            (idx % 2, idx) for idx in range(nuves))}
+        oss = UVEServer([], logging)
+        rinst = RedisInst()
+        rinst.redis_handle = RedisDataMock(data)
+        oss._redis_uve_map[RedisInstKey(ip="127.0.0.1", port=6379)] = rinst
+
+        batches = []
+        coll, gen_uves = oss.get_part(3, ("127.0.0.1", 6379, 0),
+            lambda coll, uves: batches.append((coll, uves)))
+        self.assertEqual(coll, "127.0.0.1:6379")
+        gen = "host:Analytics:contrail-collector:0"
+        self.assertEqual(list(gen_uves.keys()), [gen])
+        self.assertEqual(len(gen_uves[gen]), nuves)
+        self.assertEqual(gen_uves[gen]["ObjectXX:uve7"], {"UveType1": {}})
+        # the contents are also reported in batches as they are read
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(sum(len(uves[gen]) for _, uves in batches), nuves)
+
 
 if __name__ == '__main__':
     unittest.main()